@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of HTTP/1.1 and HTTP/2 :func:`tendril.utils.www.hx.async_client`.
+
+A local asyncio server, shaped like an internal JSON API, answers each
+request after a fixed latency. It speaks HTTP/1.1 and, if the ``h2``
+package is installed, cleartext HTTP/2 with prior knowledge (h2c), as
+internal APIs behind a TLS terminating proxy often do.
+
+Each scenario sends a number of requests with a given concurrency
+through a single client, and reports the throughput, the latency
+percentiles and the number of TCP connections the server accepted.
+The ``http2`` scenarios are skipped if ``h2`` is not installed.
+
+Usage::
+
+    python benchmarks/bench_async_client_http2.py [--requests N]
+        [--concurrency C] [--latency MS] [--size BYTES] [--json FILE]
+
+"""
+
+
+import json
+import time
+import logging
+import asyncio
+import argparse
+
+from tendril.utils.www import hx
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.events import StreamEnded
+    from h2.events import ConnectionTerminated
+except ImportError:
+    H2Connection = None
+
+
+_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+class _Server(object):
+    def __init__(self, latency, size):
+        self.latency = latency
+        self.body = json.dumps({'data': 'x' * size}).encode('ascii')
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            head = await reader.readexactly(len(_PREFACE))
+        except asyncio.IncompleteReadError:
+            writer.close()
+            return
+        try:
+            if head == _PREFACE and H2Connection is not None:
+                await self._handle_h2(head, reader, writer)
+            else:
+                await self._handle_h1(head, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_h1(self, head, reader, writer):
+        buffer = head
+        while True:
+            while b'\r\n\r\n' not in buffer:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                buffer += data
+            _, buffer = buffer.split(b'\r\n\r\n', 1)
+            await asyncio.sleep(self.latency)
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Content-Length: ' +
+                         str(len(self.body)).encode('ascii') +
+                         b'\r\n\r\n' + self.body)
+            await writer.drain()
+
+    async def _respond_h2(self, conn, stream_id, writer):
+        await asyncio.sleep(self.latency)
+        conn.send_headers(stream_id, [
+            (':status', '200'),
+            ('content-type', 'application/json'),
+            ('content-length', str(len(self.body))),
+        ])
+        # The body is small enough to not need flow control.
+        conn.send_data(stream_id, self.body, end_stream=True)
+        writer.write(conn.data_to_send())
+        await writer.drain()
+
+    async def _handle_h2(self, head, reader, writer):
+        conn = H2Connection(H2Configuration(client_side=False))
+        conn.initiate_connection()
+        conn.update_settings({'max_concurrent_streams': 1000})
+        writer.write(conn.data_to_send())
+        tasks = set()
+        data = head
+        while data:
+            for event in conn.receive_data(data):
+                if isinstance(event, StreamEnded):
+                    task = asyncio.ensure_future(
+                        self._respond_h2(conn, event.stream_id, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif isinstance(event, ConnectionTerminated):
+                    return
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            data = await reader.read(65536)
+
+
+async def _run_scenario(url, protocol, requests, concurrency):
+    kwargs = {'shared': False, 'cache': False}
+    if protocol == 'http2':
+        kwargs.update({'http2': True, 'http1': False})
+    else:
+        kwargs['http2'] = False
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def _fetch(client):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get(url)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+            return response.http_version
+
+    async with hx.async_client(**kwargs) as client:
+        start = time.perf_counter()
+        versions = await asyncio.gather(
+            *[_fetch(client) for _ in range(requests)])
+        total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': protocol,
+        'http_version': versions[0],
+        'requests': requests,
+        'concurrency': concurrency,
+        'total': total,
+        'throughput': requests / total,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def _run(requests, concurrency, latency, size):
+    server = _Server(latency / 1000.0, size)
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    url = 'http://127.0.0.1:{0}/api/v1/items'.format(port)
+    protocols = ['http1']
+    if H2Connection is not None and hx.http2_available():
+        protocols.append('http2')
+    results = []
+    try:
+        for protocol in protocols:
+            server.connections = 0
+            result = await _run_scenario(url, protocol,
+                                         requests, concurrency)
+            result['connections'] = server.connections
+            results.append(result)
+    finally:
+        listener.close()
+        await listener.wait_closed()
+    return results
+
+
+def run(requests, concurrency, latency, size):
+    return asyncio.run(_run(requests, concurrency, latency, size))
+
+
+def report(results):
+    print("{0:<10}{1:<10}{2:>8}{3:>12}{4:>10}{5:>10}{6:>14}".format(
+        'scenario', 'version', 'req/s', 'total/s',
+        'p50/ms', 'p99/ms', 'connections'))
+    for r in results:
+        print("{0:<10}{1:<10}{2:>8.1f}{3:>12.3f}{4:>10.2f}{5:>10.2f}"
+              "{6:>14}".format(r['scenario'], r['http_version'],
+                               r['throughput'], r['total'], r['p50_ms'],
+                               r['p99_ms'], r['connections']))
+    if len(results) < 2:
+        print("HTTP/2 scenarios skipped, the 'h2' package is not installed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='total number of requests')
+    parser.add_argument('--concurrency', type=int, default=500,
+                        help='number of requests in flight at once')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='server latency per request, in ms')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='size of each response body, in bytes')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON')
+    args = parser.parse_args()
+    # httpx logs every request at INFO.
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    results = run(args.requests, args.concurrency, args.latency, args.size)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
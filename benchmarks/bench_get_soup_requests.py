@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of :func:`tendril.utils.www.req.get_soup_requests`.
+
+A local HTTP server serves synthetic pages shaped like a vendor's
+parametric search results (such as digikey's passive component search) :
+large HTML tables, many query-string variants of the same search, and
+``Vary`` headers. Optionally, the server also sets a new session cookie
+with every response and varies on it, as such sites often do.
+
+Each scenario fetches every page twice, once cold and once warm, through
+a session from :func:`tendril.utils.www.req.get_session`, and reports the
+throughput and the mean time per request, broken down into :
+
+- ``cache``  : time spent in the cache backend's ``get`` and ``set``
+- ``serial`` : time spent (de)serializing responses for the cache
+- ``parse``  : time spent parsing the soup
+- ``net``    : the remainder, which is the network and :mod:`requests`
+               overhead
+
+The ``nocache`` scenario uses a plain :class:`requests.Session` instead.
+
+Usage::
+
+    python benchmarks/bench_get_soup_requests.py [--pages N] [--rows R]
+        [--variants V] [--latency MS] [--vary-cookie] [--json FILE]
+
+"""
+
+
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from uuid import uuid4
+from collections import defaultdict
+from six.moves.urllib.parse import urlparse, parse_qs
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.BaseHTTPServer import HTTPServer
+
+import requests
+from cachecontrol.caches import FileCache
+from cachecontrol.heuristics import ExpiresAfter
+
+from tendril.utils.www import req
+from tendril.utils.www.reqcache import SQLiteCache
+from tendril.utils.www.reqcache import MemoryFrontedCache
+
+
+_ROW = (u'<tr class="part"><td><a href="/product-detail/{0}">{0}</a></td>'
+        u'<td>{1}</td><td>Cap Ceramic {2}pF 50V C0G 0402</td>'
+        u'<td class="qty">{3}</td><td class="price">{4:.4f}</td>'
+        u'<td>Cut Tape</td><td>0402 (1005 Metric)</td>'
+        u'<td>-55C ~ 125C</td><td>Active</td></tr>\n')
+
+
+def _render_page(query, rows):
+    seed = '&'.join(sorted('{0}={1}'.format(k, v[0])
+                           for k, v in query.items()
+                           if k != 'variant'))
+    rnd = random.Random(seed)
+    parts = [_ROW.format('CL05C{0:06d}'.format(rnd.randrange(10 ** 6)),
+                         rnd.choice(['Samsung', 'Murata', 'TDK', 'Yageo']),
+                         rnd.randrange(1, 1000),
+                         rnd.randrange(10 ** 6),
+                         rnd.random())
+             for _ in range(rows)]
+    return (u'<!DOCTYPE html><html><head><title>Search</title></head>'
+            u'<body><table id="productTable"><thead><tr><th>Part</th>'
+            u'<th>Mfr</th><th>Description</th><th>Qty</th><th>Price</th>'
+            u'<th>Package</th><th>Case</th><th>Temp</th><th>Status</th>'
+            u'</tr></thead><tbody>\n{0}</tbody></table></body></html>'
+            u''.format(u''.join(parts))).encode('utf-8')
+
+
+class _SearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    rows = 500
+    latency = 0.0
+    vary_cookie = False
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        body = _render_page(parse_qs(urlparse(self.path).query), self.rows)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.vary_cookie:
+            self.send_header('Set-Cookie',
+                             'session={0}; Path=/'.format(uuid4().hex))
+            self.send_header('Vary', 'Accept-Encoding, Cookie')
+        else:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Timings(object):
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.hits = 0
+
+    def wrap(self, obj, name, category):
+        func = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[category] += time.perf_counter() - start
+
+        setattr(obj, name, timed)
+
+    def count_hits(self, serializer):
+        loads = serializer.loads
+
+        def counted(*args, **kwargs):
+            response = loads(*args, **kwargs)
+            if response is not None:
+                self.hits += 1
+            return response
+
+        serializer.loads = counted
+
+
+def _get_session(cache, timings):
+    if cache is None:
+        return requests.Session()
+    # get_session always uses the module's cache, so it is swapped out
+    # for the one being benchmarked.
+    req.requests_cache = cache
+    for name in ('get', 'set', 'delete'):
+        timings.wrap(cache, name, 'cache')
+    session = req.get_session(heuristic=ExpiresAfter(seconds=3600))
+    serializer = session.get_adapter('http://').controller.serializer
+    timings.wrap(serializer, 'dumps', 'serial')
+    timings.wrap(serializer, 'loads', 'serial')
+    timings.count_hits(serializer)
+    return session
+
+
+def _scenarios(root, memory_entries):
+    yield 'nocache', lambda: None
+    yield 'file', lambda: FileCache(os.path.join(root, 'file'))
+    yield 'sqlite', lambda: SQLiteCache(os.path.join(root, 'sqlite.db'))
+    yield 'sqlite+memory', lambda: MemoryFrontedCache(
+        SQLiteCache(os.path.join(root, 'fronted.db')), memory_entries)
+
+
+def _run_pass(urls, session, timings):
+    timings.times.clear()
+    timings.hits = 0
+    start = time.perf_counter()
+    for url in urls:
+        req.get_soup_requests(url, session)
+    total = time.perf_counter() - start
+    times = dict(timings.times)
+    times['net'] = total - sum(times.values())
+    return {
+        'requests': len(urls),
+        'hits': timings.hits,
+        'total': total,
+        'throughput': len(urls) / total,
+        'per_request_ms': dict((k, v * 1000 / len(urls))
+                               for k, v in times.items()),
+    }
+
+
+def run(pages, rows, variants, latency, vary_cookie, memory_entries):
+    _SearchHandler.rows = rows
+    _SearchHandler.latency = latency / 1000.0
+    _SearchHandler.vary_cookie = vary_cookie
+    server = _Server(('127.0.0.1', 0), _SearchHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{0}/products/en/capacitors/ceramic'.format(
+        server.server_port)
+    urls = ['{0}?v=1{1}&pageSize={2}&page={3}&variant={4}'.format(
+            base, page % 7, rows, page, variant)
+            for page in range(pages) for variant in range(variants)]
+
+    # Parsing is timed by wrapping the parser used by get_soup_requests.
+    timings = _Timings()
+    parser = req.BeautifulSoup
+    timings.wrap(req, 'BeautifulSoup', 'parse')
+
+    root = tempfile.mkdtemp()
+    original_cache = req.requests_cache
+    results = []
+    try:
+        for name, factory in _scenarios(root, memory_entries):
+            session = _get_session(factory(), timings)
+            for phase in ('cold', 'warm'):
+                result = _run_pass(urls, session, timings)
+                result.update({'scenario': name, 'phase': phase})
+                results.append(result)
+            session.close()
+    finally:
+        req.requests_cache = original_cache
+        req.BeautifulSoup = parser
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
+    return results
+
+
+def report(results):
+    columns = ('net', 'cache', 'serial', 'parse')
+    print("{0:<16}{1:<6}{2:>7}{3:>9}".format(
+        'scenario', 'phase', 'hits', 'req/s') +
+        ''.join('{0:>10}'.format(c + '/ms') for c in columns))
+    for r in results:
+        print("{0:<16}{1:<6}{2:>7}{3:>9.1f}".format(
+            r['scenario'], r['phase'], r['hits'], r['throughput']) +
+            ''.join('{0:>10.2f}'.format(r['per_request_ms'].get(c, 0))
+                    for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--pages', type=int, default=20,
+                        help='number of distinct search pages')
+    parser.add_argument('--rows', type=int, default=500,
+                        help='number of table rows in each page')
+    parser.add_argument('--variants', type=int, default=3,
+                        help='query-string variants of each page')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='server latency per request, in ms')
+    parser.add_argument('--vary-cookie', action='store_true',
+                        help='set a new cookie in every response and '
+                             'vary on it')
+    parser.add_argument('--memory-entries', type=int, default=1000,
+                        help='size of the memory front of sqlite+memory')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON')
+    args = parser.parse_args()
+    results = run(args.pages, args.rows, args.variants, args.latency,
+                  args.vary_cookie, args.memory_entries)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the cachecontrol cache backends used by
+:mod:`tendril.utils.www.req`.
+
+Each backend is populated with ``--entries`` responses of ``--size``
+bytes, and the time taken per operation is measured for :
+
+- ``hit``  : ``get`` of a key present in the cache
+- ``miss`` : ``get`` of a key absent from the cache, followed by the
+             ``set`` which a miss results in.
+
+Usage::
+
+    python benchmarks/bench_requests_cache.py [--entries N] [--size B]
+
+"""
+
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from cachecontrol.caches import FileCache
+from tendril.utils.www.reqcache import SQLiteCache
+from tendril.utils.www.reqcache import MemoryFrontedCache
+
+
+def _backends(root):
+    yield 'file', FileCache(os.path.join(root, 'file'))
+    yield 'sqlite', SQLiteCache(os.path.join(root, 'sqlite.db'))
+    yield 'sqlite+memory', MemoryFrontedCache(
+        SQLiteCache(os.path.join(root, 'fronted.db')), max_entries=1000)
+
+
+def _timed(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def run(entries, size, lookups):
+    payload = os.urandom(size)
+    keys = ['https://www.example.com/search?part={0}'.format(i)
+            for i in range(entries)]
+    root = tempfile.mkdtemp()
+    try:
+        print("{0:<16}{1:>14}{2:>14}".format('backend', 'hit (us)',
+                                             'miss (us)'))
+        for name, cache in _backends(root):
+            for key in keys:
+                cache.set(key, payload, expires=3600)
+            hits = [random.choice(keys) for _ in range(lookups)]
+            misses = ['{0}&miss={1}'.format(random.choice(keys), i)
+                      for i in range(lookups)]
+
+            def miss(key):
+                if cache.get(key) is None:
+                    cache.set(key, payload, expires=3600)
+
+            t_hit = _timed(cache.get, hits)
+            t_miss = _timed(miss, misses)
+            cache.close()
+            print("{0:<16}{1:>14.1f}{2:>14.1f}".format(
+                name, t_hit * 1e6, t_miss * 1e6))
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--entries', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+    run(args.entries, args.size, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
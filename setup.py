@@ -97,6 +97,7 @@ setup(
     install_requires=install_requires,
     setup_requires=setup_requires,
     extras_require={
+        'http2': ['httpx[http2]'],
         'docs': doc_requires,
         'tests': test_requires,
         'build': build_requires,
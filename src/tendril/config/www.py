@@ -15,11 +15,137 @@ config_elements_network_caching = [
         "This probably works just fine, but treat it as a largely "
         "deprecated feature."
     ),
+    ConfigOption(
+        'REDIRECT_CACHE_TTL',
+        "None",
+        "Number of seconds after which a cached redirect expires. "
+        "None for redirects to never expire."
+    ),
     ConfigOption(
         'MAX_AGE_DEFAULT',
         '600000',
         'Default max_age for data originating from www.'
     ),
+    ConfigOption(
+        'DNS_CACHE_TTL',
+        "60",
+        "Maximum number of seconds for which the addresses of hosts "
+        "resolved by the www backends are cached. Shorter TTLs reported "
+        "by the resolver are honoured. 0 to disable the DNS cache."
+    ),
+    ConfigOption(
+        'DNS_CACHE_NEGATIVE_TTL',
+        "10",
+        "Number of seconds for which the failure to resolve a host which "
+        "does not exist is cached. 0 to not cache such failures."
+    ),
+    ConfigOption(
+        'DNS_CACHE_MAX_ENTRIES',
+        "1024",
+        "Maximum number of resolved hosts kept in the DNS cache."
+    ),
+]
+
+
+config_elements_requests = [
+    ConfigOption(
+        'REQUESTS_CACHE_BACKEND',
+        "'file'",
+        "The cache backend used by the requests based www backend. "
+        "'file' for the cachecontrol FileCache, 'sqlite' for a SQLite "
+        "database."
+    ),
+    ConfigOption(
+        'REQUESTS_CACHE_MEMORY_ENTRIES',
+        "0",
+        "Number of recently used responses of the requests based www "
+        "backend to also keep in memory. 0 to disable."
+    ),
+    ConfigOption(
+        'REQUESTS_CACHE_REVALIDATE',
+        "True",
+        "Whether responses cached by the requests based www backend are "
+        "kept past their expiry if they have an ETag, and revalidated "
+        "with a conditional request instead of being refetched."
+    ),
+    ConfigOption(
+        'REQUESTS_CACHE_POLICIES',
+        "{}",
+        "Caching policies for specific sites used by the requests based "
+        "www backend, as a dict mapping url prefixes to dicts of "
+        "tendril.utils.www.cachepolicy.CachePolicy parameters, e.g. "
+        "{'https://www.example.com/pricing/': {'ttl': 600}}."
+    ),
+    ConfigOption(
+        'REQUESTS_POOL_CONNECTIONS',
+        "10",
+        "Number of per-host connection pools kept by each requests "
+        "session adapter."
+    ),
+    ConfigOption(
+        'REQUESTS_POOL_MAXSIZE',
+        "10",
+        "Maximum number of connections kept in each per-host connection "
+        "pool of requests session adapters."
+    ),
+    ConfigOption(
+        'REQUESTS_SESSION_IDLE_TIMEOUT',
+        "300",
+        "Number of seconds after which unused shared requests sessions "
+        "are closed."
+    ),
+    ConfigOption(
+        'REQUESTS_BATCH_WORKERS',
+        "8",
+        "Default number of concurrent requests made by batched fetches "
+        "using the requests based www backend."
+    ),
+    ConfigOption(
+        'REQUESTS_BATCH_MAX_PER_HOST',
+        "4",
+        "Default maximum number of concurrent requests to a single host "
+        "made by batched fetches using the requests based www backend. "
+        "This should not exceed REQUESTS_POOL_MAXSIZE."
+    ),
+]
+
+
+config_elements_resilience = [
+    ConfigOption(
+        'WWW_RETRY_COUNT',
+        "3",
+        "Maximum number of times a request which failed with a transient "
+        "error is retried by the www backends."
+    ),
+    ConfigOption(
+        'WWW_RETRY_BACKOFF',
+        "0.5",
+        "Base delay in seconds for the jittered exponential backoff "
+        "between retries."
+    ),
+    ConfigOption(
+        'WWW_RETRY_BACKOFF_MAX',
+        "60",
+        "Maximum delay in seconds between retries, including delays "
+        "requested by the server using Retry-After."
+    ),
+    ConfigOption(
+        'WWW_RETRY_STATUSES',
+        "[429, 500, 502, 503, 504]",
+        "HTTP status codes which are considered transient and retried."
+    ),
+    ConfigOption(
+        'WWW_CIRCUIT_BREAKER_THRESHOLD',
+        "5",
+        "Number of consecutive failed requests to a host after which "
+        "further requests to it fail fast."
+    ),
+    ConfigOption(
+        'WWW_CIRCUIT_BREAKER_RESET',
+        "60",
+        "Number of seconds after which a host whose requests are failing "
+        "fast is tried again."
+    ),
 ]
 
 
@@ -53,6 +179,119 @@ config_elements_proxy = [
 ]
 
 
+config_elements_httpx = [
+    ConfigOption(
+        'HTTPX_SHARE_CLIENTS',
+        "False",
+        "Whether httpx clients obtained from async_client and sync_client "
+        "are, by default, drawn from a registry of long-lived shared "
+        "clients, instead of being created and closed for each use. Shared "
+        "clients share their cookie jars and any changes made to them."
+    ),
+    ConfigOption(
+        'HTTPX_MAX_CONNECTIONS',
+        "100",
+        "Maximum number of concurrent connections of each httpx client."
+    ),
+    ConfigOption(
+        'HTTPX_MAX_KEEPALIVE_CONNECTIONS',
+        "20",
+        "Maximum number of idle keep-alive connections kept by each httpx "
+        "client."
+    ),
+    ConfigOption(
+        'HTTPX_KEEPALIVE_EXPIRY',
+        "5.0",
+        "Number of seconds after which idle keep-alive connections of "
+        "httpx clients are closed."
+    ),
+    ConfigOption(
+        'HTTPX_CLIENT_IDLE_TIMEOUT',
+        "300",
+        "Number of seconds after which unused shared httpx clients are "
+        "closed."
+    ),
+    ConfigOption(
+        'HTTPX_BATCH_CONCURRENCY',
+        "50",
+        "Default number of concurrent requests made by batched fetches "
+        "using the httpx based www backend."
+    ),
+    ConfigOption(
+        'HTTPX_BATCH_MAX_PER_HOST',
+        "10",
+        "Default maximum number of concurrent requests to a single host "
+        "made by batched fetches using the httpx based www backend. This "
+        "should not exceed HTTPX_MAX_CONNECTIONS."
+    ),
+    ConfigOption(
+        'HTTPX_RATE_LIMITS',
+        "{}",
+        "Rate limits applied to requests made using the httpx based www "
+        "backend, as a dictionary of per-host parameters of "
+        "AsyncRateLimiter (rate, burst, quotas). See "
+        "tendril.utils.www.ratelimit."
+    ),
+    ConfigOption(
+        'HTTPX_RETRY',
+        "True",
+        "Whether httpx clients retry requests which fail with transient "
+        "errors, as per the WWW_RETRY options."
+    ),
+    ConfigOption(
+        'HTTPX_HEDGING',
+        "False",
+        "Whether httpx clients hedge idempotent requests by default, "
+        "sending a duplicate request if a response is slower than usual "
+        "and using the first response to arrive."
+    ),
+    ConfigOption(
+        'HTTPX_HEDGE_QUANTILE',
+        "0.95",
+        "Quantile of recent response times from a host after which "
+        "requests to it are hedged."
+    ),
+    ConfigOption(
+        'HTTPX_HEDGE_MIN_SAMPLES',
+        "20",
+        "Minimum number of responses from a host needed before requests "
+        "to it are hedged."
+    ),
+    ConfigOption(
+        'HTTPX_HTTP2',
+        "False",
+        "Whether httpx clients offer HTTP/2 by default, so that concurrent "
+        "requests to a host are multiplexed over a single connection. "
+        "This requires the h2 package (pip install httpx[http2]). Clients "
+        "fall back to HTTP/1.1 if it is not installed."
+    ),
+    ConfigOption(
+        'HTTPX_CACHE_BACKEND',
+        "None",
+        "The response cache used by httpx clients by default. None to "
+        "disable caching, 'memory' for an in-memory cache or 'disk' for a "
+        "SQLite database in the instance cache."
+    ),
+    ConfigOption(
+        'HTTPX_CACHE_MEMORY_ENTRIES',
+        "1000",
+        "Maximum number of responses kept by the in-memory httpx cache."
+    ),
+    ConfigOption(
+        'HTTPX_CACHE_MAX_BODY_SIZE',
+        "10485760",
+        "Size in bytes of the largest response body stored by the httpx "
+        "cache."
+    ),
+    ConfigOption(
+        'HTTPX_CACHE_BYPASS',
+        "[]",
+        "List of url prefixes which are never cached by the httpx cache, "
+        "such as those of internal APIs."
+    ),
+]
+
+
 config_elements_ssl = [
     ConfigOption(
         'CA_BUNDLE',
@@ -74,6 +313,13 @@ def load(manager):
     logger.debug("Loading {0}".format(__name__))
     manager.load_elements(config_elements_network_caching,
                           doc="Network Caching Behavior Configuration")
+    manager.load_elements(config_elements_requests,
+                          doc="Requests Backend Configuration")
+    manager.load_elements(
+        config_elements_resilience,
+        doc="Network Retry and Circuit Breaker Configuration")
+    manager.load_elements(config_elements_httpx,
+                          doc="httpx Backend Configuration")
     manager.load_elements(config_elements_proxy,
                           doc="Network Proxy Configuration")
     manager.load_elements(config_elements_ssl,
@@ -42,7 +42,24 @@ resources :
 .. autosummary::
 
     get_soup_requests
+    get_soups_requests
     get_session
+    get_shared_session
+
+.. rubric:: Streaming downloads (:mod:`tendril.utils.www.downloads`)
+
+.. autosummary::
+
+    download
+    async_download
+
+.. rubric:: httpx based access (:mod:`tendril.utils.www.hx`)
+
+.. autosummary::
+
+    async_client
+    fetch_many
+    sync_client
 
 .. rubric:: suds based SOAP access (:mod:`tendril.utils.www.soap`)
 
@@ -60,25 +77,60 @@ built-in to speed up access to internet based resources.
 
 Redirect caching speeds up network accesses by saving ``301`` and ``302``
 redirects, and not needing to get the correct URL on a second access. This
-redirect cache is stored as a pickled object in the ``INSTANCE_CACHE``
-folder. The effect of this caching is far more apparent when a replicator
-cache is also used.
+redirect cache is stored in a SQLite database in the ``INSTANCE_CACHE``
+folder, and is updated as each new redirect is encountered. The effect of
+this caching is far more apparent when a replicator cache is also used.
 
-Redirect caching is only supported by the urllib based backend
-(:mod:`tendril.utils.www.bare`), and is likely going to be phased out
-entirely in the future.
+The redirect cache is shared by all the backends. The urllib based
+backend (:mod:`tendril.utils.www.bare`) uses a redirect handler, the
+requests based backend (:mod:`tendril.utils.www.req`) uses its session
+adapters, and the httpx based backend (:mod:`tendril.utils.www.hx`) uses
+a transport wrapper.
 
 .. rubric:: Full Response Caching
 
 This is a more typical kind of caching, which uses a backend-dependent
 mechanism to maintain a cache of full responses received.
 
+The requests based backend can additionally be configured to cache
+specific sites differently, see :mod:`tendril.utils.www.cachepolicy`.
+
+.. rubric:: DNS Caching
+
+The addresses of the hosts connected to are cached in-process for a short
+while, instead of being resolved again for every new connection. The DNS
+cache is shared by all the backends, see :mod:`tendril.utils.www.dnscache`.
+
+Retries and Circuit Breakers
+----------------------------
+
+The synchronous backends retry requests which fail with transient errors,
+and fail fast for hosts which are consistently failing. See
+:mod:`tendril.utils.www.resilience` for details. The httpx based backend
+retries requests in the same way, and can additionally hedge slow
+requests. See :mod:`tendril.utils.www.hxresilience`.
+
+Requests made using the httpx based backend can be rate limited per host,
+to respect the quotas of vendor APIs. See
+:mod:`tendril.utils.www.ratelimit`.
+
+Tracing
+-------
+
+All the backends can report the phases of the requests they make (DNS
+resolution, connecting, the TLS handshake, the time to the first byte,
+the transfer of the body, cache accesses and parsing) to registered
+tracers, and per-host latency breakdowns can be printed from them. This
+costs nothing while no tracer is registered. See
+:mod:`tendril.utils.www.tracing`.
+
 .. todo::
     Consider replacing uses of urllib/urllib2 backend with
-    :mod:`requests` and simplify this module. Currently, the
-    cache provided with the ``requests`` implementation here
-    is the major bottleneck and seems to cause a major
-    performance hit.
+    :mod:`requests` and simplify this module. The default file
+    based cache provided with the ``requests`` implementation
+    here is the major bottleneck and causes a major performance
+    hit. The SQLite based cache (see
+    :mod:`tendril.utils.www.reqcache`) should be used instead.
 
 """
 
@@ -91,11 +143,19 @@ from .bare import get_soup          # noqa
 
 # Requests based client
 from .req import get_session        # noqa
+from .req import get_shared_session  # noqa
 from .req import get_soup_requests  # noqa
+from .req import get_soups_requests  # noqa
+
+# Streaming downloads
+from .downloads import download     # noqa
+from .downloads import async_download  # noqa
 
 # suds based SOAP client
 from .soap import get_soap_client   # noqa
 
 # httpx based async client
 from .hx import async_client         # noqa
-from .hx import with_async_client_cl # noqa
\ No newline at end of file
+from .hx import with_async_client_cl # noqa
+from .hx import close_async_clients  # noqa
+from .hx import fetch_many           # noqa
\ No newline at end of file
@@ -36,35 +36,55 @@ Overall, caching for this backend looks something like this :
   caching is NOT HTTP1.1 compliant. In case HTTP1.1 compliant
   caching is desired, use the requests based implementation
   instead or use an external http-replicator like caching proxy.
+  The ``ETag`` and ``Last-Modified`` validators of each response
+  are stored alongside it, and expired entries are revalidated
+  using a conditional request before being downloaded again.
 
-- :class:`RedirectCacheHandler` is something of a special case,
+- Compressed transfers are negotiated by the opener, and responses
+  are decoded by :func:`urlopen` before they reach the cache. The
+  cache therefore always holds the decoded content, regardless of
+  the ``Content-Encoding`` used on the wire.
+
+- :class:`CachingRedirectHandler` is something of a special case,
   handling redirects which otherwise would be incredibly expensive.
-  Unfortunately, this layer is also the dumbest cacher, and does
-  not expire anything. Ever. To 'invalidate' something in this cache,
-  the entire cache needs to be nuked. It may be worthwhile to consider
-  moving this to redis instead.
+  Learned redirects are stored persistently as they are encountered,
+  may be given a TTL, and can be invalidated individually. See
+  :mod:`tendril.utils.www.redirectcache`.
 
 """
 
 import six
 import time
+import errno
+import socket
 from hashlib import md5
+from six.moves.http_client import HTTPConnection, HTTPSConnection
 from bs4 import BeautifulSoup
+from six.moves.urllib.request import Request
 from six.moves.urllib.request import ProxyHandler
 from six.moves.urllib.request import HTTPHandler, HTTPSHandler
 from six.moves.urllib.request import build_opener
 from six.moves.urllib.error import HTTPError, URLError
 
 from tendril.config import NETWORK_PROXY_TYPE
-from tendril.config import ENABLE_REDIRECT_CACHING
 from tendril.config import MAX_AGE_DEFAULT
 
 from .helpers import get_http_proxy_url
 from .redirectcache import CachingRedirectHandler
 from .redirectcache import get_actual_url
-from .redirectcache import redirect_cache
+from .redirectcache import record_redirect
+from .redirectcache import is_same_origin
+from .redirectcache import CREDENTIAL_HEADERS
+from .redirectcache import PERMANENT_REDIRECT_STATUSES
+from .compression import DecompressingHandler
+from .resilience import call
+from .resilience import default_policy
+from .resilience import parse_retry_after
 from .caching import CacheBase
 from .caching import WWW_CACHE
+from .tracing import span
+from .tracing import TracedConnectionMixin
+from .dnscache import CachedResolutionMixin
 from .status import set_connected
 from .status import set_disconnected
 
@@ -84,12 +104,57 @@ def _test_opener(openr):
         return False
 
 
+class _HTTPConnection(TracedConnectionMixin, CachedResolutionMixin,
+                      HTTPConnection):
+    tracing_backend = 'bare'
+
+
+class _HTTPSConnection(TracedConnectionMixin, CachedResolutionMixin,
+                       HTTPSConnection):
+    tracing_backend = 'bare'
+
+
+_connection_classes = {
+    HTTPConnection: _HTTPConnection,
+    HTTPSConnection: _HTTPSConnection,
+}
+
+
+class TracingHTTPHandler(HTTPHandler):
+    """
+    A :class:`urllib.request.HTTPHandler` whose connections report the
+    phases of requests when tracing is enabled (see
+    :mod:`tendril.utils.www.tracing`), and resolve hosts using the shared
+    DNS cache (see :mod:`tendril.utils.www.dnscache`).
+    """
+    def do_open(self, http_class, req, **http_conn_args):
+        http_class = _connection_classes.get(http_class, http_class)
+        return super(TracingHTTPHandler, self).do_open(
+            http_class, req, **http_conn_args)
+
+
+class TracingHTTPSHandler(HTTPSHandler):
+    """
+    A :class:`urllib.request.HTTPSHandler` whose connections report the
+    phases of requests when tracing is enabled (see
+    :mod:`tendril.utils.www.tracing`), and resolve hosts using the shared
+    DNS cache (see :mod:`tendril.utils.www.dnscache`).
+    """
+    def do_open(self, http_class, req, **http_conn_args):
+        http_class = _connection_classes.get(http_class, http_class)
+        return super(TracingHTTPSHandler, self).do_open(
+            http_class, req, **http_conn_args)
+
+
 def _create_opener():
     """
     Creates an opener for the internet.
 
-    It also attaches the :class:`CachingRedirectHandler` to the opener and
-    sets its User-agent to ``Mozilla/5.0``.
+    It also attaches the :class:`CachingRedirectHandler` and the
+    :class:`tendril.utils.www.compression.DecompressingHandler` to the
+    opener and sets its User-agent to ``Mozilla/5.0``. Its HTTP and
+    HTTPS handlers report the phases of requests when tracing is enabled,
+    and resolve hosts using the shared DNS cache.
 
     If the Network Proxy settings are set and recognized, it creates the
     opener and attaches the proxy_handler to it. The opener is tested and
@@ -107,11 +172,12 @@ def _create_opener():
         proxy_handler = ProxyHandler({'http': proxyurl,
                                       'https': proxyurl})
     if use_proxy:
-        openr = build_opener(HTTPHandler(), HTTPSHandler(),
-                             proxy_handler, CachingRedirectHandler)
+        openr = build_opener(TracingHTTPHandler(), TracingHTTPSHandler(),
+                             proxy_handler, CachingRedirectHandler,
+                             DecompressingHandler)
     else:
-        openr = build_opener(HTTPSHandler(), HTTPSHandler(),
-                             CachingRedirectHandler)
+        openr = build_opener(TracingHTTPHandler(), TracingHTTPSHandler(),
+                             CachingRedirectHandler, DecompressingHandler)
     openr.addheaders = [('User-agent', 'Mozilla/5.0')]
     if _test_opener(openr):
         set_connected()
@@ -123,26 +189,83 @@ def _create_opener():
 opener = _create_opener()
 
 
-def urlopen(url):
+#: Error numbers of socket errors which are transient.
+TRANSIENT_ERRNOS = (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN)
+
+
+def _is_transient(e):
+    """
+    Whether the socket level error ``e`` is transient. Timeouts, failed
+    or dropped connections, unreachable networks and temporary name
+    resolution failures are. Other errors, such as unknown hosts or
+    certificate failures, are not.
+    """
+    if isinstance(e, socket.gaierror):
+        return e.errno == socket.EAI_AGAIN
+    if isinstance(e, (socket.timeout, ConnectionError)):
+        return True
+    return isinstance(e, OSError) and e.errno in TRANSIENT_ERRNOS
+
+
+def _classify_error(e):
+    """
+    Classify an exception raised by the opener for
+    :func:`tendril.utils.www.resilience.call`.
+    """
+    if isinstance(e, HTTPError):
+        if e.code in default_policy.statuses:
+            return True, parse_retry_after(e.headers.get('Retry-After'))
+        return False, None
+    if isinstance(e, URLError):
+        return _is_transient(e.reason), None
+    return _is_transient(e), None
+
+
+def _open(url, headers=None):
+    if headers:
+        return opener.open(Request(url, headers=headers))
+    return opener.open(url)
+
+
+def urlopen(url, headers=None):
     """
     Opens a url specified by the ``url`` parameter.
 
-    This function handles redirect caching, if enabled.
+    This function handles redirect caching, if enabled. Responses sent
+    with a supported ``Content-Encoding`` are transparently decoded.
+
+    Transient failures are retried, and requests to hosts which are
+    consistently failing fail fast with a
+    :class:`tendril.utils.www.resilience.CircuitOpenError`. See
+    :mod:`tendril.utils.www.resilience`.
+
+    The request is reported as a ``request`` span if tracing is enabled,
+    see :mod:`tendril.utils.www.tracing`.
+
+    :param url: url of the resource to open.
+    :param headers: (optional) dict of additional request headers.
+
     """
     # warnings.warn("urlopen() is a part of the urllib2 based www "
     #               "implementation and is deprecated.", DeprecationWarning)
-    url = get_actual_url(url)
+    actual_url = get_actual_url(url)
+    if headers and not is_same_origin(url, actual_url):
+        headers = {k: v for k, v in headers.items()
+                   if k.lower() not in CREDENTIAL_HEADERS}
+    url = actual_url
     try:
-        page = opener.open(url)
+        with span('request', url=url, backend='bare'):
+            page = call(url, lambda: _open(url, headers), _classify_error)
         try:
-            if ENABLE_REDIRECT_CACHING is True and page.status == 301:
-                logger.debug('Detected New Permanent Redirect:\n' +
-                             url + '\n' + page.url)
-                redirect_cache[url] = page.url
+            if page.status in PERMANENT_REDIRECT_STATUSES:
+                record_redirect(url, page.url)
         except AttributeError:
             pass
         return page
     except HTTPError as e:
+        if e.code == 304:
+            # Expected response to a conditional request.
+            raise
         logger.error("HTTP Error : {0} {1}".format(e.code, url))
         raise
     except URLError as e:
@@ -150,10 +273,74 @@ def urlopen(url):
         raise
 
 
+#: Response headers retained in the cache metadata of
+#: :class:`WWWCachedFetcher` entries.
+RECORDED_HEADERS = ('Content-Type', 'Content-Language',
+                    'ETag', 'Last-Modified')
+
+
+def _get_record(page):
+    """
+    Construct the compact metadata record stored alongside each
+    :class:`WWWCachedFetcher` cache entry from the response ``page``
+    returned by :func:`urlopen`.
+    """
+    headers = {}
+    for name in RECORDED_HEADERS:
+        value = page.headers.get(name)
+        if value:
+            headers[name] = value
+    return {
+        'status': getattr(page, 'final_status', page.status),
+        'url': page.url,
+        'encoding': page.headers.get_content_charset(),
+        'headers': headers,
+        'fetched_at': time.time(),
+    }
+
+
+class CachedResponse(object):
+    def __init__(self, content, record):
+        """
+        A minimal response-like object returned by
+        :func:`WWWCachedFetcher.fetch_response`, combining the cached
+        content with the metadata recorded when it was fetched.
+
+        :param content: the (cached) body of the response.
+        :param record: the metadata record of the cache entry.
+
+        """
+        self.content = content
+        self.status = record.get('status')
+        self.url = record.get('url')
+        self.encoding = record.get('encoding')
+        self.headers = record.get('headers', {})
+        self.fetched_at = record.get('fetched_at')
+
+    @property
+    def status_code(self):
+        return self.status
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def __repr__(self):
+        return '<CachedResponse [{0}] {1}>'.format(self.status, self.url)
+
+
 class WWWCachedFetcher(CacheBase):
     """
     Subclass of :class:`CacheBase` to handle catching of url ``fetch``
     responses.
+
+    A compact record of each response (status, selected headers, final
+    url, encoding and the time it was fetched) is stored in a metadata
+    file alongside the cached content, and is made available by
+    :func:`fetch_response`. When a cached response expires, it is
+    revalidated with a conditional request using the stored validators,
+    and the existing copy is reused if the server responds with
+    ``304 Not Modified``.
     """
     def _get_filepath(self, url):
         """
@@ -171,6 +358,9 @@ class WWWCachedFetcher(CacheBase):
             filepath = md5(url).hexdigest()
         return filepath
 
+    def _get_trace_attributes(self, url):
+        return {'url': url}
+
     def _get_fresh_content(self, url):
         """
         Retrieve a fresh copy of the resource from the source.
@@ -180,8 +370,59 @@ class WWWCachedFetcher(CacheBase):
 
         """
         logger.debug('Getting url content : {0}'.format(url))
+        return self._fetch(url)
+
+    def _fetch(self, url, headers=None):
+        """
+        Retrieve the resource from the source, storing the record of
+        the response in the cache metadata.
+
+        :param url: url of the resource
+        :param headers: (optional) additional request headers
+        :return: contents of the resource
+
+        """
         time.sleep(1)
-        return urlopen(url).read()
+        page = urlopen(url, headers=headers)
+        with span('transfer', url=url, backend='bare'):
+            content = page.read()
+        self._write_metadata(self._get_filepath(url), _get_record(page))
+        return content
+
+    def _revalidate(self, filepath, url):
+        """
+        Revalidate a stale cached copy of the resource using a conditional
+        request built from the stored validators.
+
+        :param filepath: path to the stale file in the cache
+        :param url: url of the resource
+        :return: ``(True, None)`` if the resource was not modified,
+                 ``(False, content)`` if it was, and ``(False, None)``
+                 if the cached copy has no validators.
+
+        """
+        record = self._read_metadata(filepath)
+        if not record:
+            return False, None
+        rheaders = record.get('headers', {})
+        headers = {}
+        if 'ETag' in rheaders:
+            headers['If-None-Match'] = rheaders['ETag']
+        if 'Last-Modified' in rheaders:
+            headers['If-Modified-Since'] = rheaders['Last-Modified']
+        if not headers:
+            return False, None
+        logger.debug('Revalidating url content : {0}'.format(url))
+        try:
+            return False, self._fetch(url, headers=headers)
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            for name in RECORDED_HEADERS:
+                if e.headers.get(name):
+                    rheaders[name] = e.headers.get(name)
+        self._write_metadata(filepath, record)
+        return True, None
 
     def fetch(self, url, max_age=MAX_AGE_DEFAULT, getcpath=False):
         """
@@ -202,6 +443,29 @@ class WWWCachedFetcher(CacheBase):
         # )
         return self._accessor(max_age, getcpath, url)
 
+    def fetch_response(self, url, max_age=MAX_AGE_DEFAULT):
+        """
+        Return a :class:`CachedResponse` for the ``url`` provided, which
+        includes the status, selected headers, final url and encoding of
+        the response along with its content. Caching behaves exactly as
+        in :func:`fetch`.
+
+        Cache entries created before the metadata was recorded are
+        returned with only the ``url`` populated.
+
+        :param url: url of the resource to retrieve.
+        :param max_age: maximum age in seconds.
+        :rtype: :class:`CachedResponse`
+
+        """
+        content = self._accessor(max_age, False, url)
+        if content is None:
+            return None
+        record = self._read_metadata(self._get_filepath(url))
+        if record is None:
+            record = {'url': url}
+        return CachedResponse(content, record)
+
 
 #: The module's :class:`WWWCachedFetcher` instance which should be
 #: used whenever cached results are desired. The cache is stored in
@@ -216,9 +480,14 @@ def get_soup(url):
     This function returns a soup constructed of the cached page if one
     exists and is valid, or obtains one and dumps it into the cache if it
     doesn't.
+
+    If the charset of the page was declared by the server, it is passed
+    on to the parser to avoid encoding detection.
     """
-    page = cached_fetcher.fetch(url)
+    page = cached_fetcher.fetch_response(url)
     if page is None:
         return None
-    soup = BeautifulSoup(page, 'lxml')
+    with span('parse', url=url, backend='bare'):
+        soup = BeautifulSoup(page.content, 'lxml',
+                             from_encoding=page.encoding)
     return soup
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-site Caching Policies (:mod:`tendril.utils.www.cachepolicy`)
+================================================================
+
+Different sites warrant different caching. Pricing and stock information
+changes frequently, while datasheets hardly ever do. This module provides
+a registry of :class:`CachePolicy` instances keyed by url prefix, which
+:func:`tendril.utils.www.req.get_session` mounts on every session it
+creates, so that each site is cached appropriately without the callers
+having to set anything up.
+
+As with :mod:`requests` adapters, the policy with the longest prefix
+matching a url is the one applied to it. Policies are mounted regardless
+of the ``target`` of the session, so ``https://`` policies apply to the
+default (``http://``) sessions as well. Urls not covered by any
+registered policy are cached as per the session's own heuristic.
+
+The registry is populated from :data:`tendril.config.REQUESTS_CACHE_POLICIES`
+when this module is imported, and further policies can be registered
+using :func:`register_cache_policy`. For example, to have the config
+cache pricing for 10 minutes, serving the stale price for up to an hour
+if the site is down, and to cache datasheets for a month regardless of
+what the site says :
+
+.. code-block:: python
+
+    REQUESTS_CACHE_POLICIES = {
+        'https://www.example.com/pricing/': {
+            'ttl': 600, 'stale_grace': 3600,
+        },
+        'https://datasheets.example.com/': {
+            'ttl': 30 * 86400, 'ignore_cache_control': True,
+        },
+    }
+
+"""
+
+
+from datetime import timedelta
+from cachecontrol.heuristics import BaseHeuristic
+from cachecontrol.heuristics import expire_after
+from cachecontrol.heuristics import datetime_to_header
+
+from tendril.config import MAX_AGE_DEFAULT
+from tendril.config import REQUESTS_CACHE_POLICIES
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+#: Response ``Cache-Control`` directives which express the origin's own
+#: caching intent, which is respected unless ``ignore_cache_control`` is
+#: set.
+EXPLICIT_DIRECTIVES = ('max-age', 's-maxage', 'no-cache',
+                       'no-store', 'private')
+
+
+class PolicyHeuristic(BaseHeuristic):
+    def __init__(self, ttl, ignore_cache_control=False):
+        """
+        A :mod:`cachecontrol` heuristic which makes responses fresh for
+        ``ttl`` seconds.
+
+        Unless ``ignore_cache_control`` is set, this is only done for
+        responses which do not specify their own freshness (using
+        ``Cache-Control`` or ``Expires``). Otherwise, it is done for all
+        responses, as is done by :class:`cachecontrol.heuristics.ExpiresAfter`.
+        """
+        self.ttl = ttl
+        self.ignore_cache_control = ignore_cache_control
+
+    def _is_explicit(self, response):
+        if 'expires' in response.headers:
+            return True
+        cc = response.headers.get('cache-control', '').lower()
+        return any(d in cc for d in EXPLICIT_DIRECTIVES)
+
+    def update_headers(self, response):
+        if not self.ignore_cache_control and self._is_explicit(response):
+            return {}
+        expires = expire_after(timedelta(seconds=self.ttl))
+        return {'expires': datetime_to_header(expires),
+                'cache-control': 'public'}
+
+
+class CachePolicy(object):
+    def __init__(self, ttl=None, stale_grace=0, ignore_cache_control=False,
+                 cache_post=False, revalidate=None):
+        """
+        Describes how responses from a site are cached by the requests
+        based backend.
+
+        :param ttl: number of seconds responses which do not specify their
+                    own freshness are considered fresh for. If ``None``,
+                    such responses are not cached, unless
+                    ``ignore_cache_control`` is set, in which case it
+                    defaults to :data:`tendril.config.MAX_AGE_DEFAULT`.
+        :param stale_grace: number of seconds past their expiry for which
+                            cached responses are served if the site fails
+                            (with a connection error, a transient error
+                            status or an open circuit breaker).
+        :param ignore_cache_control: cache all responses for ``ttl``
+                                     seconds, regardless of the caching
+                                     headers sent by the site.
+        :param cache_post: also cache responses to ``POST`` requests,
+                           keyed by the url and the request body.
+        :param revalidate: whether expired responses are revalidated
+                           rather than refetched. See
+                           :func:`tendril.utils.www.req.get_session`.
+
+        """
+        if ignore_cache_control and ttl is None:
+            ttl = MAX_AGE_DEFAULT
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.ignore_cache_control = ignore_cache_control
+        self.cache_post = cache_post
+        self.revalidate = revalidate
+
+    @property
+    def heuristic(self):
+        """
+        The :class:`PolicyHeuristic` implementing the policy, or ``None``
+        if the site's caching headers are to be used as is.
+        """
+        if self.ttl is None:
+            return None
+        return PolicyHeuristic(self.ttl, self.ignore_cache_control)
+
+    @property
+    def cacheable_methods(self):
+        if self.cache_post:
+            return 'GET', 'POST'
+        return 'GET',
+
+    def __repr__(self):
+        return "<CachePolicy ttl={0} stale_grace={1}{2}{3}>".format(
+            self.ttl, self.stale_grace,
+            ' ignore_cache_control' if self.ignore_cache_control else '',
+            ' cache_post' if self.cache_post else '')
+
+
+#: The registry of :class:`CachePolicy` instances, keyed by url prefix.
+cache_policies = {}
+
+
+def register_cache_policy(prefix, policy):
+    """
+    Register the :class:`CachePolicy` ``policy`` for urls starting with
+    ``prefix``, replacing any policy previously registered for it. This
+    only affects sessions created after it is registered.
+    """
+    cache_policies[prefix] = policy
+
+
+def get_cache_policies(target=''):
+    """
+    Return a list of ``(prefix, policy)`` tuples of the registered
+    policies whose prefixes fall within the ``target`` prefix.
+    """
+    return [(prefix, policy) for prefix, policy in cache_policies.items()
+            if prefix.startswith(target)]
+
+
+def _load_cache_policies():
+    for prefix, params in REQUESTS_CACHE_POLICIES.items():
+        try:
+            register_cache_policy(prefix, CachePolicy(**params))
+        except TypeError as e:
+            logger.warning("Ignoring invalid cache policy for {0} : "
+                           "{1}".format(prefix, e))
+
+
+_load_cache_policies()
@@ -28,17 +28,22 @@ TODO Some introduction
 
 
 import os
+import json
 import time
 import codecs
-import tempfile
+import sqlite3
+import threading
+from uuid import uuid4
 
 from fs import open_fs
-from fs.copy import copy_file
+from fs.errors import FSError
 from fs.osfs import OSFS
-from tendril.utils.fsutils import temp_fs
 from tendril.config import INSTANCE_CACHE
 
 from .status import is_connected
+from .resilience import CircuitOpenError
+from .tracing import span
+from .tracing import is_enabled as is_tracing_enabled
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.WARNING)
@@ -46,6 +51,64 @@ logger = log.get_logger(__name__, log.WARNING)
 WWW_CACHE = os.path.join(INSTANCE_CACHE, 'soupcache')
 
 
+class SQLiteStoreBase(object):
+    def __init__(self, path):
+        """
+        This class provides the connection management shared by the
+        SQLite backed stores used by the www backends.
+
+        Each thread (and process) uses its own connection to the database
+        at ``path``, which is opened lazily on first use, in WAL mode, so
+        that multiple threads and processes can share the database.
+        Subclasses create their schema in :func:`_setup`.
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _setup(self, conn):
+        """
+        Given a new connection to the database, create the tables needed
+        by the store if they do not already exist.
+
+        Must be implemented in every subclass.
+        """
+        raise NotImplementedError
+
+    def _connect(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode, this is still safe against application crashes,
+            # and only risks the most recent writes on power loss.
+            conn.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.OperationalError:
+            pass
+        self._setup(conn)
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """
+        Close the calling thread's connection to the database, if any. A
+        new connection is opened if the store is used again.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
 class CacheBase(object):
     def __init__(self, cache_dir=WWW_CACHE):
         """
@@ -118,6 +181,62 @@ class CacheBase(object):
         """
         return filecontent
 
+    def _revalidate(self, filepath, *args, **kwargs):
+        """
+        Given the path to a stale file in the cache and the parameters
+        necessary to obtain the resource in normal circumstances, check with
+        the source whether the cached copy is still valid, typically using a
+        conditional request.
+
+        Returns a tuple ``(valid, data)``. If the cached copy is still valid,
+        ``valid`` is True and the cache entry is marked fresh again. If it
+        is not, ``data`` may contain the fresh response obtained in the
+        process (as would be returned by :func:`_get_fresh_content`), or
+        ``None``, in which case a fresh copy is obtained as usual.
+
+        Unless overridden by the subclass, this function returns
+        ``(False, None)`` and stale content is always refetched in full.
+        """
+        return False, None
+
+    @staticmethod
+    def _get_metapath(filepath):
+        """
+        Return the path of the metadata sidecar file for the cache file
+        at ``filepath``.
+        """
+        return filepath + '.meta'
+
+    def _read_metadata(self, filepath):
+        """
+        Return the metadata dict stored alongside the cache file at
+        ``filepath``, or ``None`` if there is none or it is unreadable.
+        """
+        metapath = self._get_metapath(filepath)
+        if not self.cache_fs.exists(metapath):
+            return None
+        try:
+            return json.loads(self.cache_fs.readtext(metapath))
+        except ValueError:
+            logger.warning("Discarding corrupt cache metadata "
+                           "{0}".format(metapath))
+            self._remove_metadata(filepath)
+            return None
+
+    def _write_metadata(self, filepath, metadata):
+        """
+        Store the ``metadata`` dict alongside the cache file at
+        ``filepath``. The metadata must be JSON serializable.
+        """
+        self.cache_fs.writetext(self._get_metapath(filepath),
+                                json.dumps(metadata))
+
+    def _remove_metadata(self, filepath):
+        try:
+            self.cache_fs.remove(self._get_metapath(filepath))
+        except FSError:
+            pass
+
     def _cached_exists(self, filepath):
         return self.cache_fs.exists(filepath)
 
@@ -134,13 +253,66 @@ class CacheBase(object):
         """
         if self._cached_exists(filepath):
             tn = int(time.time())
-            tc = int(time.mktime(
-                self.cache_fs.getinfo(filepath)['modified_time'].timetuple())
-            )
+            tc = int(self.cache_fs.getinfo(
+                filepath, namespaces=['details']).modified.timestamp())
             if tn - tc < max_age:
                 return True
         return False
 
+    def _read_cached(self, filepath, getcpath=False):
+        """
+        Return the deserialized content of the cache file at ``filepath``,
+        or only its path if ``getcpath`` is True.
+        """
+        if getcpath is not False:
+            return self.cache_fs.getsyspath(filepath)
+        try:
+            filecontent = self.cache_fs.open(filepath, 'rb').read()
+            return self._deserialize(filecontent)
+        except UnicodeDecodeError:
+            # TODO This requires the cache_fs to be a local
+            # filesystem. This may not be very nice. A way
+            # to hook codecs upto to pyfilesystems would be better
+            with codecs.open(
+                    self.cache_fs.getsyspath(filepath),
+                    encoding='utf-8') as f:
+                filecontent = f.read()
+                return self._deserialize(filecontent)
+
+    def _write_cached(self, filepath, data):
+        """
+        Serialize ``data`` and store it in the cache file at ``filepath``.
+        Failures are logged, and do not prevent the data from being used.
+        """
+        sdata = self._serialize(data)
+        logger.debug("Creating new cache entry")
+        # The entry is written to a temporary file in the cache_fs itself
+        # and then moved into place, so that readers never see a partially
+        # written entry.
+        temppath = '{0}.{1}.tmp'.format(filepath, uuid4().hex)
+        try:
+            self.cache_fs.writebytes(temppath, sdata)
+            self.cache_fs.move(temppath, filepath, overwrite=True)
+            if isinstance(self.cache_fs, OSFS):
+                # TODO Refine permissions
+                os.chmod(self.cache_fs.getsyspath(filepath), 0o666)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:  # noqa
+            logger.warning("Unable to write cache file "
+                           "{0}".format(filepath))
+            # Metadata describing content we failed to store must not
+            # be allowed to validate an older cached copy.
+            self._remove_metadata(filepath)
+
+    def _get_trace_attributes(self, *args, **kwargs):
+        """
+        Return the attributes (typically the ``host``) of the spans
+        reported for the cache accesses made with the given arguments
+        when tracing is enabled. See :mod:`tendril.utils.www.tracing`.
+        """
+        return {}
+
     def _accessor(self, max_age, getcpath=False, *args, **kwargs):
         """
         The primary accessor for the cache instance. Each subclass should
@@ -153,54 +325,64 @@ class CacheBase(object):
         If the module's :data:`_internet_connected` is set to False, the
         cached value is returned regardless.
 
+        If a stale cached copy exists, the subclass is given a chance to
+        revalidate it with the source (see :func:`_revalidate`) before it
+        is refetched. If the source is unavailable because its circuit
+        breaker is open (see :mod:`tendril.utils.www.resilience`), the
+        stale copy is returned instead.
+
+        Cache lookups and writes are reported as ``cache.get`` and
+        ``cache.set`` spans if tracing is enabled. See
+        :mod:`tendril.utils.www.tracing`.
+
         """
         filepath = self._get_filepath(*args, **kwargs)
-        send_cached = False
-        if not is_connected() and self._cached_exists(filepath):
-            send_cached = True
-        if self._is_cache_fresh(filepath, max_age):
-            logger.debug("Cache HIT")
-            send_cached = True
-        if send_cached is True:
-            if getcpath is False:
-                try:
-                    filecontent = self.cache_fs.open(filepath, 'rb').read()
-                    return self._deserialize(filecontent)
-                except UnicodeDecodeError:
-                    # TODO This requires the cache_fs to be a local
-                    # filesystem. This may not be very nice. A way
-                    # to hook codecs upto to pyfilesystems would be better
-                    with codecs.open(
-                            self.cache_fs.getsyspath(filepath),
-                            encoding='utf-8') as f:
-                        filecontent = f.read()
-                        return self._deserialize(filecontent)
+        attributes = self._get_trace_attributes(*args, **kwargs) \
+            if is_tracing_enabled() else {}
+        with span('cache.get', cache=self.__class__.__name__,
+                  **attributes) as s:
+            send_cached = False
+            if not is_connected() and self._cached_exists(filepath):
+                send_cached = True
+            elif self._is_cache_fresh(filepath, max_age):
+                logger.debug("Cache HIT")
+                send_cached = True
+            s.set_attribute('hit', send_cached)
+            if send_cached is True:
+                return self._read_cached(filepath, getcpath)
+            stale = self._cached_exists(filepath)
+
+        data = None
+        if stale:
+            try:
+                valid, data = self._revalidate(filepath, *args, **kwargs)
+            except CircuitOpenError as e:
+                logger.warning("Serving stale cache content : "
+                               "{0}".format(e.reason))
+                send_cached = True
             else:
-                return self.cache_fs.getsyspath(filepath)
+                if valid is True:
+                    logger.debug("Cache REVALIDATED")
+                    self.cache_fs.touch(filepath)
+                    send_cached = True
+        if send_cached is True:
+            with span('cache.get', cache=self.__class__.__name__,
+                      hit=True, **attributes):
+                return self._read_cached(filepath, getcpath)
 
         logger.debug("Cache MISS")
-        data = self._get_fresh_content(*args, **kwargs)
-
-        sdata = self._serialize(data)
-        fd, temppath = tempfile.mkstemp()
-        fp = os.fdopen(fd, 'wb')
-        fp.write(sdata)
-        fp.close()
-        logger.debug("Creating new cache entry")
-        # This can be pretty expensive if the move is across a real
-        # filesystem boundary. We should instead use a temporary file
-        # in the cache_fs itself
-        try:
-            copy_file(temp_fs, temp_fs.unsyspath(temppath),
-                      self.cache_fs, filepath)
-            if isinstance(self.cache_fs, OSFS):
-                # TODO Refine permissions
-                os.chmod(self.cache_fs.getsyspath(filepath), 0o666)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:  # noqa
-            logger.warning("Unable to write cache file "
-                           "{0}".format(filepath))
+        if data is None:
+            try:
+                data = self._get_fresh_content(*args, **kwargs)
+            except CircuitOpenError as e:
+                if not self._cached_exists(filepath):
+                    raise
+                logger.warning("Serving stale cache content : "
+                               "{0}".format(e.reason))
+                return self._read_cached(filepath, getcpath)
+
+        with span('cache.set', cache=self.__class__.__name__, **attributes):
+            self._write_cached(filepath, data)
 
         if getcpath is False:
             return data
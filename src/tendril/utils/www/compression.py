@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Content-Encoding Support for urllib (:mod:`tendril.utils.www.compression`)
+==========================================================================
+
+The ``requests`` and ``httpx`` backends negotiate and decode compressed
+responses on their own. ``urllib`` does neither, so the
+:class:`DecompressingHandler` provided here is attached to the opener of
+the urllib based backend (:mod:`tendril.utils.www.bare`) to do so.
+
+``gzip`` and ``deflate`` are always supported. ``br`` is supported if
+either the :mod:`brotli` or :mod:`brotlicffi` package is installed.
+
+Responses are decoded as they are received, so anything downstream of
+the opener (including the :class:`tendril.utils.www.bare.WWWCachedFetcher`
+cache) only ever sees the decoded content.
+
+"""
+
+
+import zlib
+import gzip
+from io import BytesIO
+from six.moves.urllib.request import BaseHandler
+from six.moves.urllib.response import addinfourl
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+def _decode_deflate(content):
+    # Servers disagree on whether 'deflate' means a zlib stream or a
+    # raw deflate stream. Accept both.
+    try:
+        return zlib.decompress(content)
+    except zlib.error:
+        return zlib.decompress(content, -zlib.MAX_WBITS)
+
+
+_decoders = {
+    'gzip': gzip.decompress,
+    'x-gzip': gzip.decompress,
+    'deflate': _decode_deflate,
+}
+
+if brotli is not None:
+    _decoders['br'] = brotli.decompress
+
+#: The value of the ``Accept-Encoding`` header sent by the
+#: :class:`DecompressingHandler`.
+ACCEPT_ENCODING = ', '.join(e for e in ('gzip', 'deflate', 'br')
+                            if e in _decoders)
+
+
+class DecodedResponse(addinfourl):
+    """
+    The response returned by :class:`DecompressingHandler` in place of a
+    compressed response. Unlike :class:`urllib.response.addinfourl`, the
+    ``status`` of this response can be set, as is done by
+    :class:`tendril.utils.www.redirectcache.CachingRedirectHandler`.
+    """
+    status = None
+
+    def __init__(self, fp, headers, url, code, msg=None):
+        addinfourl.__init__(self, fp, headers, url, code)
+        self.status = code
+        self.msg = msg
+
+    def getcode(self):
+        return self.status
+
+
+class DecompressingHandler(BaseHandler):
+    """
+    This handler advertises the content encodings supported by this
+    module in the ``Accept-Encoding`` header of each request which does
+    not already specify one, and transparently decodes responses which
+    use any of them.
+
+    The ``Content-Encoding`` header is removed from decoded responses
+    and the ``Content-Length`` header is updated to match the decoded
+    content.
+    """
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding', ACCEPT_ENCODING)
+        return req
+
+    https_request = http_request
+
+    def http_response(self, req, response):
+        encoding = response.headers.get('Content-Encoding', '')
+        encoding = encoding.strip().lower()
+        if encoding not in _decoders:
+            return response
+        content = response.read()
+        response.close()
+        if content:
+            content = _decoders[encoding](content)
+        headers = response.headers
+        del headers['Content-Encoding']
+        del headers['Content-Length']
+        headers['Content-Length'] = str(len(content))
+        logger.debug("Decoded {0} response from {1}".format(
+            encoding, response.url))
+        return DecodedResponse(BytesIO(content), headers, response.url,
+                               response.status, getattr(response, 'msg', None))
+
+    https_response = http_response
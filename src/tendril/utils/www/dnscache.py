@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+DNS Cache (:mod:`tendril.utils.www.dnscache`)
+=============================================
+
+Python asks the system resolver for the address of the host whenever it
+opens a new connection. Connections are not always reused, for instance
+by :mod:`tendril.utils.www.bare` or by short-lived :mod:`httpx` clients,
+so the same hosts are resolved over and over again during long runs.
+
+This module provides a :class:`DNSCache`, which keeps the addresses of
+resolved hosts for up to :data:`tendril.config.DNS_CACHE_TTL` seconds,
+and remembers hosts which do not exist for
+:data:`tendril.config.DNS_CACHE_NEGATIVE_TTL` seconds. Concurrent
+lookups of the same host wait for a single query to the resolver.
+
+The shared cache, :data:`dns_cache`, is used by all the backends :
+
+- :mod:`tendril.utils.www.bare` and :mod:`tendril.utils.www.req` use
+  connection classes based on :class:`CachedResolutionMixin`.
+- :mod:`tendril.utils.www.hx` clients use a :class:`CachingNetworkBackend`
+  or an :class:`AsyncCachingNetworkBackend`.
+
+When a host has several addresses, they are tried in turn until a
+connection is established. Lookups are reported as ``dns`` spans if
+tracing is enabled, see :mod:`tendril.utils.www.tracing`.
+
+The system resolver does not provide the TTL of the records it returns,
+so entries are kept for the maximum TTL. A different resolver can be
+used, which may also return the TTL of the records. See :class:`DNSCache`.
+
+"""
+
+
+import time
+import socket
+import threading
+from collections import OrderedDict
+
+import anyio
+from httpcore import NetworkBackend
+from httpcore import AsyncNetworkBackend
+from httpcore import ConnectError
+from httpcore import ConnectTimeout
+from urllib3.exceptions import NameResolutionError
+from urllib3.exceptions import ConnectTimeoutError
+
+from tendril.config import DNS_CACHE_TTL
+from tendril.config import DNS_CACHE_NEGATIVE_TTL
+from tendril.config import DNS_CACHE_MAX_ENTRIES
+
+from .tracing import span
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+#: Resolver errors which mean that the host does not exist, and which are
+#: therefore cached.
+NEGATIVE_ERRORS = frozenset(
+    e for e in (getattr(socket, 'EAI_NONAME', None),
+                getattr(socket, 'EAI_NODATA', None)) if e is not None)
+
+
+class _Entry(object):
+    __slots__ = ('infos', 'error', 'expires')
+
+    def __init__(self, infos, error, expires):
+        self.infos = infos
+        self.error = error
+        self.expires = expires
+
+    def get(self):
+        if self.error is not None:
+            # A new exception, so that tracebacks don't accumulate.
+            raise socket.gaierror(*self.error.args)
+        return list(self.infos)
+
+
+class DNSCache(object):
+    def __init__(self, ttl=None, negative_ttl=None, max_entries=None,
+                 resolver=None):
+        """
+        An in-process cache of the results of :func:`socket.getaddrinfo`.
+
+        :param ttl: (optional) maximum number of seconds for which results
+                    are cached. Defaults to
+                    :data:`tendril.config.DNS_CACHE_TTL`.
+        :param negative_ttl: (optional) number of seconds for which the
+                             failure to resolve a host which does not
+                             exist is cached. Defaults to
+                             :data:`tendril.config.DNS_CACHE_NEGATIVE_TTL`.
+        :param max_entries: (optional) maximum number of entries, the least
+                            recently used of which are discarded. Defaults
+                            to :data:`tendril.config.DNS_CACHE_MAX_ENTRIES`.
+        :param resolver: (optional) a callable with the signature of
+                         :func:`socket.getaddrinfo`, used instead of it.
+                         It may return a tuple of the results and their
+                         TTL in seconds, in which case they are cached for
+                         that long, if it is less than ``ttl``.
+
+        """
+        self.ttl = DNS_CACHE_TTL if ttl is None else ttl
+        self.negative_ttl = DNS_CACHE_NEGATIVE_TTL if negative_ttl is None \
+            else negative_ttl
+        self.max_entries = DNS_CACHE_MAX_ENTRIES if max_entries is None \
+            else max_entries
+        self.resolver = resolver or socket.getaddrinfo
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    @staticmethod
+    def _get_key(host, port, family, type, proto, flags):
+        if isinstance(host, bytes):
+            host = host.decode('ascii')
+        return host.lower(), port, family, type, proto, flags
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_cached(self, host, port, family=0, type=0, proto=0, flags=0):
+        """
+        Return the cached result of resolving the host, or None if there
+        isn't one. If the host is cached as not existing, the
+        :class:`socket.gaierror` it raised is raised again.
+        """
+        entry = self._get(self._get_key(host, port, family, type,
+                                        proto, flags))
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry.get()
+
+    def resolve(self, host, port, family=0, type=0, proto=0, flags=0):
+        """
+        Resolve the host using the resolver, unless another thread
+        already has, and cache the result.
+        """
+        key = self._get_key(host, port, family, type, proto, flags)
+        with self._lock:
+            lock = self._pending.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                entry = self._get(key)
+                if entry is None:
+                    self.misses += 1
+                    entry = self._resolve(key, host, port, family,
+                                          type, proto, flags)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        return entry.get()
+
+    def _resolve(self, key, *args):
+        now = time.monotonic()
+        try:
+            result = self.resolver(*args)
+        except socket.gaierror as e:
+            if e.errno in NEGATIVE_ERRORS and self.negative_ttl:
+                self._set(key, _Entry(None, e, now + self.negative_ttl))
+            raise
+        ttl = self.ttl
+        if isinstance(result, tuple):
+            result, record_ttl = result
+            if record_ttl is not None:
+                ttl = min(ttl, record_ttl)
+        entry = _Entry(tuple(result), None, now + ttl)
+        if ttl > 0:
+            self._set(key, entry)
+        return entry
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """
+        A replacement for :func:`socket.getaddrinfo`, returning the cached
+        result if there is one.
+        """
+        with span('dns', host=host) as s:
+            infos = self.get_cached(host, port, family, type, proto, flags)
+            s.set_attribute('hit', infos is not None)
+            if infos is None:
+                infos = self.resolve(host, port, family, type, proto, flags)
+            return infos
+
+    def invalidate(self, host):
+        """
+        Remove the cached results of the ``host``.
+        """
+        host = host.lower()
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == host]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<DNSCache entries={0} hits={1} misses={2}>".format(
+            len(self), self.hits, self.misses)
+
+
+def _get_dns_cache():
+    if not DNS_CACHE_TTL:
+        return None
+    return DNSCache()
+
+
+#: The :class:`DNSCache` shared by the backends, or None if
+#: :data:`tendril.config.DNS_CACHE_TTL` disables the cache.
+dns_cache = _get_dns_cache()
+
+
+def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """
+    Resolve the host as :func:`socket.getaddrinfo` does, using the shared
+    :data:`dns_cache` if it is enabled.
+    """
+    if dns_cache is None:
+        return socket.getaddrinfo(host, port, family, type, proto, flags)
+    return dns_cache.getaddrinfo(host, port, family, type, proto, flags)
+
+
+async def agetaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """
+    The async equivalent of :func:`getaddrinfo`. The resolver is run in
+    a worker thread, if the result is not already cached.
+    """
+    if dns_cache is None:
+        return await anyio.getaddrinfo(host, port, family=family, type=type,
+                                       proto=proto, flags=flags)
+    with span('dns', host=host) as s:
+        infos = dns_cache.get_cached(host, port, family, type, proto, flags)
+        s.set_attribute('hit', infos is not None)
+        if infos is None:
+            infos = await anyio.to_thread.run_sync(
+                dns_cache.resolve, host, port, family, type, proto, flags)
+        return infos
+
+
+def _get_addresses(infos):
+    addresses = []
+    for info in infos:
+        if info[4][0] not in addresses:
+            addresses.append(info[4][0])
+    if not addresses:
+        raise socket.gaierror("getaddrinfo returns an empty list")
+    return addresses
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                      source_address=None, socket_options=None):
+    """
+    A replacement for :func:`socket.create_connection`, resolving the
+    host using :func:`getaddrinfo`, and connecting to each of its
+    addresses in turn until a connection is established.
+
+    :param socket_options: (optional) a list of tuples of arguments to
+                           :meth:`socket.socket.setsockopt`, applied to
+                           the socket before connecting.
+
+    """
+    host, port = address
+    error = None
+    for family, type_, proto, _, sockaddr in getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM):
+        sock = None
+        try:
+            sock = socket.socket(family, type_, proto)
+            for option in socket_options or ():
+                sock.setsockopt(*option)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    if error is not None:
+        raise error
+    raise OSError("getaddrinfo returns an empty list")
+
+
+class CachedResolutionMixin(object):
+    """
+    A mixin for :class:`http.client.HTTPConnection` subclasses, including
+    those of :mod:`urllib3`, which resolves the host using the shared
+    :data:`dns_cache`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CachedResolutionMixin, self).__init__(*args, **kwargs)
+        # Used by http.client connections. urllib3 uses _new_conn.
+        self._create_connection = create_connection
+
+    def _new_conn(self):
+        if dns_cache is None:
+            return super(CachedResolutionMixin, self)._new_conn()
+        host = self._dns_host
+        try:
+            addresses = _get_addresses(dns_cache.getaddrinfo(
+                host.strip('[]'), self.port, 0, socket.SOCK_STREAM))
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        # urllib3 connects to the _dns_host, leaving the host to be used
+        # for the Host header and for verifying the certificate.
+        try:
+            for address in addresses[:-1]:
+                self._dns_host = address
+                try:
+                    return super(CachedResolutionMixin, self)._new_conn()
+                except ConnectTimeoutError as e:
+                    logger.debug("Unable to connect to {0} at {1} : "
+                                 "{2}".format(host, address, e))
+            self._dns_host = addresses[-1]
+            return super(CachedResolutionMixin, self)._new_conn()
+        finally:
+            self._dns_host = host
+
+
+def _get_network_error(host, e):
+    return ConnectError("Unable to resolve {0} : {1}".format(host, e))
+
+
+class CachingNetworkBackend(NetworkBackend):
+    def __init__(self, backend):
+        """
+        A :mod:`httpcore` network backend wrapping another, which
+        resolves hosts using the shared :data:`dns_cache`, and connects
+        to each of their addresses in turn until a connection is
+        established.
+
+        :param backend: the :class:`httpcore.NetworkBackend` to wrap.
+
+        """
+        self._backend = backend
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None,
+                    socket_options=None):
+        if dns_cache is None:
+            return self._backend.connect_tcp(
+                host, port, timeout, local_address, socket_options)
+        try:
+            addresses = _get_addresses(dns_cache.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM))
+        except socket.gaierror as e:
+            raise _get_network_error(host, e) from e
+        for address in addresses[:-1]:
+            try:
+                return self._backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options)
+            except (ConnectError, ConnectTimeout) as e:
+                logger.debug("Unable to connect to {0} at {1} : "
+                             "{2!r}".format(host, address, e))
+        return self._backend.connect_tcp(
+            addresses[-1], port, timeout, local_address, socket_options)
+
+    def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return self._backend.connect_unix_socket(path, timeout,
+                                                 socket_options)
+
+    def sleep(self, seconds):
+        self._backend.sleep(seconds)
+
+
+class AsyncCachingNetworkBackend(AsyncNetworkBackend):
+    def __init__(self, backend):
+        """
+        The async equivalent of :class:`CachingNetworkBackend`, resolving
+        hosts which are not in the cache in a worker thread.
+
+        :param backend: the :class:`httpcore.AsyncNetworkBackend` to wrap.
+
+        """
+        self._backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None,
+                          socket_options=None):
+        if dns_cache is None:
+            return await self._backend.connect_tcp(
+                host, port, timeout, local_address, socket_options)
+        try:
+            addresses = _get_addresses(await agetaddrinfo(
+                host, port, 0, socket.SOCK_STREAM))
+        except socket.gaierror as e:
+            raise _get_network_error(host, e) from e
+        for address in addresses[:-1]:
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options)
+            except (ConnectError, ConnectTimeout) as e:
+                logger.debug("Unable to connect to {0} at {1} : "
+                             "{2!r}".format(host, address, e))
+        return await self._backend.connect_tcp(
+            addresses[-1], port, timeout, local_address, socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None,
+                                  socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout,
+                                                       socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
@@ -0,0 +1,608 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streaming Downloads (:mod:`tendril.utils.www.downloads`)
+========================================================
+
+The requests based backend (:mod:`tendril.utils.www.req`) holds entire
+responses in memory, and :mod:`cachecontrol` buffers entire bodies in
+order to cache them. This is fine for web pages, but not for large files
+such as datasheets and CAD archives.
+
+This module provides :func:`download`, which streams a file from a url
+to a destination on disk, in chunks, using a session from
+:func:`tendril.utils.www.req.get_shared_session`. The file is
+simultaneously written to a download cache in the ``INSTANCE_CACHE``, so
+memory use is bounded by the chunk size regardless of the size of the
+file.
+
+- A fresh cached copy is copied to the destination without contacting
+  the server. A stale one is revalidated using its ``ETag`` or
+  ``Last-Modified``, and reused if the server responds with ``304``.
+- If a download is interrupted, the partial file is kept in the cache,
+  and the next download of the same url resumes it using a ``Range``
+  request. ``If-Range`` is used to make sure the file has not changed in
+  the meantime, in which case the server sends the whole file again.
+- The destination file only appears once the download is complete.
+
+:func:`async_download` does the same using the httpx based backend
+(:mod:`tendril.utils.www.hx`), sharing the same download cache. Disk
+writes are done in the event loop's executor, with a bounded number of
+chunks buffered between the network and the disk, so that the event loop
+is not blocked and a slow disk slows down the download rather than
+growing the buffers. It also computes a hash of the file as it is
+downloaded, and can download large files in several parts concurrently.
+
+"""
+
+
+import os
+import six
+import asyncio
+import hashlib
+from hashlib import md5
+
+from tendril.config import INSTANCE_CACHE
+from tendril.config import MAX_AGE_DEFAULT
+
+from .caching import CacheBase
+from .status import is_connected
+from .req import get_shared_session
+from .hx import async_client
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+DOWNLOAD_CACHE = os.path.join(INSTANCE_CACHE, 'downloads')
+
+#: Default number of bytes read and written at a time.
+CHUNK_SIZE = 64 * 1024
+
+#: Default maximum number of chunks of each async download buffered in
+#: memory while waiting to be written to disk.
+BUFFERS = 16
+
+#: Default size of the parts of async multi-part downloads.
+PART_SIZE = 8 * 1024 * 1024
+
+# Request extensions bypassing the httpx response cache, which would
+# otherwise buffer entire bodies.
+_NO_CACHE = {'tendril.cache': False}
+
+
+def _get_validators(response):
+    validators = {}
+    if response.headers.get('ETag'):
+        validators['ETag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        validators['Last-Modified'] = response.headers['Last-Modified']
+    return validators
+
+
+def _get_range_start(response):
+    # Content-Range: bytes <start>-<end>/<length>
+    try:
+        unit, spec = response.headers['Content-Range'].split(' ', 1)
+        return int(spec.split('-', 1)[0])
+    except (KeyError, ValueError):
+        return None
+
+
+def _get_range_length(response):
+    try:
+        return int(response.headers['Content-Range'].rsplit('/', 1)[1])
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def _is_encoded(response):
+    # Whether the server ignored Accept-Encoding: identity.
+    encoding = response.headers.get('Content-Encoding', 'identity')
+    return encoding.strip().lower() != 'identity'
+
+
+class DownloadCache(CacheBase):
+    """
+    Subclass of :class:`tendril.utils.www.caching.CacheBase` which stores
+    downloaded files. Unlike the other caches, files are streamed in and
+    out of this cache rather than being held in memory. See
+    :func:`download`.
+
+    The validators of each file are stored in its metadata. Partially
+    downloaded files are stored alongside the complete ones with a
+    ``.part`` suffix, along with their own metadata.
+    """
+    def _get_filepath(self, url):
+        """
+        Return a filename constructed from the md5 sum of the url.
+        """
+        if six.PY3 or (six.PY2 and isinstance(url, unicode)):  # noqa
+            return md5(url.encode('utf-8')).hexdigest()
+        return md5(url).hexdigest()
+
+    def _copy_out(self, filepath, dest, chunk_size):
+        with self.cache_fs.open(filepath, 'rb') as src:
+            with open(dest, 'wb') as f:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+
+    def _get_request_headers(self, filepath, partpath):
+        """
+        Return the request headers needed to revalidate the cached copy
+        at ``filepath``, if any, or to resume the partial download at
+        ``partpath``, along with the number of bytes already downloaded.
+        """
+        if self.cache_fs.exists(partpath):
+            validators = self._read_metadata(partpath) or {}
+            validator = validators.get('ETag') or \
+                validators.get('Last-Modified')
+            size = self.cache_fs.getsize(partpath)
+            if validator and size:
+                return {'Range': 'bytes={0}-'.format(size),
+                        'If-Range': validator}, size
+            self.cache_fs.remove(partpath)
+            self._remove_metadata(partpath)
+        headers = {}
+        if self.cache_fs.exists(filepath):
+            validators = self._read_metadata(filepath) or {}
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+        return headers, 0
+
+    def _stream(self, response, partpath, offset, tmpdest, chunk_size):
+        """
+        Write the body of the ``response`` to both the partial download in
+        the cache and the temporary destination file, appending to the
+        ``offset`` bytes already downloaded.
+        """
+        if offset:
+            self._copy_out(partpath, tmpdest, chunk_size)
+        received = 0
+        with self.cache_fs.open(partpath, 'ab' if offset else 'wb') as part:
+            with open(tmpdest, 'ab' if offset else 'wb') as dest:
+                for chunk in response.iter_content(chunk_size):
+                    part.write(chunk)
+                    dest.write(chunk)
+                    received += len(chunk)
+        if _is_encoded(response):
+            # The decoded body can't be checked against the length.
+            return
+        expected = response.headers.get('Content-Length')
+        if expected is not None and int(expected) != received:
+            raise IOError("Incomplete download of {0} : received {1} of {2} "
+                          "bytes".format(response.url, received, expected))
+
+    def download(self, url, dest, max_age=MAX_AGE_DEFAULT, session=None,
+                 chunk_size=CHUNK_SIZE):
+        """
+        Download the file at the ``url`` to ``dest``. See :func:`download`.
+        """
+        filepath = self._get_filepath(url)
+        partpath = filepath + '.part'
+        if self.cache_fs.exists(filepath) and (
+                not is_connected() or
+                self._is_cache_fresh(filepath, max_age)):
+            logger.debug("Cache HIT")
+            self._copy_out(filepath, dest, chunk_size)
+            return dest
+
+        if session is None:
+            session = get_shared_session()
+        headers, offset = self._get_request_headers(filepath, partpath)
+        # The response cache would otherwise buffer the entire body.
+        headers['Cache-Control'] = 'no-cache, no-store'
+        # Lengths and ranges are counted in bytes of the encoded body.
+        headers['Accept-Encoding'] = 'identity'
+        tmpdest = '{0}.download'.format(dest)
+
+        for _ in range(2):
+            response = session.get(url, headers=headers, stream=True)
+            try:
+                if response.status_code == 304:
+                    logger.debug("Cache REVALIDATED")
+                    self.cache_fs.touch(filepath)
+                    self._copy_out(filepath, dest, chunk_size)
+                    return dest
+                if response.status_code == 416 and offset:
+                    # The partial download can't be resumed. Start over.
+                    logger.info("Restarting download of {0}".format(url))
+                    headers.pop('Range')
+                    headers.pop('If-Range')
+                    offset = 0
+                    continue
+                response.raise_for_status()
+                if response.status_code != 206 or \
+                        _get_range_start(response) != offset:
+                    # The server sent the whole file, either because it
+                    # has changed or because it does not support ranges.
+                    offset = 0
+                    self._write_metadata(partpath, _get_validators(response))
+                elif offset:
+                    logger.info("Resuming download of {0} from {1} "
+                                "bytes".format(url, offset))
+                self._stream(response, partpath, offset, tmpdest, chunk_size)
+            except BaseException:
+                if os.path.exists(tmpdest):
+                    os.remove(tmpdest)
+                if _is_encoded(response) and self.cache_fs.exists(partpath):
+                    # Decoded bytes can't be resumed using byte ranges.
+                    self.cache_fs.remove(partpath)
+                    self._remove_metadata(partpath)
+                raise
+            finally:
+                response.close()
+            break
+
+        self.cache_fs.move(partpath, filepath, overwrite=True)
+        self._write_metadata(filepath, self._read_metadata(partpath) or {})
+        self._remove_metadata(partpath)
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.rename(tmpdest, dest)
+        return dest
+
+
+#: The module's :class:`DownloadCache` instance, stored in the directory
+#: defined by :data:`DOWNLOAD_CACHE`.
+download_cache = DownloadCache(cache_dir=DOWNLOAD_CACHE)
+
+
+def download(url, dest, max_age=MAX_AGE_DEFAULT, session=None,
+             chunk_size=CHUNK_SIZE):
+    """
+    Download the file at the ``url`` to the path ``dest``, streaming it
+    in chunks of ``chunk_size`` bytes and caching it in the
+    :data:`download_cache`.
+
+    If the cache has a copy of the file younger than ``max_age`` seconds,
+    it is used as is. Older copies are revalidated with the server, and
+    interrupted downloads are resumed where possible.
+
+    Any exceptions encountered will be raised, and are left for the caller
+    to handle. A partially downloaded file is left in the cache for the
+    download to be resumed later, but never at ``dest``.
+
+    :param url: url of the file to download.
+    :param dest: path to write the file to. Any existing file is replaced.
+    :param max_age: maximum age in seconds of a cached copy to use
+                    without revalidating it.
+    :param session: (optional) the :class:`requests.Session` to use.
+                    Defaults to the shared session from
+                    :func:`tendril.utils.www.req.get_shared_session`.
+    :param chunk_size: number of bytes to read and write at a time.
+    :return: ``dest``
+
+    """
+    return download_cache.download(url, dest, max_age, session, chunk_size)
+
+
+def _hash_file(path, hasher, chunk_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+
+def _copy_out_hashed(cache, filepath, dest, chunk_size, hasher=None):
+    # Copy a file out of the cache, replacing dest only once complete.
+    tmpdest = '{0}.download'.format(dest)
+    try:
+        with cache.cache_fs.open(filepath, 'rb') as src:
+            with open(tmpdest, 'wb') as f:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    f.write(chunk)
+        os.replace(tmpdest, dest)
+    finally:
+        if os.path.exists(tmpdest):
+            os.remove(tmpdest)
+
+
+def _discard_part(cache, partpath):
+    if cache.cache_fs.exists(partpath):
+        cache.cache_fs.remove(partpath)
+    cache._remove_metadata(partpath)
+
+
+def _complete(cache, filepath, partpath, dest, chunk_size):
+    cache.cache_fs.move(partpath, filepath, overwrite=True)
+    cache._write_metadata(filepath, cache._read_metadata(partpath) or {})
+    cache._remove_metadata(partpath)
+    _copy_out_hashed(cache, filepath, dest, chunk_size)
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _pump(chunks, write, hasher=None, buffers=BUFFERS):
+    """
+    Write the chunks from the async iterator ``chunks`` using the
+    blocking ``write``, which is called in the event loop's executor.
+    No more than ``buffers`` chunks are held waiting to be written, and
+    no more chunks are read from ``chunks`` until there is room for them.
+
+    Returns the number of bytes written. Once this returns or raises,
+    ``write`` is no longer being called.
+    """
+    queue = asyncio.Queue(buffers)
+    state = {'error': None, 'abort': False}
+
+    async def _writer():
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            if state['error'] is None and not state['abort']:
+                try:
+                    await _run(write, chunk)
+                except Exception as e:
+                    state['error'] = e
+
+    writer = asyncio.ensure_future(_writer())
+    received = 0
+    try:
+        async for chunk in chunks:
+            if state['error'] is not None:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            received += len(chunk)
+            await queue.put(chunk)
+    except asyncio.CancelledError:
+        state['abort'] = True
+        while not queue.empty():
+            queue.get_nowait()
+        raise
+    finally:
+        # Write out the chunks already received, even if the download
+        # failed, so that it can be resumed from them. Either way, let
+        # the write in progress, if any, finish before returning.
+        await queue.put(None)
+        await asyncio.shield(writer)
+    if state['error'] is not None:
+        raise state['error']
+    return received
+
+
+async def _fetch_range(client, url, path, start, end, validator,
+                       chunk_size, buffers):
+    headers = {'Range': 'bytes={0}-{1}'.format(start, end),
+               'If-Range': validator,
+               'Accept-Encoding': 'identity'}
+    async with client.stream('GET', url, headers=headers,
+                             extensions=_NO_CACHE) as response:
+        response.raise_for_status()
+        if response.status_code != 206 or \
+                _get_range_start(response) != start:
+            raise IOError("{0} changed during its multi-part "
+                          "download".format(url))
+        if _is_encoded(response):
+            raise IOError("Encoded part of {0} at {1} can't be "
+                          "joined".format(url, start))
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            received = await _pump(response.aiter_bytes(chunk_size),
+                                   f.write, None, buffers)
+    if received != end - start + 1:
+        raise IOError("Incomplete download of {0} : received {1} of {2} "
+                      "bytes of part at {3}".format(url, received,
+                                                    end - start + 1, start))
+
+
+async def _download_parts(client, response, path, total, validator,
+                          parts, part_size, chunk_size, buffers):
+    """
+    Download the file whose first part is being received in the
+    ``response`` into ``path``, fetching the remaining parts using up to
+    ``parts - 1`` concurrent range requests.
+    """
+    def _preallocate():
+        with open(path, 'wb') as f:
+            f.truncate(total)
+
+    async def _first():
+        with open(path, 'r+b') as f:
+            received = await _pump(response.aiter_bytes(chunk_size),
+                                   f.write, None, buffers)
+        if received != min(part_size, total):
+            raise IOError("Incomplete download of {0} : received {1} of "
+                          "{2} bytes of part at 0".format(
+                              response.url, received,
+                              min(part_size, total)))
+
+    semaphore = asyncio.Semaphore(parts - 1)
+
+    async def _rest(start):
+        async with semaphore:
+            await _fetch_range(client, response.url, path, start,
+                               min(start + part_size, total) - 1,
+                               validator, chunk_size, buffers)
+
+    await _run(_preallocate)
+    tasks = [asyncio.ensure_future(_first())]
+    tasks.extend(asyncio.ensure_future(_rest(start))
+                 for start in range(part_size, total, part_size))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _async_download(cache, client, url, dest, max_age, chunk_size,
+                          parts, part_size, hasher, buffers):
+    filepath = cache._get_filepath(url)
+    partpath = filepath + '.part'
+
+    def _is_fresh():
+        return cache.cache_fs.exists(filepath) and \
+            (not is_connected() or cache._is_cache_fresh(filepath, max_age))
+
+    if await _run(_is_fresh):
+        logger.debug("Cache HIT")
+        await _run(_copy_out_hashed, cache, filepath, dest,
+                   chunk_size, hasher)
+        return
+
+    for _ in range(2):
+        headers, offset = await _run(cache._get_request_headers,
+                                     filepath, partpath)
+        headers['Accept-Encoding'] = 'identity'
+        multipart = parts > 1 and not offset
+        if multipart:
+            headers['Range'] = 'bytes=0-{0}'.format(part_size - 1)
+        partsyspath = cache.cache_fs.getsyspath(partpath)
+        async with client.stream('GET', url, headers=headers,
+                                 extensions=_NO_CACHE) as response:
+            if response.status_code == 304:
+                logger.debug("Cache REVALIDATED")
+                await _run(cache.cache_fs.touch, filepath)
+                await _run(_copy_out_hashed, cache, filepath, dest,
+                           chunk_size, hasher)
+                return
+            if response.status_code == 416 and offset:
+                # The partial download can't be resumed. Start over.
+                logger.info("Restarting download of {0}".format(url))
+                await _run(_discard_part, cache, partpath)
+                continue
+            response.raise_for_status()
+            validators = _get_validators(response)
+            validator = validators.get('ETag') or \
+                validators.get('Last-Modified')
+            start = _get_range_start(response) \
+                if response.status_code == 206 else None
+            total = _get_range_length(response)
+            if start is not None and _is_encoded(response):
+                # Ranges of the encoded body can't be joined once decoded.
+                logger.info("Restarting download of {0}".format(url))
+                await _run(_discard_part, cache, partpath)
+                parts = 1
+                continue
+            if multipart and start == 0 and validator and total:
+                try:
+                    await _download_parts(
+                        client, response, partsyspath, total, validator,
+                        parts, part_size, chunk_size, buffers)
+                except BaseException:
+                    # Partial multi-part downloads can't be resumed.
+                    await _run(_discard_part, cache, partpath)
+                    raise
+                await _run(cache._write_metadata, partpath, validators)
+                await _run(_hash_file, partsyspath, hasher, chunk_size)
+                break
+            if multipart and start is not None:
+                # Without a validator, the parts can't be guaranteed to
+                # be from the same version of the file.
+                logger.info("Downloading {0} in one part".format(url))
+                parts = 1
+                continue
+            if start is not None and offset and start == offset:
+                logger.info("Resuming download of {0} from {1} "
+                            "bytes".format(url, offset))
+                await _run(_hash_file, partsyspath, hasher, chunk_size)
+                mode = 'ab'
+            else:
+                # The server sent the whole file, either because it has
+                # changed or because it does not support ranges.
+                await _run(cache._write_metadata, partpath, validators)
+                mode = 'wb'
+            try:
+                with open(partsyspath, mode) as f:
+                    received = await _pump(response.aiter_bytes(chunk_size),
+                                           f.write, hasher, buffers)
+            except BaseException:
+                if _is_encoded(response):
+                    # Decoded bytes can't be resumed using byte ranges.
+                    await _run(_discard_part, cache, partpath)
+                raise
+            if _is_encoded(response):
+                # The decoded body can't be checked against the length.
+                break
+            expected = response.headers.get('Content-Length')
+            if expected is not None and int(expected) != received:
+                raise IOError("Incomplete download of {0} : received {1} "
+                              "of {2} bytes".format(url, received, expected))
+            break
+    else:
+        raise IOError("Could not download {0}".format(url))
+
+    await _run(_complete, cache, filepath, partpath, dest, chunk_size)
+
+
+async def async_download(url, dest, max_age=MAX_AGE_DEFAULT, client=None,
+                         chunk_size=CHUNK_SIZE, parts=1, part_size=PART_SIZE,
+                         hash_name='sha256', buffers=BUFFERS):
+    """
+    Download the file at the ``url`` to the path ``dest`` using an
+    :mod:`httpx` async client, streaming it in chunks of ``chunk_size``
+    bytes and caching it in the :data:`download_cache`. Caching, resuming
+    and error handling are as described in :func:`download`.
+
+    If ``parts`` is greater than 1 and the server supports range requests,
+    the file is downloaded in parts of ``part_size`` bytes, up to
+    ``parts`` of them concurrently. This requires the server to provide
+    an ``ETag`` or ``Last-Modified``, to make sure all the parts are of
+    the same version of the file. Otherwise, the file is downloaded in
+    one part. Interrupted multi-part downloads are not resumed.
+
+    The file is hashed using the ``hash_name`` algorithm from
+    :mod:`hashlib` as it is downloaded, except for multi-part downloads,
+    which are hashed once complete.
+
+    :param url: url of the file to download.
+    :param dest: path to write the file to. Any existing file is replaced.
+    :param max_age: maximum age in seconds of a cached copy to use
+                    without revalidating it.
+    :param client: (optional) the :class:`httpx.AsyncClient` to use. If
+                   not provided, one is obtained from
+                   :func:`tendril.utils.www.hx.async_client`.
+    :param chunk_size: number of bytes to read and write at a time.
+    :param parts: maximum number of parts to download concurrently.
+    :param part_size: number of bytes in each part.
+    :param hash_name: name of the :mod:`hashlib` hash algorithm to use.
+    :param buffers: maximum number of chunks of each part held in memory
+                    while waiting to be written to disk.
+    :return: the hex digest of the file.
+
+    """
+    hasher = hashlib.new(hash_name)
+    if client is None:
+        async with async_client() as c:
+            await _async_download(download_cache, c, url, dest, max_age,
+                                  chunk_size, parts, part_size, hasher,
+                                  buffers)
+    else:
+        await _async_download(download_cache, client, url, dest, max_age,
+                              chunk_size, parts, part_size, hasher, buffers)
+    return hasher.hexdigest()
@@ -26,29 +26,497 @@ TODO Some introduction
 
 This is added primarily for async support and interacting with internal APIs..
 
-Features such as caching and proxy support are not presently implemented, but
-should be. Note that both proxying and caching for the present intended
-applications need exclusion/bypass mechanisms.
+Proxies are used as configured in the environment (``HTTP_PROXY``,
+``HTTPS_PROXY``, ``ALL_PROXY`` and ``NO_PROXY``), or as per the ``proxy``
+client parameter. Note that both proxying and caching for the present
+intended applications need exclusion/bypass mechanisms. Response caching
+is provided by :mod:`tendril.utils.www.hxcache`, and is disabled by default
+(see :data:`tendril.config.HTTPX_CACHE_BACKEND`).
 
 New code should preferentially use this backend when possible, and older code
 using the other backend can be gradually moved here.
 
+Clients obtained from :func:`async_client` can be long-lived clients drawn
+from a registry of shared clients, so that their connection pools and TLS
+sessions are reused across uses instead of a new connection being opened
+for every call. This is opt-in, see :func:`async_client` and
+:func:`close_async_clients`.
+
+Large numbers of requests can be made concurrently, with bounded
+concurrency, using :func:`fetch_many`.
+
+Synchronous code can use the equivalent :func:`sync_client` and
+:func:`with_sync_client_cl`, which provide pooled :class:`httpx.Client`
+instances.
+
 """
 
 
+import time
+import atexit
+import asyncio
+import threading
 from functools import wraps
+from collections import deque
+from collections import OrderedDict
+from contextlib import contextmanager
 from contextlib import asynccontextmanager
+from httpx import Client
 from httpx import AsyncClient
-from .ssl import ssl_context
+from httpx import Limits
+from httpx import BaseTransport
+from httpx import AsyncBaseTransport
+from httpx import HTTPTransport
+from httpx import AsyncHTTPTransport
+from httpx import URL
+from httpx import Request
+from httpx._utils import get_environment_proxies
+from ssl import SSLContext
+from .ssl import get_ssl_context
+from .ssl import is_noverify_host
+from .redirectcache import get_actual_url
+from .redirectcache import record_redirect
+from .redirectcache import PERMANENT_REDIRECT_STATUSES
+from .redirectcache import CREDENTIAL_HEADERS
+from .redirectcache import is_same_origin
+from .hxcache import CachingTransport
+from .hxcache import AsyncCacheStore
+from .hxcache import get_store
+from .ratelimit import RateLimitingTransport
+from .resilience import RetryPolicy
+from .hxresilience import RetryingTransport
+from .hxresilience import HedgingTransport
+from .tracing import TracingTransport
+from .dnscache import CachingNetworkBackend
+from .dnscache import AsyncCachingNetworkBackend
 
-from tendril.config import SSL_NOVERIFY_HOSTS
+from tendril.config import ENABLE_REDIRECT_CACHING
+from tendril.config import HTTPX_SHARE_CLIENTS
+from tendril.config import HTTPX_MAX_CONNECTIONS
+from tendril.config import HTTPX_MAX_KEEPALIVE_CONNECTIONS
+from tendril.config import HTTPX_KEEPALIVE_EXPIRY
+from tendril.config import HTTPX_CLIENT_IDLE_TIMEOUT
+from tendril.config import HTTPX_HTTP2
+from tendril.config import HTTPX_RETRY
+from tendril.config import HTTPX_HEDGING
+from tendril.config import HTTPX_BATCH_CONCURRENCY
+from tendril.config import HTTPX_BATCH_MAX_PER_HOST
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
 
+class RedirectCachingTransport(BaseTransport, AsyncBaseTransport):
+    def __init__(self, transport):
+        """
+        An :mod:`httpx` transport wrapping another (sync or async one),
+        which resolves urls using the shared redirect cache before sending
+        requests, and records the permanent redirects it receives in it.
+        See :mod:`tendril.utils.www.redirectcache`.
+
+        Since :mod:`httpx` clients follow redirects by sending one
+        request per hop through the transport, each hop is seen and
+        recorded here. Note that the ``url`` of a response obtained from
+        a cached redirect target remains that of the original request.
+        Requests resolved to a different origin are sent without their
+        credentials.
+
+        :param transport: the transport to wrap.
+
+        """
+        self._transport = transport
+
+    @staticmethod
+    def _resolve(request):
+        url = str(request.url)
+        target = get_actual_url(url)
+        if target == url:
+            return request
+        excluded = ('host',)
+        if not is_same_origin(url, target):
+            excluded += CREDENTIAL_HEADERS
+        target = URL(target)
+        headers = [(k, v) for k, v in request.headers.multi_items()
+                   if k.lower() not in excluded]
+        headers.insert(0, ('Host', target.netloc.decode('ascii')))
+        return Request(request.method, target, headers=headers,
+                       stream=request.stream, extensions=request.extensions)
+
+    @staticmethod
+    def _record(request, response):
+        if response.status_code in PERMANENT_REDIRECT_STATUSES and \
+                'location' in response.headers:
+            record_redirect(str(request.url), response.headers['location'])
+
+    def handle_request(self, request):
+        request = self._resolve(request)
+        response = self._transport.handle_request(request)
+        self._record(request, response)
+        return response
+
+    async def handle_async_request(self, request):
+        request = self._resolve(request)
+        response = await self._transport.handle_async_request(request)
+        self._record(request, response)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _apply_dns_cache(transport, backend_class):
+    """
+    Make the network ``transport`` resolve hosts using the shared DNS
+    cache, by wrapping the network backend of its connection pool in the
+    ``backend_class``. See :mod:`tendril.utils.www.dnscache`.
+    """
+    # httpx transports can't be given a network backend, so the one the
+    # connection pool was created with is replaced.
+    pool = transport._pool
+    pool._network_backend = backend_class(pool._network_backend)
+    return transport
+
+
+#: Keyword arguments of :class:`httpx.AsyncClient` which configure its
+#: transport, and are passed on to the transport built by
+#: :func:`_get_transport` instead.
+_TRANSPORT_KWARGS = ('verify', 'cert', 'http1', 'http2',
+                     'limits', 'proxy', 'trust_env')
+
+
+def get_limits():
+    """
+    Return the :class:`httpx.Limits` used by clients which do not specify
+    their own, as per the :data:`tendril.config.HTTPX_MAX_CONNECTIONS`,
+    :data:`tendril.config.HTTPX_MAX_KEEPALIVE_CONNECTIONS` and
+    :data:`tendril.config.HTTPX_KEEPALIVE_EXPIRY` options.
+    """
+    return Limits(max_connections=HTTPX_MAX_CONNECTIONS,
+                  max_keepalive_connections=HTTPX_MAX_KEEPALIVE_CONNECTIONS,
+                  keepalive_expiry=HTTPX_KEEPALIVE_EXPIRY)
+
+
+_http2_available = None
+
+
+def http2_available():
+    """
+    Whether the ``h2`` package, which :mod:`httpx` needs for HTTP/2
+    support, is installed.
+    """
+    global _http2_available
+    if _http2_available is None:
+        try:
+            import h2  # noqa: F401
+            _http2_available = True
+        except ImportError:
+            _http2_available = False
+    return _http2_available
+
+
+def _apply_http2(tkwargs):
+    """
+    Set the protocols offered by the transport constructed from
+    ``tkwargs``, falling back to HTTP/1.1 if HTTP/2 is requested but
+    not available.
+    """
+    tkwargs.setdefault('http2', HTTPX_HTTP2)
+    if tkwargs['http2'] and not http2_available():
+        logger.warning("HTTP/2 requested for httpx client, but the 'h2' "
+                       "package is not installed. Falling back to HTTP/1.1.")
+        tkwargs['http2'] = False
+        tkwargs['http1'] = True
+
+
+def _pop_transport_kwargs(kwargs):
+    """
+    Remove the transport related parameters from the ``kwargs`` of a
+    client and return them, along with the defaults of the transports
+    built by :func:`_get_transport`.
+    """
+    tkwargs = {k: kwargs[k] for k in _TRANSPORT_KWARGS if k in kwargs}
+    for k in tkwargs:
+        if k != 'trust_env':
+            kwargs.pop(k)
+    tkwargs.setdefault('limits', get_limits())
+    _apply_http2(tkwargs)
+    return tkwargs
+
+
+def _mount_proxies(kwargs, tkwargs, build):
+    """
+    Mount transports for the proxies configured in the environment
+    (``HTTP_PROXY``, ``HTTPS_PROXY``, ``ALL_PROXY`` and ``NO_PROXY``) in
+    the ``kwargs`` of a client, built by calling ``build`` with the
+    ``tkwargs`` for each proxy.
+
+    :mod:`httpx` only uses these proxies for clients it builds the
+    transport of itself. As it does, they are not used if a ``proxy`` is
+    provided or if ``trust_env`` is False. Any ``mounts`` already in the
+    ``kwargs`` take precedence.
+    """
+    if tkwargs.get('proxy') is not None or \
+            not kwargs.get('trust_env', True):
+        return
+    mounts = {}
+    for pattern, proxy in get_environment_proxies().items():
+        if proxy is None:
+            mounts[pattern] = None
+        else:
+            mounts[pattern] = build(dict(tkwargs, proxy=proxy))
+    if mounts:
+        mounts.update(kwargs.get('mounts') or {})
+        kwargs['mounts'] = mounts
+
+
+def _get_transport(kwargs, cache=None, rate_limiter=None,
+                   retry=None, hedge=None):
+    """
+    Construct the transport for an :class:`httpx.AsyncClient` from (and
+    in place of) the transport related parameters in the client's
+    ``kwargs``. HTTP/2 is enabled as described in :func:`async_client`.
+    The network transport resolves hosts using the shared DNS cache of
+    :mod:`tendril.utils.www.dnscache`, and is wrapped in a
+    :class:`tendril.utils.www.tracing.TracingTransport`, so that each
+    attempt at a request is traced separately, then in a
+    :class:`tendril.utils.www.ratelimit.RateLimitingTransport`, then in a
+    :class:`tendril.utils.www.hxresilience.HedgingTransport` and a
+    :class:`tendril.utils.www.hxresilience.RetryingTransport` if enabled,
+    then in the
+    :class:`RedirectCachingTransport` if redirect caching is enabled, and
+    then in a :class:`tendril.utils.www.hxcache.CachingTransport` if a
+    ``cache`` is to be used.
+
+    Transports built in the same way are mounted in the ``kwargs`` for the
+    proxies configured in the environment, see :func:`_mount_proxies`.
+
+    :param cache: the response cache to use. Either an
+                  :class:`tendril.utils.www.hxcache.AsyncCacheStore`, the
+                  name of a backend (see
+                  :func:`tendril.utils.www.hxcache.get_store`), False to
+                  disable caching, or None to use the configured default.
+    :param rate_limiter: (optional) a
+                         :class:`tendril.utils.www.ratelimit.AsyncRateLimiter`
+                         to apply to all requests.
+    :param retry: a :class:`tendril.utils.www.resilience.RetryPolicy`,
+                  True to use the default one, False to not retry
+                  requests, or None to retry as per
+                  :data:`tendril.config.HTTPX_RETRY`.
+    :param hedge: whether to hedge requests. If None, as per
+                  :data:`tendril.config.HTTPX_HEDGING`.
+    """
+    if hedge is None:
+        hedge = HTTPX_HEDGING
+    if retry is None:
+        retry = HTTPX_RETRY
+    if cache is False:
+        cache = None
+    elif not isinstance(cache, AsyncCacheStore):
+        cache = get_store(cache)
+
+    def build(tkwargs):
+        transport = _apply_dns_cache(AsyncHTTPTransport(**tkwargs),
+                                     AsyncCachingNetworkBackend)
+        transport = TracingTransport(transport)
+        transport = RateLimitingTransport(transport, rate_limiter)
+        if hedge:
+            transport = HedgingTransport(transport)
+        if retry:
+            transport = RetryingTransport(
+                transport, retry if isinstance(retry, RetryPolicy) else None)
+        if ENABLE_REDIRECT_CACHING:
+            transport = RedirectCachingTransport(transport)
+        if cache is not None:
+            transport = CachingTransport(transport, cache)
+        return transport
+
+    tkwargs = _pop_transport_kwargs(kwargs)
+    _mount_proxies(kwargs, tkwargs, build)
+    return build(tkwargs)
+
+
+#: Keyword arguments of :func:`async_client` which are not supported by
+#: :func:`sync_client`.
+ASYNC_ONLY_KWARGS = ('cache', 'rate_limiter', 'hedge')
+
+
+def _get_sync_transport(kwargs, retry=None):
+    """
+    Construct the transport for an :class:`httpx.Client` from (and in
+    place of) the transport related parameters in the client's
+    ``kwargs``, in the same way as :func:`_get_transport`. Response
+    caching, rate limiting and hedging are presently only available for
+    async clients.
+    """
+    if retry is None:
+        retry = HTTPX_RETRY
+
+    def build(tkwargs):
+        transport = _apply_dns_cache(HTTPTransport(**tkwargs),
+                                     CachingNetworkBackend)
+        transport = TracingTransport(transport)
+        if retry:
+            transport = RetryingTransport(
+                transport, retry if isinstance(retry, RetryPolicy) else None)
+        if ENABLE_REDIRECT_CACHING:
+            transport = RedirectCachingTransport(transport)
+        return transport
+
+    tkwargs = _pop_transport_kwargs(kwargs)
+    _mount_proxies(kwargs, tkwargs, build)
+    return build(tkwargs)
+
+
+def _prepare_kwargs(kwargs):
+    """
+    Configure SSL verification in the ``kwargs`` for an
+    :class:`httpx.AsyncClient` or :class:`httpx.Client`, as described in
+    :func:`async_client`.
+    """
+    base_url = kwargs.get('base_url', None)
+    verify = kwargs.get('verify', True)
+    if isinstance(verify, SSLContext):
+        logger.debug("Using the provided SSL context for this httpx client")
+        return
+    if not verify:
+        if base_url is None:
+            logger.warn("SSL verification disabled for this generic httpx client!")
+        else:
+            logger.info(f"SSL verification disabled for this httpx client to {base_url}")
+    elif is_noverify_host(base_url):
+        logger.info(f"SSL verification disabled for httpx client to {base_url}")
+    kwargs['verify'] = get_ssl_context(base_url, verify,
+                                       kwargs.pop('cert', None))
+
+
+def _create_client(*args, **kwargs):
+    cache = kwargs.pop('cache', None)
+    rate_limiter = kwargs.pop('rate_limiter', None)
+    retry = kwargs.pop('retry', None)
+    hedge = kwargs.pop('hedge', None)
+    if 'transport' not in kwargs.keys():
+        kwargs['transport'] = _get_transport(kwargs, cache, rate_limiter,
+                                             retry, hedge)
+    return AsyncClient(*args, **kwargs)
+
+
+def _create_sync_client(*args, **kwargs):
+    retry = kwargs.pop('retry', None)
+    if 'transport' not in kwargs.keys():
+        kwargs['transport'] = _get_sync_transport(kwargs, retry)
+    return Client(*args, **kwargs)
+
+
+def _freeze(value):
+    # Make client parameters usable as a registry key.
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+#: Client parameters with which clients are never shared, since they carry
+#: per-caller credentials or state, and since objects such as these are
+#: usually created anew by each caller, which would keep adding clients to
+#: the registry.
+UNSHARED_KWARGS = ('auth', 'cookies', 'event_hooks')
+
+
+def _is_shared(shared, kwargs):
+    """
+    Whether a client created with the ``kwargs`` is to be drawn from the
+    registry of shared clients, given the ``shared`` argument of
+    :func:`async_client` or :func:`sync_client`.
+    """
+    if shared is None:
+        shared = HTTPX_SHARE_CLIENTS
+    if shared and any(kwargs.get(k) for k in UNSHARED_KWARGS):
+        logger.debug("Not sharing httpx client created with any of "
+                     "{0}".format(', '.join(UNSHARED_KWARGS)))
+        return False
+    return shared
+
+
+class _SharedClient(object):
+    def __init__(self, client):
+        self.client = client
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+#: The registry of shared clients, keyed by the event loop they belong to
+#: and the parameters they were created with.
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+
+def _pop_clients(loop, idle_before=None):
+    """
+    Remove and return the shared clients belonging to the ``loop`` which
+    are not in use and were last used before ``idle_before``, or all of
+    them if ``idle_before`` is None. Clients belonging to event loops
+    which have been closed can't be closed anymore, and are simply
+    dropped.
+    """
+    clients = []
+    with _shared_clients_lock:
+        for key, entry in list(_shared_clients.items()):
+            if key[0].is_closed():
+                del _shared_clients[key]
+            elif key[0] is loop and (
+                    idle_before is None or
+                    (not entry.users and entry.last_used < idle_before)):
+                del _shared_clients[key]
+                clients.append(entry.client)
+    return clients
+
+
+async def _acquire_client(args, kwargs):
+    loop = asyncio.get_running_loop()
+    for client in _pop_clients(
+            loop, time.monotonic() - HTTPX_CLIENT_IDLE_TIMEOUT):
+        logger.debug(f"Closing idle shared httpx client to {client.base_url}")
+        await client.aclose()
+    key = (loop, _freeze(args), _freeze(kwargs))
+    with _shared_clients_lock:
+        entry = _shared_clients.get(key)
+        if entry is None or entry.client.is_closed:
+            entry = _SharedClient(_create_client(*args, **kwargs))
+            _shared_clients[key] = entry
+        entry.users += 1
+    return entry
+
+
+def _release_client(entry):
+    with _shared_clients_lock:
+        entry.users -= 1
+        entry.last_used = time.monotonic()
+
+
+async def close_async_clients():
+    """
+    Close all the shared clients created by :func:`async_client` for the
+    running event loop. Applications should await this when shutting
+    down, before the event loop is closed.
+
+    Any further use of :func:`async_client` creates new clients.
+    """
+    for client in _pop_clients(asyncio.get_running_loop()):
+        await client.aclose()
+
+
 @asynccontextmanager
-async def async_client(*args, **kwargs):
+async def async_client(*args, shared=None, **kwargs):
     """
     Application executable code will typically only have to interact with this
     ``contextmanager``. It should use this to create a http client session,
@@ -57,33 +525,324 @@ async def async_client(*args, **kwargs):
 
     The client provided by this context manager will (should. TODO) be configured
     appropriately as per the network settings in the tendril configuration.
+    Unless the client parameters specify otherwise, its connection pool is
+    limited as per :func:`get_limits`.
+
+    The client uses a cached SSL context from
+    :func:`tendril.utils.www.ssl.get_ssl_context` for its ``base_url``, so
+    that clients to the same host share the context and resume its TLS
+    sessions. ``verify`` may be False, or the path to a CA file to trust
+    in addition to :data:`tendril.config.CA_BUNDLE`, and ``cert`` may be
+    a client certificate, as described there. An :class:`ssl.SSLContext`
+    provided as ``verify`` is used as is.
 
-    This client may also provide some caching and cache management functionality
-    in the future, similar to the other tendril www providers.
+    By default, a new client is created, and closed when the context exits.
+    If ``shared`` is True (or, if it isn't provided, as per
+    :data:`tendril.config.HTTPX_SHARE_CLIENTS`), the client is instead a
+    long-lived one drawn from a registry of shared clients, keyed by the
+    running event loop and the parameters provided (``base_url``,
+    ``verify``, ``proxy``, ``limits``, ``headers``, etc.). Exiting the
+    context does not close a shared client. Shared clients which have not
+    been used for :data:`tendril.config.HTTPX_CLIENT_IDLE_TIMEOUT` seconds
+    are closed, and applications should close the rest using
+    :func:`close_async_clients` when they shut down. Shared clients also
+    share their cookie jars, so callers should not modify or close shared
+    clients themselves. Clients created with ``auth``, ``cookies`` or
+    ``event_hooks`` are never shared, see :data:`UNSHARED_KWARGS`.
+
+    Responses are cached as described in :mod:`tendril.utils.www.hxcache`
+    if a ``cache`` keyword argument is provided (an
+    :class:`tendril.utils.www.hxcache.AsyncCacheStore`, or ``'memory'`` or
+    ``'disk'``), or if one is configured and ``cache`` is not False.
+    Permanent redirects are cached in the shared redirect cache, if redirect
+    caching is enabled. See :class:`RedirectCachingTransport`.
+
+    Requests are rate limited by the limiters registered for their hosts,
+    and by the ``rate_limiter`` keyword argument, if provided. Cache hits
+    are not rate limited. See :mod:`tendril.utils.www.ratelimit`.
+
+    Requests failing with transient errors are retried, and slow requests
+    may be hedged, as described in :mod:`tendril.utils.www.hxresilience`.
+    By default, this is as per :data:`tendril.config.HTTPX_RETRY` and
+    :data:`tendril.config.HTTPX_HEDGING`. The ``retry`` keyword argument
+    can be False to not retry requests, or a
+    :class:`tendril.utils.www.resilience.RetryPolicy` to use, and the
+    ``hedge`` keyword argument can be True or False.
+
+    HTTP/2 is offered if ``http2`` is True or, if it isn't provided, as per
+    :data:`tendril.config.HTTPX_HTTP2`. Over TLS, the protocol is negotiated
+    with the server, and HTTP/1.1 is used with servers that don't support
+    HTTP/2. For cleartext (``http://``) connections to servers known to
+    support HTTP/2, such as internal APIs, also provide ``http1=False``.
+    Clients fall back to HTTP/1.1 if the ``h2`` package is not installed.
+    See :func:`http2_available`.
     """
+    shared = _is_shared(shared, kwargs)
+    _prepare_kwargs(kwargs)
+    if not shared:
+        async with _create_client(*args, **kwargs) as client:
+            yield client
+        return
+    entry = await _acquire_client(args, kwargs)
     try:
-        if 'verify' in kwargs.keys():
-            if not kwargs['verify']:
-                if 'base_url' not in kwargs.keys():
-                    logger.warn("SSL verification disabled for this generic httpx client!")
-                else:
-                    logger.info(f"SSL verification disabled for this httpx client to {kwargs['base_url']}")
-                kwargs['verify'] = False
-            else:
-                raise NotImplementedError(
-                    "A custom verify has been provided, but we already "
-                    "specify a custom SSL context to manage self-signed "
-                    "certificate verification. Merging the two contexts "
-                    "is not presently implemented")
-        elif 'base_url' in kwargs.keys() and kwargs['base_url'] in SSL_NOVERIFY_HOSTS:
-            logger.info(f"SSL verification disabled for httpx client to {kwargs['base_url']}")
-            kwargs['verify'] = False
-        else:
-            kwargs['verify'] = ssl_context
-        async with AsyncClient(*args, **kwargs) as client:
+        yield entry.client
+    finally:
+        _release_client(entry)
+
+
+#: The registry of shared sync clients, keyed by the parameters they were
+#: created with.
+_shared_sync_clients = {}
+
+
+def _pop_sync_clients(idle_before=None):
+    # As _pop_clients, for the shared sync clients.
+    clients = []
+    with _shared_clients_lock:
+        for key, entry in list(_shared_sync_clients.items()):
+            if idle_before is None or \
+                    (not entry.users and entry.last_used < idle_before):
+                del _shared_sync_clients[key]
+                clients.append(entry.client)
+    return clients
+
+
+def _acquire_sync_client(args, kwargs):
+    for client in _pop_sync_clients(
+            time.monotonic() - HTTPX_CLIENT_IDLE_TIMEOUT):
+        logger.debug(f"Closing idle shared httpx client to {client.base_url}")
+        client.close()
+    key = (_freeze(args), _freeze(kwargs))
+    with _shared_clients_lock:
+        entry = _shared_sync_clients.get(key)
+        if entry is None or entry.client.is_closed:
+            entry = _SharedClient(_create_sync_client(*args, **kwargs))
+            _shared_sync_clients[key] = entry
+        entry.users += 1
+    return entry
+
+
+@atexit.register
+def close_sync_clients():
+    """
+    Close all the shared clients created by :func:`sync_client`. This is
+    done automatically when the interpreter exits.
+
+    Any further use of :func:`sync_client` creates new clients.
+    """
+    for client in _pop_sync_clients():
+        client.close()
+
+
+@contextmanager
+def sync_client(*args, shared=None, **kwargs):
+    """
+    The synchronous counterpart of :func:`async_client`, providing an
+    :class:`httpx.Client` configured in the same way, for code which can't
+    be made async. If ``shared``, the client is drawn from a registry of
+    shared clients, keyed by the parameters provided, so that all the sync
+    code using the same parameters shares a connection pool. Shared clients
+    can be used from multiple threads.
+
+    SSL verification, connection limits, HTTP/2, retries and redirect
+    caching are as described in :func:`async_client`. Response caching,
+    rate limiting and hedging are presently only available for async
+    clients.
+    """
+    shared = _is_shared(shared, kwargs)
+    _prepare_kwargs(kwargs)
+    if not shared:
+        with _create_sync_client(*args, **kwargs) as client:
             yield client
+        return
+    entry = _acquire_sync_client(args, kwargs)
+    try:
+        yield entry.client
     finally:
-        await client.aclose()
+        _release_client(entry)
+
+
+class FetchResult(object):
+    def __init__(self, index, request, response=None, error=None):
+        """
+        The result of one of the requests made by :func:`fetch_many`.
+
+        :param index: the position of the request in the requests provided.
+        :param request: the request, as it was provided.
+        :param response: the :class:`httpx.Response`, if one was received.
+        :param error: the exception raised by the request, if it failed.
+        """
+        self.index = index
+        self.request = request
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<FetchResult {0} {1}>".format(
+            self.index, self.response if self.ok else repr(self.error))
+
+
+async def _aiterate(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+def _build_request(client, item):
+    if isinstance(item, Request):
+        return item
+    if isinstance(item, dict):
+        kwargs = dict(item)
+        return client.build_request(kwargs.pop('method', 'GET'),
+                                    kwargs.pop('url'), **kwargs)
+    return client.build_request('GET', item)
+
+
+async def _fetch_one(client, index, item, request, timeout,
+                     raise_for_status):
+    try:
+        response = await asyncio.wait_for(client.send(request), timeout)
+        if raise_for_status:
+            response.raise_for_status()
+        return FetchResult(index, item, response)
+    except Exception as e:
+        return FetchResult(index, item, error=e)
+
+
+async def fetch_many(requests, client=None, concurrency=None,
+                     max_per_host=None, timeout=None,
+                     raise_for_status=False, **client_kwargs):
+    """
+    Make each of the ``requests``, no more than ``concurrency`` at a time,
+    of which no more than ``max_per_host`` to any one host at a time.
+
+    This is an async generator, yielding a :class:`FetchResult` for each
+    request as it completes. Requests are only taken from ``requests``
+    as earlier ones complete, so ``requests`` can be a (possibly async)
+    generator of any number of requests, which are made with memory use
+    bounded by ``concurrency``, and no state kept for hosts without
+    requests in flight. Consumers should not hold on to the
+    results they don't need, and should use :attr:`FetchResult.index` to
+    match results to requests if needed.
+
+    Requests to a host which already has ``max_per_host`` requests in
+    flight are held back without counting against ``concurrency``, so
+    that requests to other hosts can proceed in the meantime. Up to
+    ``concurrency`` requests are held back, beyond which no more are
+    taken from ``requests`` until some of them have been made, so that
+    at most twice ``concurrency`` requests are taken but not yet done.
+
+    Failed requests do not interrupt the others. Exceptions raised by a
+    request, including those due to ``timeout``, are captured in the
+    :attr:`FetchResult.error` of its result. If ``raise_for_status`` is
+    True, error responses are treated as failures as well.
+
+    If the consumer stops iterating early, the requests in flight are
+    cancelled when the generator is closed (use
+    :func:`contextlib.aclosing` to have this happen right away).
+
+    :param requests: an iterable or async iterable of requests, each of
+                     which may be a url, an :class:`httpx.Request`, or a
+                     dict of arguments to :meth:`httpx.AsyncClient.request`
+                     (``method``, which defaults to ``GET``, ``url``,
+                     ``params``, ``json``, ``headers``, etc.).
+    :param client: (optional) the :class:`httpx.AsyncClient` to use. If not
+                   provided, one is obtained from :func:`async_client`
+                   using the ``client_kwargs``.
+    :param concurrency: (optional) maximum number of concurrent requests.
+                        Defaults to
+                        :data:`tendril.config.HTTPX_BATCH_CONCURRENCY`.
+    :param max_per_host: (optional) maximum number of concurrent requests
+                         to a single host. Defaults to
+                         :data:`tendril.config.HTTPX_BATCH_MAX_PER_HOST`.
+    :param timeout: (optional) number of seconds after which each request
+                    is abandoned, in addition to the client's own timeouts.
+    :param raise_for_status: whether error responses are failures.
+
+    """
+    if client is None:
+        async with async_client(**client_kwargs) as c:
+            async for result in fetch_many(
+                    requests, c, concurrency, max_per_host,
+                    timeout, raise_for_status):
+                yield result
+        return
+    if concurrency is None:
+        concurrency = HTTPX_BATCH_CONCURRENCY
+    if max_per_host is None:
+        max_per_host = HTTPX_BATCH_MAX_PER_HOST
+
+    # Tasks of the requests in flight, and the hosts they are to.
+    pending = {}
+    # Number of requests in flight to each host, only for hosts with any.
+    in_flight = {}
+    # Requests held back, for each host which has any.
+    held = OrderedDict()
+    n_held = 0
+    source = _aiterate(requests)
+    exhausted = False
+    index = 0
+
+    def start(host, index, item, request):
+        in_flight[host] = in_flight.get(host, 0) + 1
+        pending[asyncio.ensure_future(_fetch_one(
+            client, index, item, request, timeout,
+            raise_for_status))] = host
+
+    try:
+        while True:
+            # Release held requests to hosts which can take them.
+            for host in list(held):
+                queue = held[host]
+                while queue and len(pending) < concurrency and \
+                        in_flight.get(host, 0) < max_per_host:
+                    start(host, *queue.popleft())
+                    n_held -= 1
+                if not queue:
+                    del held[host]
+            while not exhausted and len(pending) < concurrency and \
+                    n_held < concurrency:
+                try:
+                    item = await source.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                args, index = (index, item), index + 1
+                try:
+                    request = _build_request(client, item)
+                except Exception as e:
+                    yield FetchResult(*args, error=e)
+                    continue
+                host = request.url.netloc
+                if host in held or in_flight.get(host, 0) >= max_per_host:
+                    held.setdefault(host, deque()).append(args + (request,))
+                    n_held += 1
+                else:
+                    start(host, *args, request)
+            if not pending:
+                break
+            done, _ = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                host = pending.pop(task)
+                in_flight[host] -= 1
+                if not in_flight[host]:
+                    del in_flight[host]
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await source.aclose()
 
 
 def with_async_client_cl(**client_kwargs):
@@ -96,8 +855,8 @@ def with_async_client_cl(**client_kwargs):
         Such a function would accept 'client' only as a keyword argument
         ``client``, which can be an async client (created by :func:`async_client`)
         provided by the caller. If ``client`` is ``None``, this decorator creates
-        a new client with the provided parameters  and calls the decorated
-        function using it.
+        a client with the provided parameters (see :func:`async_client`) and
+        calls the decorated function using it.
 
         .. seealso:: :func:`async_client`
 
@@ -122,3 +881,38 @@ def with_async_client_cl(**client_kwargs):
                 return result
         return inject_client
     return decorator
+
+
+def with_sync_client_cl(**client_kwargs):
+    """
+    The synchronous counterpart of :func:`with_async_client_cl`, for
+    instance methods which require a sync client, accepted as the keyword
+    argument ``client``. If it is ``None``, a client is obtained from
+    :func:`sync_client` with the provided parameters, and those returned
+    by the instance's ``_sync_http_client_args`` (or, failing that,
+    ``_async_http_client_args``, less any :data:`ASYNC_ONLY_KWARGS`)
+    method, if it has one.
+
+    .. seealso:: :func:`sync_client`
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def inject_client(self, *args, **kwargs):
+            if kwargs.get('client', None) is not None:
+                return func(self, *args, **kwargs)
+            ckw = {}
+            if hasattr(self, '_sync_http_client_args'):
+                ckw.update(self._sync_http_client_args())
+            elif hasattr(self, '_async_http_client_args'):
+                ckw.update((k, v) for k, v in
+                           self._async_http_client_args().items()
+                           if k not in ASYNC_ONLY_KWARGS)
+            ckw.update(client_kwargs)
+            logger.debug("Creating httpx client with args : "
+                         "{}".format(ckw))
+            with sync_client(**ckw) as c:
+                kwargs['client'] = c
+                return func(self, *args, **kwargs)
+        return inject_client
+    return decorator
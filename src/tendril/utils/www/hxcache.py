@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2022 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Response Caching for httpx (:mod:`tendril.utils.www.hxcache`)
+=============================================================
+
+This module provides the :class:`CachingTransport`, an :mod:`httpx` async
+transport implementing a private HTTP cache along the lines of RFC 9111,
+which is used by :func:`tendril.utils.www.hx.async_client` if caching is
+enabled.
+
+- Only ``GET`` responses with a cacheable status are stored, and only if
+  neither the request nor the response has ``Cache-Control: no-store``,
+  the response is not ``private`` and does not ``Vary`` on ``*``.
+- Responses are fresh as per their ``max-age`` or ``Expires``, or, for
+  responses with a ``Last-Modified`` but neither, for a tenth of their
+  age when received (up to a day).
+- Stale responses with an ``ETag`` or ``Last-Modified`` are revalidated
+  using a conditional request, and the stored response is served if the
+  origin responds with ``304``. Responses with ``Cache-Control: no-cache``
+  are always revalidated, as are all responses to requests with
+  ``no-cache`` or ``max-age=0``.
+- A stored response is only used for requests whose headers named by its
+  ``Vary`` match those of the request it was stored for.
+- Successful ``POST``, ``PUT``, ``PATCH`` and ``DELETE`` requests evict the
+  stored response for their url.
+- Requests which carry their own conditional or ``Range`` headers are
+  passed through untouched.
+- The store is shared by all the clients of the process, and the disk
+  store across processes, so requests carrying credentials in their
+  ``Authorization``, ``Proxy-Authorization`` or ``Cookie`` headers are
+  neither served from nor stored in it.
+
+Responses are stored in an :class:`AsyncCacheStore`, either in memory
+(:class:`MemoryStore`) or on disk (:class:`DiskStore`), as per
+:data:`tendril.config.HTTPX_CACHE_BACKEND`.
+
+The internal APIs this backend is primarily used for generally should not
+be cached by the client. Requests to urls starting with any of the prefixes
+in :data:`tendril.config.HTTPX_CACHE_BYPASS`, and requests made with the
+``tendril.cache`` request extension set to False, bypass the cache
+entirely :
+
+.. code-block:: python
+
+    await client.get(url, extensions={'tendril.cache': False})
+
+"""
+
+
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from email.utils import formatdate
+from httpx import AsyncBaseTransport
+from httpx import AsyncByteStream
+from httpx import Request
+from httpx import Response
+
+from tendril.config import INSTANCE_CACHE
+from tendril.config import HTTPX_CACHE_BACKEND
+from tendril.config import HTTPX_CACHE_MEMORY_ENTRIES
+from tendril.config import HTTPX_CACHE_BYPASS
+from tendril.config import HTTPX_CACHE_MAX_BODY_SIZE
+
+from .reqcache import SQLiteCache
+from .tracing import span
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+HTTPX_CACHE = os.path.join(INSTANCE_CACHE, 'httpxcache.db')
+
+#: Statuses which may be stored, per RFC 9110 section 15.1.
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+#: Methods which evict the stored response for their url when successful.
+INVALIDATING_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+#: Request headers with which a request bypasses the cache.
+BYPASS_HEADERS = ('if-none-match', 'if-modified-since', 'if-match',
+                  'if-unmodified-since', 'if-range', 'range')
+
+#: Request headers carrying credentials, with which a request bypasses the
+#: cache, since its responses may not be shared with other clients.
+CREDENTIAL_HEADERS = ('authorization', 'proxy-authorization', 'cookie')
+
+#: Number of seconds stale responses with validators are kept for, so
+#: that they can be revalidated.
+STALE_RETENTION = 14 * 86400
+
+#: Maximum lifetime of a heuristically fresh response.
+MAX_HEURISTIC_LIFETIME = 86400
+
+#: Headers of a ``304`` response which are not merged into the stored
+#: response.
+_EXCLUDED_304_HEADERS = ('content-length', 'content-encoding',
+                         'transfer-encoding')
+
+
+class AsyncCacheStore(object):
+    """
+    The interface of the stores used by the :class:`CachingTransport`. Keys
+    are strings and values are bytes. Entries may be dropped by the store
+    at any time, and are dropped once ``expires`` seconds have passed since
+    they were stored, if it is provided.
+    """
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, expires=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class MemoryStore(AsyncCacheStore):
+    def __init__(self, max_entries=1000):
+        """
+        An :class:`AsyncCacheStore` keeping up to ``max_entries`` of the
+        most recently used entries in memory.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    async def set(self, key, value, expires=None):
+        expiry = time.time() + expires if expires else None
+        with self._lock:
+            self._entries[key] = (value, expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DiskStore(AsyncCacheStore):
+    def __init__(self, path):
+        """
+        An :class:`AsyncCacheStore` keeping entries in a SQLite database at
+        ``path``, using a :class:`tendril.utils.www.reqcache.SQLiteCache`.
+        Database access is done in the event loop's default executor, so
+        as not to block the loop.
+        """
+        self._cache = SQLiteCache(path)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def get(self, key):
+        return await self._run(self._cache.get, key)
+
+    async def set(self, key, value, expires=None):
+        await self._run(self._cache.set, key, value, expires)
+
+    async def delete(self, key):
+        await self._run(self._cache.delete, key)
+
+
+def parse_cache_control(value):
+    """
+    Parse a ``Cache-Control`` header value into a dict mapping (lowercase)
+    directive names to their values, which are None for directives
+    without one and ints for those with numeric values.
+    """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, arg = directive.strip().partition('=')
+        if not name:
+            continue
+        arg = arg.strip().strip('"') or None
+        if arg is not None and arg.isdigit():
+            arg = int(arg)
+        directives[name.lower()] = arg
+    return directives
+
+
+def _parse_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+class _Entry(object):
+    """
+    A response stored in the cache, along with the values of the request
+    headers it varies on, and the time it was received.
+    """
+    def __init__(self, status, headers, body, vary, stored_at):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.vary = vary
+        self.stored_at = stored_at
+
+    def dumps(self):
+        meta = json.dumps({'status': self.status, 'headers': self.headers,
+                           'vary': self.vary, 'stored_at': self.stored_at})
+        return meta.encode('utf-8') + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, data):
+        meta, _, body = data.partition(b'\n')
+        try:
+            meta = json.loads(meta.decode('utf-8'))
+        except ValueError:
+            return None
+        return cls(meta['status'], meta['headers'], body,
+                   meta['vary'], meta['stored_at'])
+
+    def get_header(self, name):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(self.get_header('cache-control'))
+
+    @property
+    def has_validators(self):
+        return bool(self.get_header('etag') or
+                    self.get_header('last-modified'))
+
+    @property
+    def freshness_lifetime(self):
+        cc = self.cache_control
+        if isinstance(cc.get('max-age'), int):
+            return cc['max-age']
+        date = _parse_date(self.get_header('date')) or self.stored_at
+        if self.get_header('expires') is not None:
+            expires = _parse_date(self.get_header('expires'))
+            return max(0, expires - date) if expires else 0
+        last_modified = _parse_date(self.get_header('last-modified'))
+        if last_modified is not None:
+            return min(MAX_HEURISTIC_LIFETIME,
+                       max(0, (date - last_modified) / 10))
+        return 0
+
+    def get_age(self, now):
+        date = _parse_date(self.get_header('date')) or self.stored_at
+        try:
+            age = int(self.get_header('age') or 0)
+        except ValueError:
+            age = 0
+        initial_age = max(age, self.stored_at - date, 0)
+        return initial_age + (now - self.stored_at)
+
+    def is_fresh(self, now):
+        if 'no-cache' in self.cache_control:
+            return False
+        return self.freshness_lifetime > self.get_age(now)
+
+    def matches(self, request):
+        return all(request.headers.get(name) == value
+                   for name, value in self.vary.items())
+
+    def to_response(self, request, now):
+        headers = [(k, v) for k, v in self.headers if k.lower() != 'age']
+        headers.append(('Age', str(int(self.get_age(now)))))
+        return Response(self.status, headers=headers, content=self.body,
+                        request=request, extensions={'tendril.cache': 'hit'})
+
+
+class _ReplayStream(AsyncByteStream):
+    """
+    The stream of a response whose body was partially read while checking
+    whether it could be cached, which replays the chunks already read
+    before those still to come from the original stream.
+    """
+    def __init__(self, chunks, iterator, stream):
+        self._chunks = chunks
+        self._iterator = iterator
+        self._stream = stream
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+        async for chunk in self._iterator:
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+
+class CachingTransport(AsyncBaseTransport):
+    def __init__(self, transport, store, bypass=None,
+                 max_body_size=None):
+        """
+        An :mod:`httpx` async transport wrapping another, which caches
+        responses in the ``store`` as described in
+        :mod:`tendril.utils.www.hxcache`.
+
+        :param transport: the transport to wrap.
+        :param store: the :class:`AsyncCacheStore` to use.
+        :param bypass: (optional) url prefixes which are never cached.
+                       Defaults to :data:`tendril.config.HTTPX_CACHE_BYPASS`.
+        :param max_body_size: (optional) size in bytes of the largest body
+                              which is stored. Defaults to
+                              :data:`tendril.config.HTTPX_CACHE_MAX_BODY_SIZE`.
+
+        """
+        self._transport = transport
+        self.store = store
+        self.bypass = tuple(HTTPX_CACHE_BYPASS if bypass is None else bypass)
+        self.max_body_size = HTTPX_CACHE_MAX_BODY_SIZE \
+            if max_body_size is None else max_body_size
+
+    def _is_bypassed(self, request):
+        if request.extensions.get('tendril.cache', True) is False:
+            return True
+        if str(request.url).startswith(self.bypass):
+            return True
+        return any(h in request.headers for h in BYPASS_HEADERS)
+
+    @staticmethod
+    def _get_key(request):
+        return str(request.url)
+
+    async def _load(self, key, request):
+        with span('cache.get', url=request.url, backend='hx') as s:
+            data = await self.store.get(key)
+            s.set_attribute('hit', data is not None)
+        if data is None:
+            return None
+        entry = _Entry.loads(data)
+        if entry is None or not entry.matches(request):
+            return None
+        return entry
+
+    async def _store(self, key, entry):
+        if entry.has_validators:
+            expires = max(entry.freshness_lifetime, STALE_RETENTION)
+        else:
+            expires = entry.freshness_lifetime
+        if expires > 0:
+            with span('cache.set', url=key, backend='hx'):
+                await self.store.set(key, entry.dumps(), expires=int(expires))
+
+    def _is_storable(self, request, response):
+        if response.status_code not in CACHEABLE_STATUSES:
+            return False
+        if 'no-store' in parse_cache_control(
+                request.headers.get('cache-control')):
+            return False
+        response_cc = parse_cache_control(
+            response.headers.get('cache-control'))
+        if 'no-store' in response_cc or 'private' in response_cc:
+            return False
+        if '*' in response.headers.get('vary', ''):
+            return False
+        length = response.headers.get('content-length')
+        if length is not None and int(length) > self.max_body_size:
+            return False
+        return True
+
+    async def _read_body(self, response):
+        """
+        Read the raw body of the ``response``, up to the maximum body size.
+        Returns the body, or None along with a replacement for the response
+        if the body turned out to be too large.
+        """
+        chunks = []
+        size = 0
+        iterator = response.stream.__aiter__()
+        async for chunk in iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None, Response(
+                    response.status_code, headers=response.headers,
+                    stream=_ReplayStream(chunks, iterator, response.stream),
+                    extensions=response.extensions)
+        await response.stream.aclose()
+        return b''.join(chunks), None
+
+    async def _cache_response(self, key, request, response, now):
+        body, passthrough = await self._read_body(response)
+        if body is None:
+            return passthrough
+        vary = {}
+        for name in response.headers.get('vary', '').split(','):
+            name = name.strip().lower()
+            if name:
+                vary[name] = request.headers.get(name)
+        entry = _Entry(response.status_code,
+                       list(response.headers.multi_items()),
+                       body, vary, now)
+        await self._store(key, entry)
+        return entry.to_response(request, now)
+
+    async def _revalidate(self, key, request, entry, now):
+        headers = [(k, v) for k, v in request.headers.multi_items()]
+        if entry.get_header('etag'):
+            headers.append(('If-None-Match', entry.get_header('etag')))
+        if entry.get_header('last-modified'):
+            headers.append(('If-Modified-Since',
+                            entry.get_header('last-modified')))
+        conditional = Request(request.method, request.url, headers=headers,
+                              stream=request.stream,
+                              extensions=request.extensions)
+        response = await self._transport.handle_async_request(conditional)
+        if response.status_code != 304:
+            return response
+        await response.aread()
+        await response.aclose()
+        logger.debug("Revalidated {0}".format(request.url))
+        updated = dict((k.lower(), (k, v)) for k, v in response.headers.items()
+                       if k.lower() not in _EXCLUDED_304_HEADERS)
+        entry.headers = [updated.pop(k.lower(), (k, v))
+                         for k, v in entry.headers] + list(updated.values())
+        if entry.get_header('date') is None:
+            entry.headers.append(('Date', formatdate(now, usegmt=True)))
+        entry.stored_at = now
+        await self._store(key, entry)
+        return entry.to_response(request, now)
+
+    async def handle_async_request(self, request):
+        if self._is_bypassed(request):
+            return await self._transport.handle_async_request(request)
+
+        key = self._get_key(request)
+        if request.method in INVALIDATING_METHODS:
+            response = await self._transport.handle_async_request(request)
+            if response.status_code < 400:
+                await self.store.delete(key)
+            return response
+        if request.method != 'GET' or \
+                any(h in request.headers for h in CREDENTIAL_HEADERS):
+            return await self._transport.handle_async_request(request)
+
+        now = time.time()
+        cc = parse_cache_control(request.headers.get('cache-control'))
+        entry = None
+        if 'no-store' not in cc:
+            entry = await self._load(key, request)
+        if entry is not None:
+            if entry.is_fresh(now) and 'no-cache' not in cc and \
+                    cc.get('max-age') != 0:
+                logger.debug("Cache HIT for {0}".format(request.url))
+                return entry.to_response(request, now)
+            if entry.has_validators:
+                response = await self._revalidate(key, request, entry, now)
+            else:
+                response = await self._transport.handle_async_request(
+                    request)
+        else:
+            response = await self._transport.handle_async_request(request)
+
+        if response.extensions.get('tendril.cache') == 'hit':
+            return response
+        if self._is_storable(request, response):
+            return await self._cache_response(key, request, response, now)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(backend=None):
+    """
+    Return the process-wide :class:`AsyncCacheStore` for the ``backend``,
+    which is one of ``'memory'`` or ``'disk'`` and defaults to
+    :data:`tendril.config.HTTPX_CACHE_BACKEND`. Returns None if caching is
+    disabled.
+    """
+    if backend is None:
+        backend = HTTPX_CACHE_BACKEND
+    if not backend:
+        return None
+    with _stores_lock:
+        if backend not in _stores:
+            if backend == 'memory':
+                _stores[backend] = MemoryStore(HTTPX_CACHE_MEMORY_ENTRIES)
+            elif backend == 'disk':
+                _stores[backend] = DiskStore(HTTPX_CACHE)
+            else:
+                raise ValueError("Unrecognized httpx cache backend "
+                                 "{0}".format(backend))
+        return _stores[backend]
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Retries and Hedged Requests for httpx (:mod:`tendril.utils.www.hxresilience`)
+=============================================================================
+
+This module provides :mod:`httpx` async transports which make the httpx
+based backend (:mod:`tendril.utils.www.hx`) more resilient.
+
+- :class:`RetryingTransport` retries requests which fail with a transient
+  error, as per a :class:`tendril.utils.www.resilience.RetryPolicy`, in
+  the same way as the synchronous backends do. See
+  :mod:`tendril.utils.www.resilience`. Only requests which are safe to
+  repeat are retried.
+
+- :class:`HedgingTransport` reduces tail latency when a server has slow
+  replicas. If the response to a request has not arrived within the
+  time in which most responses from the host do (by default, the 95th
+  percentile of recent response times), a duplicate request is sent,
+  and whichever response arrives first is used. This costs a few percent
+  more requests. How often hedged requests win is recorded in the
+  :class:`HedgeStats` of each host, see :func:`get_hedge_stats`.
+
+Clients from :func:`tendril.utils.www.hx.async_client` retry requests by
+default (see :data:`tendril.config.HTTPX_RETRY`), and hedge requests if
+:data:`tendril.config.HTTPX_HEDGING` is set or the client is created with
+``hedge=True``.
+
+"""
+
+
+import time
+import asyncio
+import threading
+from collections import deque
+from httpx import BaseTransport
+from httpx import AsyncBaseTransport
+from httpx import ByteStream
+from httpx import Request
+from httpx import TransportError
+from httpx import ConnectError
+from httpx import ConnectTimeout
+from httpx import PoolTimeout
+
+from tendril.config import HTTPX_HEDGE_QUANTILE
+from tendril.config import HTTPX_HEDGE_MIN_SAMPLES
+
+from .resilience import default_policy
+from .resilience import get_host
+from .resilience import parse_retry_after
+from .ratelimit import RateLimitingTransport
+from .ratelimit import ON_SEND_EXTENSION
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+#: Methods which can be safely repeated, as per RFC 9110.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE',
+                                'PUT', 'DELETE'])
+
+#: Exceptions which guarantee the request was not sent, so that even
+#: requests which are not idempotent can be retried.
+UNSENT_ERRORS = (ConnectError, ConnectTimeout, PoolTimeout)
+
+
+def _is_replayable(request):
+    return isinstance(request.stream, ByteStream)
+
+
+def _is_idempotent(request):
+    return request.method in IDEMPOTENT_METHODS or \
+        'idempotency-key' in request.headers
+
+
+class RetryingTransport(BaseTransport, AsyncBaseTransport):
+    def __init__(self, transport, policy=None):
+        """
+        An :mod:`httpx` transport wrapping another (sync or async one),
+        which retries requests failing with a transport error or one of
+        the ``statuses`` of the ``policy``, with a jittered exponential
+        backoff between attempts. A ``Retry-After`` sent by the server is
+        honoured.
+
+        Idempotent requests (those using one of the
+        :data:`IDEMPOTENT_METHODS`, or having an ``Idempotency-Key``
+        header) are retried for all such failures. Other requests are
+        only retried if they could not be sent at all. Requests with
+        streaming bodies are never retried, since the body can't be sent
+        again. When retries on a status are exhausted, the final response
+        is returned.
+
+        :param transport: the transport to wrap.
+        :param policy: (optional) the
+                       :class:`tendril.utils.www.resilience.RetryPolicy`
+                       to use. Defaults to
+                       :data:`tendril.utils.www.resilience.default_policy`.
+
+        """
+        self._transport = transport
+        self.policy = policy or default_policy
+
+    def _get_error_delay(self, request, error, attempt):
+        """
+        Return the delay before retrying the ``request`` after the
+        ``error``, or None if it should not be retried.
+        """
+        if attempt >= self.policy.retries or \
+                not _is_replayable(request) or \
+                not (_is_idempotent(request) or
+                     isinstance(error, UNSENT_ERRORS)):
+            return None
+        delay = self.policy.get_backoff(attempt)
+        logger.info("Retrying {0} in {1:.2f}s after : {2!r}".format(
+            request.url, delay, error))
+        return delay
+
+    def _get_status_delay(self, request, response, attempt):
+        """
+        Return the delay before retrying the ``request`` after the
+        ``response``, or None if the response should be returned.
+        """
+        if response.status_code not in self.policy.statuses or \
+                attempt >= self.policy.retries or \
+                not (_is_replayable(request) and _is_idempotent(request)):
+            return None
+        delay = self.policy.get_backoff(attempt, parse_retry_after(
+            response.headers.get('Retry-After')))
+        logger.info("Retrying {0} in {1:.2f}s after status {2}".format(
+            request.url, delay, response.status_code))
+        return delay
+
+    def handle_request(self, request):
+        attempt = 0
+        while True:
+            try:
+                response = self._transport.handle_request(request)
+            except TransportError as e:
+                delay = self._get_error_delay(request, e, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = self._get_status_delay(request, response, attempt)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def handle_async_request(self, request):
+        attempt = 0
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except TransportError as e:
+                delay = self._get_error_delay(request, e, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = self._get_status_delay(request, response, attempt)
+                if delay is None:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self._transport.close()
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class HedgeStats(object):
+    def __init__(self, host):
+        """
+        Counters of the hedged requests made to a host.
+
+        :ivar requests: number of requests which could have been hedged.
+        :ivar hedged: number of requests for which a hedge was sent.
+        :ivar hedge_wins: number of hedged requests for which the hedge's
+                          response was used.
+        """
+        self.host = host
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @property
+    def hedge_rate(self):
+        return self.hedged / self.requests if self.requests else 0
+
+    @property
+    def win_rate(self):
+        return self.hedge_wins / self.hedged if self.hedged else 0
+
+    def __repr__(self):
+        return "<HedgeStats {0} requests={1} hedged={2} " \
+               "hedge_wins={3}>".format(self.host, self.requests,
+                                        self.hedged, self.hedge_wins)
+
+
+_hedge_stats = {}
+_hedge_stats_lock = threading.Lock()
+
+
+def get_hedge_stats(host=None):
+    """
+    Return the process-wide :class:`HedgeStats` of the ``host``, or a
+    dictionary of those of all hosts if ``host`` is None.
+    """
+    if host is None:
+        return dict(_hedge_stats)
+    try:
+        return _hedge_stats[host]
+    except KeyError:
+        with _hedge_stats_lock:
+            return _hedge_stats.setdefault(host, HedgeStats(host))
+
+
+class _LatencyTracker(object):
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+
+    def record(self, latency):
+        self.samples.append(latency)
+
+    def quantile(self, q):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class HedgingTransport(AsyncBaseTransport):
+    def __init__(self, transport, delay=None, quantile=None,
+                 min_samples=None, window=200):
+        """
+        An :mod:`httpx` async transport wrapping another, which hedges
+        idempotent requests. If no response to a request has arrived
+        within the hedging delay, a duplicate request is sent, and the
+        first response to arrive is used. The other request is
+        cancelled.
+
+        The delay is ``delay`` seconds if provided. Otherwise, it is the
+        ``quantile`` of the latencies of the last ``window`` responses
+        from the host, and requests are only hedged once there are
+        ``min_samples`` of them. Latencies are measured to the arrival of
+        the response headers, from when the request is let through by the
+        rate limiters if the wrapped transport is a
+        :class:`tendril.utils.www.ratelimit.RateLimitingTransport`, so
+        that requests held back by the limiters are not hedged.
+
+        :param transport: the transport to wrap.
+        :param delay: (optional) fixed hedging delay, in seconds.
+        :param quantile: (optional) quantile of the response latencies to
+                         use as the hedging delay. Defaults to
+                         :data:`tendril.config.HTTPX_HEDGE_QUANTILE`.
+        :param min_samples: (optional) minimum number of responses from a
+                            host needed to hedge requests to it. Defaults
+                            to :data:`tendril.config.HTTPX_HEDGE_MIN_SAMPLES`.
+        :param window: number of recent responses from each host to
+                       compute the quantile over.
+
+        """
+        self._transport = transport
+        self.delay = delay
+        self.quantile = HTTPX_HEDGE_QUANTILE if quantile is None \
+            else quantile
+        self.min_samples = HTTPX_HEDGE_MIN_SAMPLES if min_samples is None \
+            else min_samples
+        self.window = window
+        self._latencies = {}
+
+    def _get_delay(self, host):
+        if self.delay is not None:
+            return self.delay
+        tracker = self._latencies.get(host)
+        if tracker is None or len(tracker.samples) < self.min_samples:
+            return None
+        return tracker.quantile(self.quantile)
+
+    def _record(self, host, latency):
+        if host not in self._latencies:
+            self._latencies[host] = _LatencyTracker(self.window)
+        self._latencies[host].record(latency)
+
+    def _attempt(self, request, host):
+        """
+        Start an attempt at sending the ``request``. Returns its task, and
+        an event which is set once the request has been let through by the
+        rate limiters, from when its latency is measured.
+        """
+        sent = asyncio.Event()
+        start = []
+
+        def on_send():
+            if not start:
+                start.append(time.monotonic())
+                sent.set()
+
+        extensions = dict(request.extensions)
+        extensions[ON_SEND_EXTENSION] = on_send
+        request = Request(request.method, request.url,
+                          headers=request.headers, stream=request.stream,
+                          extensions=extensions)
+        if not isinstance(self._transport, RateLimitingTransport):
+            on_send()
+
+        async def send():
+            response = await self._transport.handle_async_request(request)
+            self._record(host, time.monotonic() - start[0])
+            return response
+
+        return asyncio.ensure_future(send()), sent
+
+    @staticmethod
+    async def _discard(tasks):
+        # Cancel the tasks, and close any responses which arrived anyway.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is None:
+                await task.result().aclose()
+
+    async def _wait_primary(self, primary, sent, delay):
+        """
+        Wait for up to ``delay`` seconds after the ``primary`` request is
+        sent for it to complete. Returns whether it has.
+        """
+        waiter = asyncio.ensure_future(sent.wait())
+        try:
+            await asyncio.wait([primary, waiter],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if not primary.done():
+            await asyncio.wait([primary], timeout=delay)
+        return primary.done()
+
+    async def handle_async_request(self, request):
+        if not (_is_replayable(request) and _is_idempotent(request)):
+            return await self._transport.handle_async_request(request)
+        host = get_host(str(request.url))
+        stats = get_hedge_stats(host)
+        stats.requests += 1
+        delay = self._get_delay(host)
+        primary, sent = self._attempt(request, host)
+        if delay is None:
+            return await primary
+        try:
+            if await self._wait_primary(primary, sent, delay):
+                return primary.result()
+        except asyncio.CancelledError:
+            # Don't leave the primary running, holding a connection.
+            await self._discard([primary])
+            raise
+
+        stats.hedged += 1
+        logger.debug("Hedging request to {0} after {1:.3f}s".format(
+            request.url, delay))
+        hedge, _ = self._attempt(request, host)
+        pending = {primary, hedge}
+        winner = None
+        try:
+            while winner is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                else:
+                    if not pending:
+                        # Both failed. Raise the primary's error.
+                        return primary.result()
+            if winner is hedge:
+                stats.hedge_wins += 1
+            return winner.result()
+        finally:
+            await self._discard(
+                [t for t in (primary, hedge) if t is not winner])
+
+    async def aclose(self):
+        await self._transport.aclose()
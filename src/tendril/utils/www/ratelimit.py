@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Async Rate Limiting (:mod:`tendril.utils.www.ratelimit`)
+========================================================
+
+Vendor APIs typically limit both the rate of requests (some number per
+second) and the total number of requests per hour or per day. This module
+provides an :class:`AsyncRateLimiter` enforcing such limits across all
+the tasks (and threads) using it, and a :class:`RateLimitingTransport`
+applying it to :mod:`httpx` clients.
+
+Tasks do not wait on each other. Each request reserves the earliest time
+at which it may be sent, and only sleeps until that time, so concurrent
+requests are spaced out as the limits require and are otherwise sent
+concurrently.
+
+Limiters are registered per host, and the clients from
+:func:`tendril.utils.www.hx.async_client` apply the limiter registered
+for the host of each request they make. The registry is populated from
+:data:`tendril.config.HTTPX_RATE_LIMITS` when this module is imported,
+and further limiters can be registered using :func:`register_rate_limiter`.
+For example, to send at most 5 requests per second (in bursts of up to
+10), 1000 per hour and 10000 per day to a vendor's API :
+
+.. code-block:: python
+
+    HTTPX_RATE_LIMITS = {
+        'api.example.com': {
+            'rate': 5, 'burst': 10,
+            'quotas': [[1000, 3600], [10000, 86400]],
+        },
+    }
+
+"""
+
+
+import time
+import asyncio
+import threading
+from collections import deque
+from httpx import AsyncBaseTransport
+
+from tendril.config import HTTPX_RATE_LIMITS
+
+from .resilience import get_host
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+class _Quota(object):
+    def __init__(self, count, period):
+        # The times of the requests in the last period, including those
+        # reserved for the future. There are never more than count.
+        self.count = count
+        self.period = period
+        self.sent = deque()
+
+    def earliest(self, now):
+        while self.sent and self.sent[0] <= now - self.period:
+            self.sent.popleft()
+        if len(self.sent) < self.count:
+            return now
+        return self.sent[-self.count] + self.period
+
+    def reserve(self, at):
+        self.sent.append(at)
+        if len(self.sent) > self.count:
+            self.sent.popleft()
+
+
+class AsyncRateLimiter(object):
+    def __init__(self, rate=None, burst=None, quotas=None, name=None):
+        """
+        An asyncio rate limiter, combining a token bucket limiting the
+        rate of requests with sliding window quotas limiting the number
+        of requests in longer periods.
+
+        A single limiter can be shared by any number of tasks, including
+        those of different threads and event loops. Requests are let
+        through in the order in which they call :meth:`acquire`.
+
+        A request which is cancelled while waiting still counts against
+        the limits.
+
+        :param rate: (optional) maximum sustained number of requests per
+                     second.
+        :param burst: (optional) maximum number of requests sent at once,
+                      if there have been no requests for a while. Defaults
+                      to ``rate``, or 1 if ``rate`` is less than 1.
+        :param quotas: (optional) a list of ``(count, period)`` tuples,
+                       each allowing no more than ``count`` requests in
+                       any ``period`` seconds.
+        :param name: (optional) a name for the limiter, used in logs.
+
+        """
+        self.rate = rate
+        self.burst = max(1, int(rate or 1)) if burst is None else burst
+        self.name = name
+        self._quotas = [_Quota(count, period)
+                        for count, period in (quotas or [])]
+        # Theoretical arrival time of the token bucket, as in GCRA.
+        self._tat = 0
+        self._last = 0
+        self._lock = threading.Lock()
+
+    @property
+    def quotas(self):
+        return [(q.count, q.period) for q in self._quotas]
+
+    def reserve(self):
+        """
+        Reserve the earliest time at which a request may be sent, and
+        return the number of seconds until then.
+        """
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._last)
+            if self.rate:
+                interval = 1.0 / self.rate
+                at = max(at, self._tat - (self.burst - 1) * interval)
+            for quota in self._quotas:
+                at = max(at, quota.earliest(now))
+            if self.rate:
+                self._tat = max(self._tat, at) + interval
+            for quota in self._quotas:
+                quota.reserve(at)
+            self._last = at
+            return at - now
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent, as per the limits.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            logger.debug("Rate limiting {0} for {1:.3f}s".format(
+                self.name or 'request', delay))
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __repr__(self):
+        return "<AsyncRateLimiter {0} rate={1} burst={2} quotas={3}>".format(
+            self.name, self.rate, self.burst, self.quotas)
+
+
+#: The registry of :class:`AsyncRateLimiter` instances, keyed by host.
+rate_limiters = {}
+
+
+def register_rate_limiter(host, limiter):
+    """
+    Register the :class:`AsyncRateLimiter` ``limiter`` for requests to
+    ``host`` (as returned by :func:`tendril.utils.www.resilience.get_host`),
+    replacing any limiter previously registered for it.
+    """
+    rate_limiters[host.lower()] = limiter
+
+
+def get_rate_limiter(url):
+    """
+    Return the :class:`AsyncRateLimiter` registered for the host of the
+    ``url``, or None if there isn't one.
+    """
+    return rate_limiters.get(get_host(url))
+
+
+#: Name of the request extension which may hold a callable, which is
+#: called by :class:`RateLimitingTransport` when it lets the request
+#: through. Used by :class:`tendril.utils.www.hxresilience.HedgingTransport`
+#: so that time spent waiting on the limiters is not mistaken for latency.
+ON_SEND_EXTENSION = 'tendril.on_send'
+
+
+class RateLimitingTransport(AsyncBaseTransport):
+    def __init__(self, transport, limiter=None):
+        """
+        An :mod:`httpx` async transport wrapping another, which waits as
+        required by the :class:`AsyncRateLimiter` registered for the host
+        of each request before sending it.
+
+        :param transport: the transport to wrap.
+        :param limiter: (optional) an :class:`AsyncRateLimiter` applied to
+                        all requests, in addition to the per-host ones.
+
+        """
+        self._transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request):
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        limiter = get_rate_limiter(str(request.url))
+        if limiter is not None:
+            await limiter.acquire()
+        on_send = request.extensions.get(ON_SEND_EXTENSION)
+        if on_send is not None:
+            on_send()
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _load_rate_limiters():
+    for host, params in HTTPX_RATE_LIMITS.items():
+        try:
+            register_rate_limiter(host, AsyncRateLimiter(name=host, **params))
+        except TypeError as e:
+            logger.warning("Ignoring invalid rate limit for {0} : "
+                           "{1}".format(host, e))
+
+
+_load_rate_limiters()
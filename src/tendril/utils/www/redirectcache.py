@@ -22,79 +22,375 @@
 Redirect Caching Infrastructure (:mod:`tendril.utils.www.redirectcaching`)
 ==========================================================================
 
-TODO Some introduction
+Redirects learned by the www backends are stored in a small SQLite
+database (:data:`REDIR_CACHE_FILE`) in the ``INSTANCE_CACHE`` folder,
+wrapped by the dict-like :class:`RedirectStore` available as
+:data:`redirect_cache`.
+
+- The database is only opened when it is first used.
+- Each new redirect is written to the database as soon as it is learned,
+  so nothing is lost if the process dies, and multiple processes can
+  share the store safely.
+- Redirects older than :data:`tendril.config.REDIRECT_CACHE_TTL` seconds,
+  if set, are ignored, and are purged from the database when each process
+  first opens it.
+- Individual redirects can be dropped with
+  :func:`RedirectStore.invalidate`.
+- Urls are resolved to their final targets by :func:`RedirectStore.resolve`
+  using a per-process in-memory index, so that repeated resolution does
+  not touch the database. Chains of redirects are collapsed to their final
+  target when first resolved, and redirect cycles are detected and
+  dropped.
+
+All the www backends resolve urls using :func:`get_actual_url` before
+making a request, and record the permanent redirects they encounter with
+:func:`record_redirect`. As the clients themselves do when following
+redirects, the credentials of a request (see :data:`CREDENTIAL_HEADERS`)
+are dropped if the url resolves to a different origin. See
+:func:`is_same_origin`.
+
+A redirect cache in the legacy pickle format (``redirects.p``) is imported
+into the database the first time it is opened, and then removed.
 
 """
 
 
 import os
-import atexit
+import time
+import threading
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from six.moves.urllib.parse import urljoin
+from six.moves.urllib.parse import urlsplit
 from six.moves.urllib.request import HTTPRedirectHandler
 
 from tendril.config import INSTANCE_CACHE
 from tendril.config import ENABLE_REDIRECT_CACHING
+from tendril.config import REDIRECT_CACHE_TTL
+
+from .caching import SQLiteStoreBase
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.WARNING)
 
 
-REDIR_CACHE_FILE = os.path.join(INSTANCE_CACHE, 'redirects.p')
+REDIR_CACHE_FILE = os.path.join(INSTANCE_CACHE, 'redirects.db')
+LEGACY_REDIR_CACHE_FILE = os.path.join(INSTANCE_CACHE, 'redirects.p')
 
+#: Maximum number of cached redirects followed when resolving a url.
+MAX_REDIRECT_HOPS = 30
 
-logger.info("Initializing Redirect Caching")
-try:
-    with open(REDIR_CACHE_FILE, "rb") as rdcf:
-        redirect_cache = pickle.load(rdcf)
-    logger.info('Loaded Redirect Cache from file')
-except EOFError:
-    os.remove(REDIR_CACHE_FILE)
-    redirect_cache = {}
-    logger.warning('Discarded Corrupt Redirect Cache')
-except (IOError, FileNotFoundError):
-    redirect_cache = {}
-    logger.info('Created new Redirect Cache')
-
-
-def dump_redirect_cache():
-    """
-    Called during python interpreter shutdown, this function dumps the
-    redirect cache to the file system.
-    """
-    if DUMP_REDIR_CACHE_ON_EXIT:
-        with open(REDIR_CACHE_FILE, 'wb') as f:
-            pickle.dump(redirect_cache, f, protocol=2)
-        logger.info('Dumping Redirect Cache to file')
+#: Status codes of the redirects cached by the requests and httpx
+#: backends, see :func:`record_redirect`.
+PERMANENT_REDIRECT_STATUSES = (301, 308)
+
+#: Request headers which are dropped when a url resolves to a different
+#: origin, see :func:`is_same_origin`.
+CREDENTIAL_HEADERS = ('authorization', 'proxy-authorization', 'cookie')
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class RedirectStore(SQLiteStoreBase, MutableMapping):
+    #: Number of urls held in the in-memory index before it is reset.
+    index_limit = 1000000
+
+    def __init__(self, path, ttl=None, legacy_path=None):
+        """
+        A persistent, dict-like mapping of urls to the urls they redirect
+        to, backed by a SQLite database.
+
+        Every write is committed immediately. Connections to the
+        database are managed as described in
+        :class:`tendril.utils.www.caching.SQLiteStoreBase`.
+
+        Resolution of urls to their final targets (see :func:`resolve`)
+        is served from an in-memory index of previously resolved urls,
+        shared by all threads of the process. This index is kept in sync
+        with writes made through this instance, but does not see
+        redirects learned by other processes for urls it has already
+        resolved.
 
+        :param path: path to the SQLite database file.
+        :param ttl: (optional) number of seconds after which a stored
+                    redirect is considered expired.
+        :param legacy_path: (optional) path to a pickled redirect dict
+                            to import into the store when it is first
+                            opened.
 
-if ENABLE_REDIRECT_CACHING:
-    DUMP_REDIR_CACHE_ON_EXIT = True
-else:
-    DUMP_REDIR_CACHE_ON_EXIT = False
+        """
+        SQLiteStoreBase.__init__(self, path)
+        self.ttl = ttl
+        self.legacy_path = legacy_path
+        # url -> (final target, expiry) and final target -> {urls}
+        self._index = {}
+        self._reverse = {}
+        self._index_lock = threading.RLock()
+        # The process which last purged expired redirects.
+        self._purged_by = None
+
+    def _setup(self, conn):
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS redirects ('
+                         'url TEXT PRIMARY KEY, '
+                         'target TEXT NOT NULL, '
+                         'created REAL NOT NULL)')
+        self._import_legacy(conn)
+        if self._purged_by != os.getpid():
+            self._purged_by = os.getpid()
+            self._purge(conn)
+        logger.info("Opened Redirect Cache at {0}".format(self.path))
+
+    def _purge(self, conn):
+        if self.ttl is None:
+            return
+        with conn:
+            conn.execute('DELETE FROM redirects WHERE created < ?',
+                         (self._horizon(),))
+
+    def _import_legacy(self, conn):
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'rb') as f:
+                legacy = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            logger.warning('Discarding Corrupt Legacy Redirect Cache')
+            legacy = {}
+        except (IOError, OSError):
+            return
+        now = time.time()
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO redirects VALUES (?, ?, ?)',
+                [(k, v, now) for k, v in legacy.items()]
+            )
+        try:
+            os.remove(self.legacy_path)
+        except OSError:
+            pass
+        logger.info('Imported {0} redirects from Legacy Redirect Cache'
+                    ''.format(len(legacy)))
+
+    def _horizon(self):
+        if self.ttl is None:
+            return 0
+        return time.time() - self.ttl
+
+    def _lookup(self, url):
+        row = self._conn.execute(
+            'SELECT target, created FROM redirects '
+            'WHERE url = ? AND created >= ?',
+            (url, self._horizon())
+        ).fetchone()
+        if row is None:
+            return None, None
+        return row
+
+    def __getitem__(self, url):
+        target, _ = self._lookup(url)
+        if target is None:
+            raise KeyError(url)
+        return target
+
+    def __setitem__(self, url, target):
+        with self._conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)',
+                (url, target, time.time())
+            )
+        self._index_redirect(url)
+
+    def __delitem__(self, url):
+        with self._conn as conn:
+            cursor = conn.execute('DELETE FROM redirects WHERE url = ?',
+                                  (url,))
+        self.reset_index()
+        if not cursor.rowcount:
+            raise KeyError(url)
 
-if ENABLE_REDIRECT_CACHING is True:
-    atexit.register(dump_redirect_cache)
+    def __contains__(self, url):
+        try:
+            self[url]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        rows = self._conn.execute(
+            'SELECT url FROM redirects WHERE created >= ?',
+            (self._horizon(),)
+        ).fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM redirects WHERE created >= ?',
+            (self._horizon(),)
+        ).fetchone()[0]
+
+    def invalidate(self, url):
+        """
+        Forget any redirect from the ``url``, as well as any redirects
+        which lead to it.
+        """
+        with self._conn as conn:
+            conn.execute('DELETE FROM redirects WHERE url = ? OR target = ?',
+                         (url, url))
+        self.reset_index()
+
+    def purge_expired(self):
+        """
+        Remove expired redirects from the database. This is done when
+        each process first opens the database.
+        """
+        self._purge(self._conn)
+        self.reset_index()
+
+    def clear(self):
+        with self._conn as conn:
+            conn.execute('DELETE FROM redirects')
+        self.reset_index()
+
+    def reset_index(self):
+        """
+        Discard the in-memory resolution index.
+        """
+        with self._index_lock:
+            self._index = {}
+            self._reverse = {}
+
+    def _set_index(self, url, final, expiry):
+        if len(self._index) >= self.index_limit:
+            self.reset_index()
+        old = self._index.get(url)
+        if old is not None:
+            self._reverse.get(old[0], set()).discard(url)
+        self._index[url] = (final, expiry)
+        self._reverse.setdefault(final, set()).add(url)
+
+    def _index_redirect(self, url):
+        # A new redirect from url changes the resolution of every url
+        # which currently resolves to it. If url was not the end of the
+        # chains it belonged to, the affected urls are not tracked, and
+        # the index is rebuilt from scratch instead.
+        with self._index_lock:
+            entry = self._index.get(url)
+            if entry is not None and entry[0] != url:
+                self.reset_index()
+                return
+            affected = self._reverse.pop(url, set())
+            affected.add(url)
+            for u in affected:
+                self._index.pop(u, None)
+        final = self.resolve(url)
+        with self._index_lock:
+            entry = self._index.get(url)
+            if entry is None:
+                return
+            for u in affected:
+                self._set_index(u, entry[0], entry[1])
+        # Keep the chains in the database collapsed as well.
+        with self._conn as conn:
+            conn.executemany(
+                'UPDATE redirects SET target = ? '
+                'WHERE url = ? AND target != ?',
+                [(final, u, final) for u in affected if u != final]
+            )
+
+    def resolve(self, url, max_hops=MAX_REDIRECT_HOPS):
+        """
+        Return the final target of the chain of cached redirects starting
+        at the ``url``, or the ``url`` itself if there are none.
+
+        When a chain of more than one redirect is encountered, the stored
+        redirects of every url along it are updated to point directly to
+        its final target. If the chain contains a cycle, the redirects
+        forming it are dropped and the ``url`` is returned unchanged. At
+        most ``max_hops`` redirects are followed.
+        """
+        now = time.time()
+        with self._index_lock:
+            entry = self._index.get(url)
+            if entry is not None:
+                if entry[1] > now:
+                    return entry[0]
+                self.reset_index()
+
+        chain = [url]
+        expiry = float('inf')
+        current = url
+        while True:
+            target, created = self._lookup(current)
+            if target is None:
+                break
+            if target in chain:
+                cycle = chain[chain.index(target):]
+                logger.warning("Dropping cached redirect cycle : "
+                               "{0}".format(' -> '.join(cycle + [target])))
+                with self._conn as conn:
+                    conn.executemany('DELETE FROM redirects WHERE url = ?',
+                                     [(u,) for u in cycle])
+                self.reset_index()
+                return url
+            if len(chain) > max_hops:
+                logger.warning("Too many cached redirects from "
+                               "{0}".format(url))
+                return current
+            if self.ttl is not None:
+                expiry = min(expiry, created + self.ttl)
+            chain.append(target)
+            current = target
+
+        if len(chain) > 2:
+            with self._conn as conn:
+                conn.executemany(
+                    'UPDATE redirects SET target = ? WHERE url = ?',
+                    [(current, u) for u in chain[:-2]]
+                )
+        with self._index_lock:
+            for u in chain:
+                self._set_index(u, current, expiry)
+        return current
+
+
+#: The module's :class:`RedirectStore`, used by all backends which
+#: support redirect caching.
+redirect_cache = RedirectStore(REDIR_CACHE_FILE, ttl=REDIRECT_CACHE_TTL,
+                               legacy_path=LEGACY_REDIR_CACHE_FILE)
 
 
 class CachingRedirectHandler(HTTPRedirectHandler):
     """
     This handler modifies the behavior of
-    :class:`urllib2.HTTPRedirectHandler`, resulting in a HTTP ``301`` or
-    ``302`` status to be included in the ``result``.
+    :class:`urllib2.HTTPRedirectHandler`, resulting in a HTTP ``301``,
+    ``302`` or ``308`` status to be included in the ``result``.
 
     When this handler is attached to a ``urllib2`` opener, if the opening of
-    the URL resulted in a redirect via HTTP ``301`` or ``302``, this is
+    the URL resulted in a redirect via HTTP ``301``, ``302`` or ``308``,
+    this is
     reported along with the result. This information can be used by the opener
-    to maintain a redirect cache.
+    to maintain a redirect cache. The status of the final response is
+    retained in ``result.final_status``.
     """
     def __init__(self):
         pass
 
+    @staticmethod
+    def _set_status(result, code):
+        if not hasattr(result, 'final_status'):
+            result.final_status = result.status
+        result.status = code
+
     def http_error_301(self, req, fp, code, msg, headers):
         """
         Wraps the :func:`urllib2.HTTPRedirectHandler.http_error_301` handler,
@@ -103,7 +399,7 @@ class CachingRedirectHandler(HTTPRedirectHandler):
         """
         result = HTTPRedirectHandler.http_error_301(
             self, req, fp, code, msg, headers)
-        result.status = code
+        self._set_status(result, code)
         return result
 
     def http_error_302(self, req, fp, code, msg, headers):
@@ -114,9 +410,59 @@ class CachingRedirectHandler(HTTPRedirectHandler):
         """
         result = HTTPRedirectHandler.http_error_302(
             self, req, fp, code, msg, headers)
-        result.status = code
+        self._set_status(result, code)
         return result
 
+    def http_error_308(self, req, fp, code, msg, headers):
+        """
+        Wraps the :func:`urllib2.HTTPRedirectHandler.http_error_308` handler,
+        setting the ``result.status`` to ``308`` in case a http ``308`` error
+        is encountered.
+        """
+        result = HTTPRedirectHandler.http_error_302(
+            self, req, fp, code, msg, headers)
+        self._set_status(result, code)
+        return result
+
+
+def record_redirect(url, target):
+    """
+    Record a permanent redirect from ``url`` to ``target`` in the
+    :data:`redirect_cache`, if redirect caching is enabled. The ``target``
+    may be relative to the ``url``, as in a ``Location`` header.
+
+    This is the hook used by each of the www backends to populate the
+    shared redirect cache. Only permanent redirects (see
+    :data:`PERMANENT_REDIRECT_STATUSES`) should be recorded.
+    """
+    if not ENABLE_REDIRECT_CACHING:
+        return
+    target = urljoin(url, target)
+    if target == url:
+        return
+    logger.debug('Detected New Permanent Redirect:\n' +
+                 url + '\n' + target)
+    redirect_cache[url] = target
+
+
+def is_same_origin(url, target):
+    """
+    Whether the ``url`` and the ``target`` it redirects to have the same
+    scheme, host and port, so that the credentials of requests to the
+    ``url`` may be sent to the ``target``. As with :mod:`requests` and
+    :mod:`httpx`, a redirect from ``http`` to ``https`` on the default
+    ports of the same host is considered to be to the same origin.
+    """
+    old, new = urlsplit(url), urlsplit(target)
+    if old.hostname != new.hostname:
+        return False
+    old_port = old.port or _DEFAULT_PORTS.get(old.scheme)
+    new_port = new.port or _DEFAULT_PORTS.get(new.scheme)
+    if old.scheme == new.scheme:
+        return old_port == new_port
+    return (old.scheme, old_port, new.scheme, new_port) == \
+        ('http', 80, 'https', 443)
+
 
 def get_actual_url(url):
     # warnings.warn("get_actual_url() is a part of Redirect caching and is "
@@ -124,6 +470,4 @@ def get_actual_url(url):
     if not ENABLE_REDIRECT_CACHING:
         return url
     else:
-        while url in redirect_cache.keys():
-            url = redirect_cache[url]
-        return url
+        return redirect_cache.resolve(url)
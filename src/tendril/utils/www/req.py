@@ -24,20 +24,76 @@ requests based www backend (:mod:`tendril.utils.www.bare`)
 
 TODO Some introduction
 
+Responses are cached using :mod:`cachecontrol`. The cache backend is
+selected with :data:`tendril.config.REQUESTS_CACHE_BACKEND`. The
+``'sqlite'`` backend (see :mod:`tendril.utils.www.reqcache`) is
+substantially faster than the default ``'file'`` backend, and can be
+further fronted by an in-memory cache of recently used responses using
+:data:`tendril.config.REQUESTS_CACHE_MEMORY_ENTRIES`.
+
+Responses with an ``ETag`` are kept in the cache after they expire, and
+are then revalidated using a conditional request (``If-None-Match``, and
+``If-Modified-Since`` if the response also had a ``Last-Modified``). If
+the origin responds with a ``304``, the cached response is served and
+its expiry is renewed as per the session's heuristic, instead of the
+content being downloaded again. This can be disabled per session, or by
+default with :data:`tendril.config.REQUESTS_CACHE_REVALIDATE`. Note that
+responses without an ``ETag`` are always refetched once they expire.
+
 """
 
 import os
+import time
+import atexit
 import logging
+import hashlib
+import threading
 import requests
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
 from cachecontrol import CacheControlAdapter
+from cachecontrol.controller import CacheController
 from cachecontrol.caches import FileCache
 from cachecontrol.heuristics import ExpiresAfter
 from bs4 import BeautifulSoup
 
 from tendril.config import INSTANCE_CACHE
 from tendril.config import MAX_AGE_DEFAULT
+from tendril.config import REQUESTS_CACHE_BACKEND
+from tendril.config import REQUESTS_CACHE_MEMORY_ENTRIES
+from tendril.config import REQUESTS_CACHE_REVALIDATE
+from tendril.config import REQUESTS_POOL_CONNECTIONS
+from tendril.config import REQUESTS_POOL_MAXSIZE
+from tendril.config import REQUESTS_SESSION_IDLE_TIMEOUT
+from tendril.config import REQUESTS_BATCH_WORKERS
+from tendril.config import REQUESTS_BATCH_MAX_PER_HOST
 
 from .helpers import proxy_dict
+from .cachepolicy import get_cache_policies
+from .reqcache import SQLiteCache
+from .reqcache import MemoryFrontedCache
+from .redirectcache import get_actual_url
+from .redirectcache import record_redirect
+from .redirectcache import PERMANENT_REDIRECT_STATUSES
+from .redirectcache import CREDENTIAL_HEADERS
+from .redirectcache import is_same_origin
+from .resilience import get_host
+from .resilience import get_breaker
+from .resilience import get_urllib3_retry
+from .resilience import default_policy
+from .resilience import CircuitOpenError
+from .tracing import span
+from .tracing import is_enabled as is_tracing_enabled
+from .tracing import TracedConnectionMixin
+from .dnscache import CachedResolutionMixin
 
 from tendril.utils import log
 
@@ -50,30 +106,392 @@ logging.getLogger('requests.packages.urllib3.connectionpool').\
 REQUESTS_CACHE = os.path.join(INSTANCE_CACHE, 'requestscache')
 
 
-#: The module's :class:`cachecontrol.caches.FileCache` instance which
-#: should be used whenever cached :mod:`requests` responses are desired.
-#: The cache is stored in the directory defined by
-#: :data:`tendril.config.REQUESTS_CACHE`.
-#: This cache uses very weak permissions. These should probably be
+def _get_requests_cache():
+    """
+    Construct the cache used by the module as per the
+    :data:`tendril.config.REQUESTS_CACHE_BACKEND` and
+    :data:`tendril.config.REQUESTS_CACHE_MEMORY_ENTRIES` options.
+    """
+    if REQUESTS_CACHE_BACKEND == 'sqlite':
+        cache = SQLiteCache(REQUESTS_CACHE + '.db')
+    else:
+        if REQUESTS_CACHE_BACKEND != 'file':
+            logger.warning("Unrecognized REQUESTS_CACHE_BACKEND {0}, using "
+                           "'file'".format(REQUESTS_CACHE_BACKEND))
+        cache = FileCache(REQUESTS_CACHE, filemode=0o666, dirmode=0o777)
+    if REQUESTS_CACHE_MEMORY_ENTRIES:
+        cache = MemoryFrontedCache(cache, REQUESTS_CACHE_MEMORY_ENTRIES)
+    return cache
+
+
+#: The module's :mod:`cachecontrol` cache instance which should be used
+#: whenever cached :mod:`requests` responses are desired. This is a
+#: :class:`cachecontrol.caches.FileCache` stored in the directory defined
+#: by :data:`REQUESTS_CACHE` or a
+#: :class:`tendril.utils.www.reqcache.SQLiteCache` stored alongside it,
+#: depending on :data:`tendril.config.REQUESTS_CACHE_BACKEND`.
+#: The file cache uses very weak permissions. These should probably be
 #: fine tuned.
-requests_cache = FileCache(REQUESTS_CACHE, filemode=0o666, dirmode=0o777)
+requests_cache = _get_requests_cache()
+
+
+class _HTTPConnection(TracedConnectionMixin, CachedResolutionMixin,
+                      HTTPConnection):
+    tracing_backend = 'req'
+
+
+class _HTTPSConnection(TracedConnectionMixin, CachedResolutionMixin,
+                       HTTPSConnection):
+    tracing_backend = 'req'
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+_pool_classes = {
+    'http': _HTTPConnectionPool,
+    'https': _HTTPSConnectionPool,
+}
+
+
+class _TracingAdapter(HTTPAdapter):
+    """
+    A :class:`requests.adapters.HTTPAdapter` which reports the phases of
+    the requests it sends when tracing is enabled, as described in
+    :mod:`tendril.utils.www.tracing`.
 
+    Unless the request is streamed, the body of the response is read
+    here instead of by the session, so that its transfer can be timed.
 
-def _get_requests_cache_adapter(heuristic):
+    The connections of the adapter also resolve hosts using the shared
+    DNS cache, see :mod:`tendril.utils.www.dnscache`.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TracingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _pool_classes
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super(_TracingAdapter, self).proxy_manager_for(
+            proxy, **proxy_kwargs)
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = _pool_classes
+        return manager
+
+    def send(self, request, *args, **kwargs):
+        if not is_tracing_enabled():
+            return super(_TracingAdapter, self).send(request, *args, **kwargs)
+        stream = kwargs.get('stream', args[0] if args else False)
+        with span('request', url=request.url, backend='req',
+                  method=request.method) as s:
+            response = super(_TracingAdapter, self).send(
+                request, *args, **kwargs)
+            s.set_attribute('status', response.status_code)
+            s.set_attribute('from_cache',
+                            getattr(response, 'from_cache', False))
+            if not stream:
+                with span('transfer', url=request.url, backend='req'):
+                    response.content
+        return response
+
+
+class _CircuitBreakingAdapter(HTTPAdapter):
+    """
+    A :class:`requests.adapters.HTTPAdapter` which guards the requests
+    it sends with the circuit breaker of the host, as described in
+    :mod:`tendril.utils.www.resilience`.
+    """
+    def send(self, request, *args, **kwargs):
+        breaker = get_breaker(get_host(request.url))
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.host)
+        try:
+            response = super(_CircuitBreakingAdapter, self).send(
+                request, *args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            raise
+        if response.status_code in default_policy.statuses:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+
+class _RedirectCachingAdapter(HTTPAdapter):
+    """
+    A :class:`requests.adapters.HTTPAdapter` which resolves urls using the
+    shared redirect cache before sending requests, and records the
+    permanent redirects it receives in it. See
+    :mod:`tendril.utils.www.redirectcache`.
+
+    Since :mod:`requests` follows redirects by sending one request per
+    hop through the adapter, each hop is seen and recorded here. Requests
+    resolved to a different origin are sent without their credentials.
+    """
+    def send(self, request, *args, **kwargs):
+        url = get_actual_url(request.url)
+        if url != request.url:
+            original, request = request.url, request.copy()
+            request.prepare_url(url, None)
+            if not is_same_origin(original, url):
+                for header in CREDENTIAL_HEADERS:
+                    request.headers.pop(header, None)
+        response = super(_RedirectCachingAdapter, self).send(
+            request, *args, **kwargs)
+        if response.status_code in PERMANENT_REDIRECT_STATUSES and \
+                'location' in response.headers:
+            record_redirect(request.url, response.headers['location'])
+        return response
+
+
+class _CacheController(CacheController):
+    """
+    A :class:`cachecontrol.controller.CacheController` which :
+
+    - Only makes conditional requests if ``cache_etags`` is set. The stock
+      controller revalidates any stale entry with an ``ETag`` which
+      happens to still be in the cache, regardless.
+    - Keys ``POST`` responses by both the url and the request body, so
+      that they can be cached when a :class:`CachePolicy` asks for it.
+    - Keeps entries in the cache for ``stale_grace`` seconds past their
+      expiry, so that they remain available to :class:`_StaleIfErrorAdapter`.
+    """
+    stale_grace = 0
+
+    def __init__(self, *args, **kwargs):
+        super(_CacheController, self).__init__(*args, **kwargs)
+        self._local = threading.local()
+
+    def get_cache_key(self, request):
+        """
+        Return the key of the cache entry for the ``request``, or ``None``
+        if its response cannot be cached.
+        """
+        key = super(_CacheController, self).cache_url(request.url)
+        if request.method == 'POST':
+            body = request.body or b''
+            if not isinstance(body, bytes):
+                if not isinstance(body, str):
+                    # Streamed bodies can't be keyed.
+                    return None
+                body = body.encode('utf-8')
+            key = '{0}#POST:{1}'.format(key, hashlib.sha256(body).hexdigest())
+        return key
+
+    def cache_url(self, uri):
+        # The stock controller derives keys from the url alone. While a
+        # POST request is being handled, its own key is used instead.
+        key = getattr(self._local, 'key', None)
+        if key is not None:
+            return key
+        return super(_CacheController, self).cache_url(uri)
+
+    def _with_key(self, request, func, *args):
+        if request.method != 'POST':
+            return func(request, *args)
+        self._local.key = self.get_cache_key(request)
+        if self._local.key is None:
+            return None
+        try:
+            return func(request, *args)
+        finally:
+            self._local.key = None
+
+    def cached_request(self, request):
+        with span('cache.get', url=request.url, backend='req') as s:
+            response = self._with_key(
+                request, super(_CacheController, self).cached_request)
+            s.set_attribute('hit', bool(response))
+        return response or False
+
+    def cache_response(self, request, *args, **kwargs):
+        with span('cache.set', url=request.url, backend='req'):
+            return self._with_key(
+                request,
+                lambda r: super(_CacheController, self).cache_response(
+                    r, *args, **kwargs))
+
+    def update_cached_response(self, request, response):
+        return self._with_key(
+            request, super(_CacheController, self).update_cached_response,
+            response) or response
+
+    def conditional_headers(self, request):
+        if not self.cache_etags:
+            return {}
+        return self._with_key(
+            request, super(_CacheController, self).conditional_headers) or {}
+
+    def _load_from_cache(self, request):
+        if request.method != 'POST':
+            return super(_CacheController, self)._load_from_cache(request)
+        key = self.get_cache_key(request)
+        data = self.cache.get(key) if key is not None else None
+        if data is None:
+            return None
+        return self.serializer.loads(request, data)
+
+    def _cache_set(self, cache_url, request, response, body=None,
+                   expires_time=None):
+        if expires_time and self.stale_grace:
+            expires_time += self.stale_grace
+        super(_CacheController, self)._cache_set(
+            cache_url, request, response, body, expires_time)
+
+
+def _get_expiry(headers):
+    """
+    Return the timestamp at which a response with the given ``headers``
+    expires, as per its ``Cache-Control`` or ``Expires`` headers, or
+    ``None`` if that can't be determined.
+    """
+    date = parsedate_tz(headers.get('date', ''))
+    if date is None:
+        return None
+    date = mktime_tz(date)
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                return date + int(value)
+            except ValueError:
+                return None
+    expires = parsedate_tz(headers.get('expires', ''))
+    if expires is not None:
+        return mktime_tz(expires)
+    return date
+
+
+class _StaleIfErrorAdapter(HTTPAdapter):
+    """
+    A :class:`cachecontrol.CacheControlAdapter` mixin which serves the
+    cached response to a request, even if it has expired, when the site
+    fails with a connection error, a transient error status or an open
+    circuit breaker, as long as it is no more than ``stale_grace``
+    seconds past its expiry.
+
+    The stale entry is read before the request is made, since the
+    controller purges stale entries without an ``ETag`` from the cache
+    when it finds them.
+    """
+    stale_grace = 0
+
+    def _get_stale(self, request, key, data):
+        response = self.controller.serializer.loads(request, data)
+        if response is None:
+            return None
+        expiry = _get_expiry(response.headers)
+        remaining = None if expiry is None else \
+            expiry + self.stale_grace - time.time()
+        if remaining is None or remaining <= 0:
+            return None
+        logger.warning("Serving stale response for {0}".format(request.url))
+        # Put the entry back, in case it has been purged in the meantime.
+        self.cache.set(key, data, expires=int(remaining))
+        return self.build_response(request, response, from_cache=True)
+
+    def send(self, request, *args, **kwargs):
+        key = None
+        if self.stale_grace and request.method in self.cacheable_methods:
+            key = self.controller.get_cache_key(request)
+        data = self.cache.get(key) if key is not None else None
+        if data is None:
+            return super(_StaleIfErrorAdapter, self).send(
+                request, *args, **kwargs)
+        try:
+            response = super(_StaleIfErrorAdapter, self).send(
+                request, *args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout,
+                CircuitOpenError):
+            stale = self._get_stale(request, key, data)
+            if stale is None:
+                raise
+            return stale
+        if response.status_code in default_policy.statuses:
+            stale = self._get_stale(request, key, data)
+            if stale is not None:
+                response.close()
+                return stale
+        return response
+
+
+class ResilientCacheControlAdapter(_TracingAdapter,
+                                   _RedirectCachingAdapter,
+                                   _StaleIfErrorAdapter,
+                                   CacheControlAdapter,
+                                   _CircuitBreakingAdapter):
+    """
+    A :class:`cachecontrol.CacheControlAdapter` which retries requests
+    failing with transient errors and fails fast when the host is
+    consistently failing. Responses available in the cache are served
+    without consulting the circuit breaker. If ``stale_grace`` is
+    provided, expired responses are served for that many seconds past
+    their expiry while the host is failing.
+
+    Urls are resolved against the shared redirect cache before the
+    response cache is consulted, if redirect caching is enabled.
+
+    The phases of requests are reported if tracing is enabled. See
+    :mod:`tendril.utils.www.tracing`.
+    """
+    def __init__(self, *args, **kwargs):
+        stale_grace = kwargs.pop('stale_grace', 0)
+        kwargs.setdefault('max_retries', get_urllib3_retry())
+        kwargs.setdefault('controller_class', _CacheController)
+        super(ResilientCacheControlAdapter, self).__init__(*args, **kwargs)
+        self.stale_grace = stale_grace
+        self.controller.stale_grace = stale_grace
+
+
+def _get_requests_cache_adapter(heuristic, pool_connections=None,
+                                pool_maxsize=None, revalidate=None,
+                                stale_grace=0, cacheable_methods=None):
     """
     Given a heuristic, constructs and returns a
-    :class:`cachecontrol.CacheControlAdapter` attached to the instance's
-    :data:`requests_cache`.
+    :class:`ResilientCacheControlAdapter` attached to the instance's
+    :data:`requests_cache`. The sizes of the adapter's connection pools
+    default to :data:`tendril.config.REQUESTS_POOL_CONNECTIONS` and
+    :data:`tendril.config.REQUESTS_POOL_MAXSIZE`, and whether expired
+    responses are revalidated defaults to
+    :data:`tendril.config.REQUESTS_CACHE_REVALIDATE`.
 
     """
-    return CacheControlAdapter(
+    if pool_connections is None:
+        pool_connections = REQUESTS_POOL_CONNECTIONS
+    if pool_maxsize is None:
+        pool_maxsize = REQUESTS_POOL_MAXSIZE
+    if revalidate is None:
+        revalidate = REQUESTS_CACHE_REVALIDATE
+    return ResilientCacheControlAdapter(
         cache=requests_cache,
         heuristic=heuristic,
-        cache_etags=False
+        cache_etags=revalidate,
+        cacheable_methods=cacheable_methods,
+        stale_grace=stale_grace,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
     )
 
 
-def get_session(target='http://', heuristic=None):
+def _get_policy_adapter(policy, pool_connections=None, pool_maxsize=None):
+    """
+    Construct a :class:`ResilientCacheControlAdapter` implementing the
+    :class:`tendril.utils.www.cachepolicy.CachePolicy` ``policy``.
+    """
+    return _get_requests_cache_adapter(
+        policy.heuristic, pool_connections, pool_maxsize,
+        revalidate=policy.revalidate, stale_grace=policy.stale_grace,
+        cacheable_methods=policy.cacheable_methods,
+    )
+
+
+def get_session(target='http://', heuristic=None,
+                pool_connections=None, pool_maxsize=None, revalidate=None):
     """
     Gets a pre-configured :mod:`requests` session.
 
@@ -81,8 +499,18 @@ def get_session(target='http://', heuristic=None):
 
     - Proxy settings are added to the session.
     - It is configured to use the instance's :data:`requests_cache`.
-    - Permanent redirect caching is handled by :mod:`CacheControl`.
+    - Permanent redirects are cached in the shared redirect cache, if
+      redirect caching is enabled, and are also cached as responses by
+      :mod:`CacheControl`.
     - Temporary redirect caching is not supported.
+    - Expired responses with an ``ETag`` are revalidated with conditional
+      requests, unless ``revalidate`` is False.
+    - Transient failures are retried and failing hosts fail fast, see
+      :mod:`tendril.utils.www.resilience`.
+    - The caching policies registered in
+      :mod:`tendril.utils.www.cachepolicy` are mounted on the session,
+      whether or not their prefixes fall within the ``target``, and take
+      precedence over the ``heuristic`` for the urls they cover.
 
     Each module / class instance which uses this should subsequently
     maintain it's own session with whatever modifications it requires
@@ -102,8 +530,17 @@ def get_session(target='http://', heuristic=None):
                    site-specific heuristics.
     :param heuristic: The heuristic to use for the cache adapter.
     :type heuristic: :class:`cachecontrol.heuristics.BaseHeuristic`
+    :param pool_connections: (optional) number of per-host connection
+                             pools kept by the adapter.
+    :param pool_maxsize: (optional) maximum number of connections kept
+                         in each pool.
+    :param revalidate: (optional) whether expired responses are
+                       revalidated rather than refetched. Defaults to
+                       :data:`tendril.config.REQUESTS_CACHE_REVALIDATE`.
     :rtype: :class:`requests.Session`
 
+    .. seealso:: :func:`get_shared_session`
+
     """
 
     s = requests.session()
@@ -111,18 +548,101 @@ def get_session(target='http://', heuristic=None):
         s.proxies.update(proxy_dict)
     if heuristic is None:
         heuristic = ExpiresAfter(seconds=MAX_AGE_DEFAULT)
-    s.mount(target, _get_requests_cache_adapter(heuristic))
+    s.mount(target, _get_requests_cache_adapter(
+        heuristic, pool_connections, pool_maxsize, revalidate))
+    for prefix, policy in get_cache_policies():
+        s.mount(prefix, _get_policy_adapter(
+            policy, pool_connections, pool_maxsize))
     return s
 
 
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def _close_idle_sessions(now):
+    for key, (session, last_used) in list(_shared_sessions.items()):
+        if now - last_used > REQUESTS_SESSION_IDLE_TIMEOUT:
+            logger.debug("Closing idle shared session {0}".format(key[0]))
+            session.close()
+            del _shared_sessions[key]
+
+
+def get_shared_session(target='http://', heuristic=None, revalidate=None):
+    """
+    Gets a process-wide shared :mod:`requests` session, configured as by
+    :func:`get_session`, creating it if needed.
+
+    Shared sessions are keyed by the ``target`` prefix, the ``heuristic``,
+    the ``revalidate`` setting and the proxy settings, so that callers
+    asking for the same configuration share the session along with its
+    connection pools and keep-alive connections. This function is
+    thread-safe.
+
+    Shared sessions which have not been requested for
+    :data:`tendril.config.REQUESTS_SESSION_IDLE_TIMEOUT` seconds are
+    closed. Closing a session only drops its pooled connections, so a
+    caller still holding it can continue to use it. Callers should not
+    close shared sessions themselves, or mount anything else on them.
+
+    :param target: Defaults to ``'http://'``. See :func:`get_session`.
+    :param heuristic: The heuristic to use for the cache adapter.
+                      Heuristics are compared by their class and their
+                      parameters, so equivalent heuristics share a
+                      session even if they are different instances.
+    :param revalidate: (optional) See :func:`get_session`.
+    :rtype: :class:`requests.Session`
+
+    """
+    proxies = tuple(sorted(proxy_dict.items())) if proxy_dict else None
+    if revalidate is None:
+        revalidate = REQUESTS_CACHE_REVALIDATE
+    key = (target, _get_heuristic_key(heuristic), revalidate, proxies)
+    now = time.time()
+    with _shared_sessions_lock:
+        _close_idle_sessions(now)
+        try:
+            session = _shared_sessions[key][0]
+        except KeyError:
+            session = get_session(target, heuristic, revalidate=revalidate)
+        _shared_sessions[key] = (session, now)
+    return session
+
+
+def _get_heuristic_key(heuristic):
+    """
+    Return a key identifying the ``heuristic`` by its class and its
+    parameters, or the ``heuristic`` itself if they can't be used as one.
+    """
+    if heuristic is None:
+        return None
+    try:
+        params = tuple(sorted(vars(heuristic).items()))
+        hash(params)
+    except TypeError:
+        return heuristic
+    return type(heuristic), params
+
+
+@atexit.register
+def close_shared_sessions():
+    """
+    Close all shared sessions created by :func:`get_shared_session`.
+    """
+    with _shared_sessions_lock:
+        for session, _ in _shared_sessions.values():
+            session.close()
+        _shared_sessions.clear()
+
+
 def get_soup_requests(url, session=None):
     """
     Gets a :mod:`bs4` parsed soup for the ``url`` specified by the parameter.
     The :mod:`lxml` parser is used.
 
     If a ``session`` (previously created from :func:`get_session`) is
-    provided, this session is used and left open. If it is not, a new session
-    is created for the request and closed before the soup is returned.
+    provided, this session is used and left open. If it is not, the default
+    shared session from :func:`get_shared_session` is used.
 
     Using a caller-defined session allows re-use of a single session across
     multiple requests, therefore taking advantage of HTTP keep-alive to
@@ -135,15 +655,132 @@ def get_soup_requests(url, session=None):
 
     """
     if session is None:
-        session = get_session()
-        _close_after = True
-    else:
-        _close_after = False
+        session = get_shared_session()
 
     r = session.get(url)
     r.raise_for_status()
-    soup = BeautifulSoup(r.content, 'lxml', from_encoding=r.encoding)
+    with span('parse', url=url, backend='req'):
+        return _parse_soup(r.content, r.encoding)
+
+
+def _parse_soup(content, encoding):
+    return BeautifulSoup(content, 'lxml', from_encoding=encoding)
 
-    if _close_after is True:
-        session.close()
-    return soup
+
+def _chain(future, target):
+    # Propagate the outcome of one future to another.
+    if future.cancelled():
+        target.cancel()
+    elif future.exception() is not None:
+        target.set_exception(future.exception())
+    else:
+        target.set_result(future.result())
+
+
+def get_soups_requests(urls, session=None, max_workers=None,
+                       max_per_host=None, ordered=True,
+                       parse_executor=None, return_exceptions=False):
+    """
+    Gets :mod:`bs4` parsed soups for each of the ``urls``, fetching them
+    concurrently using a pool of ``max_workers`` threads, of which no more
+    than ``max_per_host`` fetch from any one host at a time.
+
+    This is a generator, yielding a tuple ``(url, soup)`` for each url,
+    either in the order of ``urls`` (if ``ordered`` is True) or as they
+    become available.
+
+    All the requests are made using the same ``session``, which defaults
+    to the shared session from :func:`get_shared_session`. The pools of
+    the session's adapter should be at least ``max_per_host`` connections
+    large, or connections will be discarded after use instead of being
+    kept alive.
+
+    Soups are parsed in the fetching threads, unless a
+    ``parse_executor`` is provided. Since parsing is mostly done while
+    holding the GIL, a :class:`concurrent.futures.ProcessPoolExecutor`
+    can be used here to let parsing actually run in parallel with
+    fetching, at the cost of pickling the soups back.
+
+    If a request fails, the exception is raised when its result is
+    reached, as is done by :func:`get_soup_requests`, and the remaining
+    requests are abandoned. If ``return_exceptions`` is True, the
+    exception is instead yielded in place of the soup.
+
+    :param urls: an iterable of urls to get.
+    :param session: (optional) the :class:`requests.Session` to use.
+    :param max_workers: (optional) maximum number of concurrent requests.
+                        Defaults to
+                        :data:`tendril.config.REQUESTS_BATCH_WORKERS`.
+    :param max_per_host: (optional) maximum number of concurrent requests
+                         to a single host. Defaults to
+                         :data:`tendril.config.REQUESTS_BATCH_MAX_PER_HOST`.
+    :param ordered: whether to yield results in the order of ``urls``.
+    :param parse_executor: (optional) a
+                           :class:`concurrent.futures.Executor` to parse
+                           the soups with.
+    :param return_exceptions: whether to yield exceptions instead of
+                              raising them.
+
+    """
+    if session is None:
+        session = get_shared_session()
+    if max_workers is None:
+        max_workers = REQUESTS_BATCH_WORKERS
+    if max_per_host is None:
+        max_per_host = REQUESTS_BATCH_MAX_PER_HOST
+
+    urls = list(urls)
+    host_limits = {}
+    for url in urls:
+        host_limits.setdefault(get_host(url),
+                               threading.BoundedSemaphore(max_per_host))
+
+    def fetch(url):
+        with host_limits[get_host(url)]:
+            r = session.get(url)
+        r.raise_for_status()
+        if parse_executor is None:
+            with span('parse', url=url, backend='req'):
+                return _parse_soup(r.content, r.encoding)
+        return r.content, r.encoding
+
+    # The futures of the work submitted to the executors, which are
+    # cancelled if the consumer stops early.
+    submitted = []
+
+    def parse(fetched, result):
+        if fetched.cancelled() or fetched.exception() is not None:
+            _chain(fetched, result)
+        else:
+            parsed = parse_executor.submit(_parse_soup, *fetched.result())
+            submitted.append(parsed)
+            parsed.add_done_callback(lambda f: _chain(f, result))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        for url in urls:
+            fetched = executor.submit(fetch, url)
+            submitted.append(fetched)
+            if parse_executor is None:
+                futures.append(fetched)
+            else:
+                result = Future()
+                result.set_running_or_notify_cancel()
+                fetched.add_done_callback(
+                    lambda f, result=result: parse(f, result))
+                futures.append(result)
+        urls_by_future = dict(zip(futures, urls))
+
+        for future in (futures if ordered else as_completed(futures)):
+            try:
+                soup = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                soup = e
+            yield urls_by_future[future], soup
+    finally:
+        for future in submitted:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+CacheControl Cache Backends (:mod:`tendril.utils.www.reqcache`)
+===============================================================
+
+This module provides :mod:`cachecontrol` cache implementations for the
+requests based backend (:mod:`tendril.utils.www.req`), which can be used
+in place of the default :class:`cachecontrol.caches.FileCache`.
+
+The :class:`cachecontrol.caches.FileCache` stores each response in its
+own file in a two level directory tree, and every lookup involves
+hashing the key, several ``stat`` calls and a file open. The
+:class:`SQLiteCache` keeps all responses in a single SQLite database
+instead, which makes both hits and misses considerably cheaper. The
+:class:`MemoryFrontedCache` can additionally be used to keep recently
+used responses in memory in front of either of them.
+
+The cache used by :mod:`tendril.utils.www.req` is selected with the
+:data:`tendril.config.REQUESTS_CACHE_BACKEND` and
+:data:`tendril.config.REQUESTS_CACHE_MEMORY_ENTRIES` options.
+
+"""
+
+
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from cachecontrol.cache import BaseCache
+
+from .caching import SQLiteStoreBase
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+def _get_expiry(expires):
+    """
+    Convert the ``expires`` provided by :mod:`cachecontrol` to a cache
+    (either a number of seconds from now or a :class:`datetime.datetime`)
+    into an absolute timestamp, or ``None``.
+    """
+    if not expires:
+        return None
+    if isinstance(expires, datetime):
+        return expires.timestamp()
+    return time.time() + expires
+
+
+class SQLiteCache(SQLiteStoreBase, BaseCache):
+    def __init__(self, path):
+        """
+        A :mod:`cachecontrol` cache backed by a SQLite database at
+        ``path``, which can be safely shared by multiple threads and
+        processes. See :class:`tendril.utils.www.caching.SQLiteStoreBase`.
+
+        Entries are dropped once the expiry provided by
+        :mod:`cachecontrol` when they were stored has passed.
+
+        Closing the cache (as is done by
+        :class:`cachecontrol.CacheControlAdapter` when its session is
+        closed) only closes the calling thread's connection, so a single
+        instance can be shared by many sessions.
+        """
+        SQLiteStoreBase.__init__(self, path)
+
+    def _setup(self, conn):
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, '
+                         'value BLOB NOT NULL, '
+                         'expires REAL)')
+
+    def get_with_expiry(self, key):
+        """
+        Return the value stored for the ``key`` along with the timestamp
+        at which it expires (or ``None``), or ``(None, None)`` if there
+        isn't one.
+        """
+        row = self._conn.execute(
+            'SELECT value, expires FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        if row[1] is not None and row[1] < time.time():
+            self.delete(key)
+            return None, None
+        return bytes(row[0]), row[1]
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def set(self, key, value, expires=None):
+        with self._conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                (key, value, _get_expiry(expires))
+            )
+
+    def delete(self, key):
+        with self._conn as conn:
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def purge_expired(self):
+        """
+        Remove expired entries from the database.
+        """
+        with self._conn as conn:
+            conn.execute('DELETE FROM responses WHERE expires < ?',
+                         (time.time(),))
+
+
+class MemoryFrontedCache(BaseCache):
+    def __init__(self, backend, max_entries=1000):
+        """
+        A :mod:`cachecontrol` cache which keeps up to ``max_entries`` of
+        the most recently used entries of the ``backend`` cache in memory.
+
+        All writes go through to the ``backend``. Note that entries held
+        in memory do not see changes made to the ``backend`` by other
+        processes. Entries read from a backend which provides their expiry,
+        as the :class:`SQLiteCache` does with ``get_with_expiry``, expire
+        from memory along with those in the backend.
+
+        :param backend: the :class:`cachecontrol.cache.BaseCache` to front.
+        :param max_entries: the maximum number of entries kept in memory.
+
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, value, expiry):
+        with self._lock:
+            self._entries[key] = (value, expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] >= time.time():
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+        if hasattr(self.backend, 'get_with_expiry'):
+            value, expiry = self.backend.get_with_expiry(key)
+        else:
+            value, expiry = self.backend.get(key), None
+        if value is not None:
+            self._remember(key, value, expiry)
+        return value
+
+    def set(self, key, value, expires=None):
+        self.backend.set(key, value, expires)
+        self._remember(key, value, _get_expiry(expires))
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self.backend.delete(key)
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Retries and Circuit Breakers (:mod:`tendril.utils.www.resilience`)
+==================================================================
+
+This module provides the retry and circuit breaker infrastructure shared
+by the synchronous www backends.
+
+- Requests which fail with a transient error (a connection error, or one
+  of the :data:`tendril.config.WWW_RETRY_STATUSES`) are retried up to
+  :data:`tendril.config.WWW_RETRY_COUNT` times, with a jittered
+  exponential backoff between attempts. A ``Retry-After`` sent by the
+  server is honoured instead of the computed backoff.
+
+- Each host has a :class:`CircuitBreaker`. Once
+  :data:`tendril.config.WWW_CIRCUIT_BREAKER_THRESHOLD` consecutive
+  requests to a host have failed, further requests to it fail fast with
+  a :class:`CircuitOpenError` until
+  :data:`tendril.config.WWW_CIRCUIT_BREAKER_RESET` seconds have passed,
+  after which a single trial request is let through. The
+  :class:`tendril.utils.www.caching.CacheBase` caches serve stale content,
+  if they have any, while the circuit is open.
+
+The urllib (:mod:`tendril.utils.www.bare`) and suds
+(:mod:`tendril.utils.www.soap`) backends use :func:`call` directly. The
+requests backend (:mod:`tendril.utils.www.req`) delegates retries to
+:mod:`urllib3` using :func:`get_urllib3_retry`, and uses the circuit
+breakers from :func:`get_breaker`.
+
+"""
+
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.error import URLError
+from urllib3.util import Retry
+
+from tendril.config import WWW_RETRY_COUNT
+from tendril.config import WWW_RETRY_BACKOFF
+from tendril.config import WWW_RETRY_BACKOFF_MAX
+from tendril.config import WWW_RETRY_STATUSES
+from tendril.config import WWW_CIRCUIT_BREAKER_THRESHOLD
+from tendril.config import WWW_CIRCUIT_BREAKER_RESET
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+class CircuitOpenError(URLError):
+    """
+    Raised instead of making a request to a host whose
+    :class:`CircuitBreaker` is open.
+    """
+    def __init__(self, host):
+        URLError.__init__(self, "Circuit open for host {0}".format(host))
+        self.host = host
+
+
+def get_host(url):
+    """
+    Return the host (``netloc``) of the ``url``, as used to key the
+    circuit breakers.
+    """
+    return urlparse(url).netloc.lower()
+
+
+def parse_retry_after(value):
+    """
+    Parse the value of a ``Retry-After`` header, which may either be a
+    number of seconds or a HTTP date, returning the number of seconds to
+    wait. Returns ``None`` if the value is absent or unparseable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=None, backoff=None,
+                 backoff_max=None, statuses=None):
+        """
+        Describes how failed requests are retried. Parameters which are
+        not provided are obtained from the :mod:`tendril.config` options.
+
+        :param retries: maximum number of retries.
+        :param backoff: base delay in seconds of the exponential backoff.
+        :param backoff_max: maximum delay in seconds between attempts.
+        :param statuses: HTTP status codes which should be retried.
+
+        """
+        self.retries = WWW_RETRY_COUNT if retries is None else retries
+        self.backoff = WWW_RETRY_BACKOFF if backoff is None else backoff
+        self.backoff_max = WWW_RETRY_BACKOFF_MAX \
+            if backoff_max is None else backoff_max
+        self.statuses = frozenset(WWW_RETRY_STATUSES
+                                  if statuses is None else statuses)
+
+    def get_backoff(self, attempt, retry_after=None):
+        """
+        Return the number of seconds to wait before the retry following
+        the (zero-indexed) ``attempt``. A ``retry_after`` requested by the
+        server takes precedence over the computed ("full jitter")
+        exponential backoff. Both are capped at ``backoff_max``.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        ceiling = min(self.backoff_max, self.backoff * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+
+#: The default :class:`RetryPolicy`, constructed from the
+#: :mod:`tendril.config` options.
+default_policy = RetryPolicy()
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, threshold=None, reset_timeout=None):
+        """
+        A thread-safe circuit breaker guarding requests to a single host.
+
+        The breaker starts out ``closed``. It opens once ``threshold``
+        consecutive failures have been recorded, and while it is open
+        :func:`allow` returns False. After ``reset_timeout`` seconds it
+        becomes ``half-open`` and lets a single trial request through,
+        which either closes it again or reopens it.
+
+        :param host: the host guarded by this breaker.
+        :param threshold: number of consecutive failures which open the
+                          breaker.
+        :param reset_timeout: number of seconds after which an open
+                              breaker lets a trial request through.
+
+        """
+        self.host = host
+        self.threshold = WWW_CIRCUIT_BREAKER_THRESHOLD \
+            if threshold is None else threshold
+        self.reset_timeout = WWW_CIRCUIT_BREAKER_RESET \
+            if reset_timeout is None else reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return whether a request to the host should be attempted.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self._opened_at >= self.reset_timeout:
+                logger.info("Trying host {0} again".format(self.host))
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Host {0} recovered".format(self.host))
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Host {0} is failing, failing fast for "
+                                   "{1}s".format(self.host,
+                                                 self.reset_timeout))
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    """
+    Return the process-wide :class:`CircuitBreaker` for the ``host``.
+    """
+    try:
+        return _breakers[host]
+    except KeyError:
+        with _breakers_lock:
+            return _breakers.setdefault(host, CircuitBreaker(host))
+
+
+def call(url, func, classify, policy=None):
+    """
+    Call ``func`` to make a request to the ``url``, retrying it as per the
+    ``policy`` and guarding it with the circuit breaker of the host.
+
+    :param url: the url being requested, used to identify the host.
+    :param func: callable without arguments which makes the request and
+                 returns the response, or raises on failure.
+    :param classify: callable which, given an exception raised by
+                     ``func``, returns a tuple ``(transient, retry_after)``
+                     indicating whether the failure is transient (and
+                     should therefore be retried and counted against the
+                     host) and the ``Retry-After`` requested by the
+                     server, if any.
+    :param policy: the :class:`RetryPolicy` to use. Defaults to
+                   :data:`default_policy`.
+    :return: the return value of ``func``.
+    :raises CircuitOpenError: if the host's circuit breaker is open.
+
+    """
+    if policy is None:
+        policy = default_policy
+    breaker = get_breaker(get_host(url))
+    # The breaker is only consulted once, since retries belong to the
+    # attempt it let through, which may be the trial of a half-open
+    # breaker that would otherwise never be resolved.
+    if not breaker.allow():
+        raise CircuitOpenError(breaker.host)
+    attempt = 0
+    while True:
+        try:
+            result = func()
+        except Exception as e:
+            transient, retry_after = classify(e)
+            if not transient:
+                # The host responded, even if not the way we wanted.
+                breaker.record_success()
+                raise
+            if attempt >= policy.retries:
+                breaker.record_failure()
+                raise
+            delay = policy.get_backoff(attempt, retry_after)
+            logger.info("Retrying {0} in {1:.2f}s after : {2}".format(
+                url, delay, e))
+            time.sleep(delay)
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
+
+
+def get_urllib3_retry(policy=None):
+    """
+    Return a :class:`urllib3.util.Retry` implementing the ``policy`` (by
+    default :data:`default_policy`), for use with :mod:`requests`
+    adapters.
+
+    Only idempotent methods are retried. The final response is returned
+    rather than raised when retries on a status are exhausted, leaving it
+    to :func:`requests.Response.raise_for_status`.
+    """
+    if policy is None:
+        policy = default_policy
+    return Retry(
+        total=policy.retries,
+        backoff_factor=policy.backoff,
+        backoff_max=policy.backoff_max,
+        backoff_jitter=policy.backoff,
+        status_forcelist=policy.statuses,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
@@ -35,6 +35,7 @@ from hashlib import md5
 from suds.client import Client
 from suds.transport.http import HttpAuthenticated
 from suds.transport.http import HttpTransport
+from suds.transport import TransportError
 
 try:
     import cPickle as pickle
@@ -43,6 +44,9 @@ except ImportError:
 
 from .helpers import proxy_dict
 from .caching import CacheBase
+from .resilience import call
+from .resilience import default_policy
+from .resilience import parse_retry_after
 
 from tendril.config import INSTANCE_CACHE
 from tendril.config import MAX_AGE_DEFAULT
@@ -66,14 +70,48 @@ logging.getLogger('suds.transport.http').setLevel(logging.INFO)
 SOAP_CACHE = os.path.join(INSTANCE_CACHE, 'soapcache')
 
 
-class ThrottledTransport(HttpAuthenticated):
+def _classify_error(e):
+    """
+    Classify an exception raised by a suds transport for
+    :func:`tendril.utils.www.resilience.call`.
+
+    SOAP services report faults with a ``500`` status, so that status is
+    never considered transient here.
+    """
+    if isinstance(e, TransportError):
+        if e.httpcode != 500 and e.httpcode in default_policy.statuses:
+            headers = getattr(e.fp, 'headers', None) or {}
+            return True, parse_retry_after(headers.get('Retry-After'))
+        return False, None
+    if isinstance(e, IOError):
+        return True, None
+    return False, None
+
+
+class ResilientTransport(HttpAuthenticated):
+    """
+    Provides a HTTP transport for :mod:`suds` which retries requests
+    failing with transient errors and fails fast when the service is
+    consistently failing, as described in
+    :mod:`tendril.utils.www.resilience`.
+
+    This class is a :class:`suds.transport.Transport` subclass
+    based on the default ``HttpAuthenticated`` transport.
+    """
+    def send(self, request):
+        return call(request.url,
+                    lambda: HttpAuthenticated.send(self, request),
+                    _classify_error)
+
+
+class ThrottledTransport(ResilientTransport):
     def __init__(self, **kwargs):
         """
         Provides a throttled HTTP transport for respecting rate limits
         on rate-restricted SOAP APIs using :mod:`suds`.
 
         This class is a :class:`suds.transport.Transport` subclass
-        based on the default ``HttpAuthenticated`` transport.
+        based on the :class:`ResilientTransport`.
 
         :param minimum_spacing: Minimum number of seconds between requests.
                                 Default 0.
@@ -102,17 +140,17 @@ class ThrottledTransport(HttpAuthenticated):
             logger.info("Throttling SOAP client for {0}".format(tleft))
             time.sleep(tleft)
         self._last_called = now
-        return HttpAuthenticated.send(self, request)
+        return ResilientTransport.send(self, request)
 
 
-class CachedTransport(CacheBase, HttpAuthenticated):
+class CachedTransport(CacheBase, ResilientTransport):
     def __init__(self, **kwargs):
         """
         Provides a cached HTTP transport with request-based caching for
         SOAP APIs using :mod:`suds`.
 
-        This is a subclass of :class:`CacheBase` and the default
-        ``HttpAuthenticated`` transport.
+        This is a subclass of :class:`CacheBase` and the
+        :class:`ResilientTransport`.
 
         :param cache_dir: folder where the cache is located.
         :param max_age: the maximum age in seconds after which a response
@@ -150,7 +188,7 @@ class CachedTransport(CacheBase, HttpAuthenticated):
         :return: the response to the request
 
         """
-        response = HttpAuthenticated.send(self, request)
+        response = ResilientTransport.send(self, request)
         return response
 
     @staticmethod
@@ -243,8 +281,10 @@ def get_soap_client(wsdl, cache_requests=True,
     cache folder, along with the ``max_age`` and ``minimum_spacing``
     parameters if provided.
 
-    If ``cache_requests`` is ``False``, the client uses the default
-    :class:`suds.transport.http.HttpAuthenticated` transport.
+    If ``cache_requests`` is ``False``, the client uses a
+    :class:`ResilientTransport`, which behaves like the default
+    :class:`suds.transport.http.HttpAuthenticated` transport apart from
+    retrying transient failures.
     """
     if cache_requests is True:
         if proxy_dict is None:
@@ -260,7 +300,7 @@ def get_soap_client(wsdl, cache_requests=True,
             )
     else:
         if proxy_dict is None:
-            soap_transport = HttpAuthenticated()
+            soap_transport = ResilientTransport()
         else:
-            soap_transport = HttpAuthenticated(proxy=proxy_dict)
+            soap_transport = ResilientTransport(proxy=proxy_dict)
     return Client(wsdl, transport=soap_transport)
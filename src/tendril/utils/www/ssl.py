@@ -1,13 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2022 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+SSL Contexts (:mod:`tendril.utils.www.ssl`)
+===========================================
+
+Creating an :class:`ssl.SSLContext` loads and parses the CA certificates,
+which takes a few milliseconds, and each context keeps its own TLS
+sessions. This module provides :func:`get_ssl_context`, which returns
+cached contexts, created lazily, for each host and verification setting.
+Custom CA files are merged with :data:`tendril.config.CA_BUNDLE`, and
+hosts in :data:`tendril.config.SSL_NOVERIFY_HOSTS` get contexts which
+don't verify certificates.
+
+The contexts also resume TLS sessions. Python does not do this on its
+own for client connections, so every new connection to a host normally
+performs a full TLS handshake. The contexts provided here remember the
+last session established with each host, and offer it when connecting to
+the host again, from any client using the same context. Servers which
+support session resumption then perform an abbreviated handshake.
+
+"""
 
 
 import ssl
+import threading
+from six.moves.urllib.parse import urlparse
+
 from tendril.config import CA_BUNDLE
+from tendril.config import SSL_NOVERIFY_HOSTS
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
 
-ssl_context = ssl.create_default_context()
+class _ResumingMixin(object):
+    # Records the session of the connection with the context, once it
+    # has one. TLS 1.3 servers send session tickets after the handshake,
+    # so the session is also recorded after the first read.
+    _session_recorded = False
+
+    def do_handshake(self, *args, **kwargs):
+        result = super(_ResumingMixin, self).do_handshake(*args, **kwargs)
+        self.context._record_session(self)
+        return result
+
+    def read(self, *args, **kwargs):
+        data = super(_ResumingMixin, self).read(*args, **kwargs)
+        if not self._session_recorded:
+            self._session_recorded = True
+            self.context._record_session(self)
+        return data
+
+
+class _ResumingSSLSocket(_ResumingMixin, ssl.SSLSocket):
+    pass
+
+
+class _ResumingSSLObject(_ResumingMixin, ssl.SSLObject):
+    pass
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    An :class:`ssl.SSLContext` which resumes TLS sessions with the hosts
+    it connects to. The session last established with each
+    ``server_hostname`` is offered to the host when the context is next
+    used to connect to it. Sessions which can't be resumed are simply
+    ignored by the server.
+    """
+    sslsocket_class = _ResumingSSLSocket
+    sslobject_class = _ResumingSSLObject
+
+    def __init__(self, *args, **kwargs):
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def _record_session(self, sslobj):
+        session = sslobj.session
+        if session is None or not sslobj.server_hostname:
+            return
+        with self._sessions_lock:
+            self._sessions[sslobj.server_hostname] = session
+
+    def get_session(self, server_hostname):
+        """
+        Return the TLS session last established with the
+        ``server_hostname``, if any.
+        """
+        if isinstance(server_hostname, bytes):
+            server_hostname = server_hostname.decode('ascii')
+        with self._sessions_lock:
+            return self._sessions.get(server_hostname)
+
+    def clear_sessions(self):
+        with self._sessions_lock:
+            self._sessions.clear()
+
+    def wrap_socket(self, sock, server_side=False,
+                    do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        if session is None and server_hostname and not server_side:
+            session = self.get_session(server_hostname)
+        return super(ResumingSSLContext, self).wrap_socket(
+            sock, server_side, do_handshake_on_connect,
+            suppress_ragged_eofs, server_hostname, session)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and server_hostname and not server_side:
+            session = self.get_session(server_hostname)
+        return super(ResumingSSLContext, self).wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session)
+
+
+def _create_context(verify, cafile, cert):
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.load_default_certs()
+        for path in (CA_BUNDLE, cafile):
+            if path:
+                logger.info(f"Using custom CA Bundle at '{path}'")
+                context.load_verify_locations(cafile=path)
+    if cert:
+        if isinstance(cert, str):
+            context.load_cert_chain(cert)
+        else:
+            context.load_cert_chain(*cert)
+    return context
+
+
+def _get_host(url):
+    if not url:
+        return None
+    parsed = urlparse(str(url))
+    return parsed.hostname or None
+
+
+def is_noverify_host(url):
+    """
+    Whether SSL verification is to be skipped for the ``url`` (or
+    ``base_url``), as per :data:`tendril.config.SSL_NOVERIFY_HOSTS`.
+    """
+    if not url:
+        return False
+    url = str(url)
+    host = _get_host(url)
+    return url in SSL_NOVERIFY_HOSTS or url.rstrip('/') in SSL_NOVERIFY_HOSTS \
+        or 'https://{0}'.format(host) in SSL_NOVERIFY_HOSTS
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_ssl_context(url=None, verify=True, cert=None):
+    """
+    Return the cached :class:`ResumingSSLContext` to use for connections
+    to the host of the ``url``, creating it if needed.
+
+    :param url: (optional) the url (or ``base_url``) of the host. Clients
+                which connect to many hosts can use the context for
+                ``None``.
+    :param verify: True to verify certificates using the default CAs and
+                   :data:`tendril.config.CA_BUNDLE`, the path to a CA file
+                   to also trust, or False to not verify certificates.
+                   Certificates are not verified for hosts in
+                   :data:`tendril.config.SSL_NOVERIFY_HOSTS`.
+    :param cert: (optional) the client certificate to use, either the path
+                 to a file containing the certificate and its key, or a
+                 tuple of the paths to the certificate and the key.
+
+    """
+    if is_noverify_host(url):
+        verify = False
+    if isinstance(cert, list):
+        cert = tuple(cert)
+    key = (_get_host(url), bool(verify),
+           verify if isinstance(verify, str) else None, cert)
+    try:
+        return _contexts[key]
+    except KeyError:
+        pass
+    with _contexts_lock:
+        if key not in _contexts:
+            _contexts[key] = _create_context(verify, key[2], cert)
+        return _contexts[key]
+
 
-if CA_BUNDLE:
-    logger.info(f"Using custom CA Bundle at '{CA_BUNDLE}'")
-    ssl_context.load_verify_locations(cafile=CA_BUNDLE)
+def __getattr__(name):
+    # The default context is created lazily, when first used.
+    if name == 'ssl_context':
+        return get_ssl_context()
+    raise AttributeError(name)
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2019 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Request Tracing (:mod:`tendril.utils.www.tracing`)
+==================================================
+
+This module provides hooks to find out where the time taken by requests
+made through :mod:`tendril.utils.www` goes. The backends report the
+phases of each request they make as :class:`Span` instances to the
+tracers registered using :func:`add_tracer`. A tracer is any callable
+accepting a :class:`Span`.
+
+Spans are named after the phase they time :
+
+=============  ==========================================================
+``request``    The request, as seen by the backend, up to the arrival of
+               the response headers. For :mod:`tendril.utils.www.req`,
+               the body is also read unless the request is streamed.
+``dns``        Resolving the address of the host, using the DNS cache of
+               :mod:`tendril.utils.www.dnscache`.
+``connect``    Opening the TCP connection, including resolving the address
+               of the host.
+``tls``        The TLS handshake.
+``ttfb``       From sending the request to receiving the response headers.
+``transfer``   Reading the response body.
+``cache.get``  Looking up (and reading) a cached response.
+``cache.set``  Storing a response in a cache.
+``parse``      Parsing the content into a :mod:`bs4` soup.
+=============  ==========================================================
+
+Spans have a ``host`` attribute, and most have a ``backend`` attribute
+naming the backend which emitted them (``bare``, ``req`` or ``hx``).
+
+When no tracer is registered, which is the default, the instrumentation
+costs no more than checking that there are none. :func:`span` then
+returns a shared span which does nothing, and the backends skip their
+instrumentation altogether.
+
+Two tracers are provided. :class:`LatencyAggregator` collects the
+durations of the spans and prints a per-host breakdown of the latency of
+requests, and :class:`OpenTelemetryTracer` forwards the spans to
+OpenTelemetry, if it is installed. For example :
+
+.. code-block:: python
+
+    from tendril.utils.www import tracing
+
+    with tracing.aggregate() as aggregator:
+        soups = list(get_soups_requests(urls))
+    aggregator.report()
+
+"""
+
+
+import sys
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from six.moves.urllib.parse import urlparse
+from httpx import BaseTransport
+from httpx import AsyncBaseTransport
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.WARNING)
+
+
+#: The phases reported by the backends, in the order in which
+#: :meth:`LatencyAggregator.report` lists them.
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer',
+          'cache.get', 'cache.set', 'parse', 'request')
+
+
+class Span(object):
+    def __init__(self, name, attributes=None, start=None, duration=None):
+        """
+        A timed phase of a request. Spans are used as context managers,
+        timing the block they enclose and reporting themselves to the
+        registered tracers when it exits. An exception raised in the
+        block is recorded in :attr:`error`.
+
+        :param name: the name of the phase, one of :data:`PHASES`.
+        :param attributes: (optional) dict of attributes of the span.
+        :param start: (optional) the time at which the phase started, as
+                      returned by :func:`time.time`.
+        :param duration: (optional) the duration of the phase, in seconds.
+
+        """
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = start
+        self.duration = duration
+        self.error = None
+        self._t0 = None
+
+    @property
+    def end(self):
+        if self.start is None or self.duration is None:
+            return None
+        return self.start + self.duration
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._t0
+        if exc_value is not None:
+            self.error = exc_value
+        _emit(self)
+        return False
+
+    def __repr__(self):
+        return "<Span {0} {1} {2}>".format(
+            self.name, self.attributes.get('host'),
+            'open' if self.duration is None
+            else '{0:.2f}ms'.format(self.duration * 1000))
+
+
+class _NullSpan(object):
+    # Returned by span() when tracing is disabled.
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+# Replaced rather than modified, so that it can be iterated over
+# without holding the lock.
+_tracers = ()
+_tracers_lock = threading.Lock()
+
+
+def add_tracer(tracer):
+    """
+    Register the callable ``tracer`` to receive every :class:`Span`
+    emitted by the backends from now on.
+    """
+    global _tracers
+    with _tracers_lock:
+        if tracer not in _tracers:
+            _tracers = _tracers + (tracer,)
+
+
+def remove_tracer(tracer):
+    """
+    Stop sending spans to a ``tracer`` registered using :func:`add_tracer`.
+    """
+    global _tracers
+    with _tracers_lock:
+        _tracers = tuple(t for t in _tracers if t is not tracer)
+
+
+def is_enabled():
+    """
+    Whether any tracers are registered.
+    """
+    return bool(_tracers)
+
+
+def _emit(span):
+    for tracer in _tracers:
+        try:
+            tracer(span)
+        except Exception as e:
+            logger.warning("Tracer {0!r} failed : {1!r}".format(tracer, e))
+
+
+def _get_attributes(url, attributes):
+    if url is not None:
+        attributes['url'] = str(url)
+        attributes.setdefault('host', get_hostname(url))
+    return attributes
+
+
+def span(name, url=None, **attributes):
+    """
+    Return a :class:`Span` named ``name`` with the given ``attributes``,
+    to be used as a context manager around the phase it times. If
+    tracing is disabled, a span which does nothing is returned instead.
+
+    If a ``url`` is provided, it is added to the attributes along with
+    its ``host``. This is only done if tracing is enabled.
+    """
+    if not _tracers:
+        return _null_span
+    return Span(name, _get_attributes(url, attributes))
+
+
+def record(name, duration, start=None, url=None, **attributes):
+    """
+    Report a phase which has already been timed, if tracing is enabled.
+
+    :param name: the name of the phase.
+    :param duration: the duration of the phase, in seconds.
+    :param start: (optional) the time at which the phase started, as
+                  returned by :func:`time.time`. Defaults to ``duration``
+                  seconds ago.
+    :param url: (optional) the url, added to the attributes as in
+                :func:`span`.
+
+    """
+    if not _tracers:
+        return
+    if start is None:
+        start = time.time() - duration
+    _emit(Span(name, _get_attributes(url, attributes), start, duration))
+
+
+def get_hostname(url):
+    """
+    Return the host name of the ``url``, as used in the ``host``
+    attribute of spans.
+    """
+    return urlparse(str(url)).hostname
+
+
+@contextmanager
+def aggregate(window=1000):
+    """
+    A context manager registering a new :class:`LatencyAggregator` as a
+    tracer for the duration of the block, and providing it.
+    """
+    aggregator = LatencyAggregator(window)
+    add_tracer(aggregator)
+    try:
+        yield aggregator
+    finally:
+        remove_tracer(aggregator)
+
+
+class PhaseStats(object):
+    def __init__(self, window):
+        """
+        Statistics of the durations of one phase of the requests to a
+        host. Quantiles are computed over the last ``window`` spans.
+        """
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, span):
+        self.count += 1
+        if span.error is not None:
+            self.errors += 1
+        self.total += span.duration
+        self.max = max(self.max, span.duration)
+        self.samples.append(span.duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def quantile(self, q):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class LatencyAggregator(object):
+    def __init__(self, window=1000):
+        """
+        A tracer collecting :class:`PhaseStats` for each phase of the
+        requests to each host, and reporting them using :meth:`report`.
+        Spans without a ``host`` are collected under ``-``.
+
+        :param window: number of recent spans of each phase of each host
+                       to compute quantiles over.
+
+        """
+        self.window = window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        if span.duration is None:
+            return
+        key = (span.attributes.get('host') or '-', span.name)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = PhaseStats(self.window)
+            stats.add(span)
+
+    def hosts(self):
+        return sorted(set(host for host, _ in self._stats))
+
+    def get_stats(self, host, phase):
+        """
+        Return the :class:`PhaseStats` of the ``phase`` of requests to
+        the ``host``, or None if there have been no such spans.
+        """
+        return self._stats.get((host, phase))
+
+    def summary(self):
+        """
+        Return the statistics collected, as a dictionary of the count,
+        errors, mean, median, 95th percentile and maximum duration (in
+        seconds) of each phase, keyed by host and then phase.
+        """
+        rval = {}
+        with self._lock:
+            for (host, phase), stats in self._stats.items():
+                rval.setdefault(host, {})[phase] = {
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'mean': stats.mean,
+                    'p50': stats.quantile(0.5),
+                    'p95': stats.quantile(0.95),
+                    'max': stats.max,
+                }
+        return rval
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self, file=None):
+        """
+        Print the latency breakdown of the requests to each host to
+        ``file`` (by default, :data:`sys.stdout`), with durations in
+        milliseconds.
+        """
+        file = file or sys.stdout
+        summary = self.summary()
+        for host in sorted(summary):
+            phases = summary[host]
+            print(host, file=file)
+            print("  {0:<10}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}".format(
+                'phase', 'count', 'errors', 'mean', 'p50', 'p95', 'max'),
+                file=file)
+            names = [p for p in PHASES if p in phases] + \
+                sorted(p for p in phases if p not in PHASES)
+            for name in names:
+                s = phases[name]
+                print("  {0:<10}{1:>8}{2:>8}{3:>10.2f}{4:>10.2f}{5:>10.2f}"
+                      "{6:>10.2f}".format(name, s['count'], s['errors'],
+                                          s['mean'] * 1000, s['p50'] * 1000,
+                                          s['p95'] * 1000, s['max'] * 1000),
+                      file=file)
+
+
+class OpenTelemetryTracer(object):
+    def __init__(self, tracer=None, prefix='http.'):
+        """
+        A tracer forwarding spans to OpenTelemetry, as spans of the same
+        name (prefixed with ``prefix``) and attributes. The spans are
+        created as children of the current OpenTelemetry span, if any.
+
+        :param tracer: (optional) the :class:`opentelemetry.trace.Tracer`
+                       to create the spans with. Defaults to one named
+                       after this module, from the global tracer provider.
+                       The :mod:`opentelemetry` package is only needed if
+                       this isn't provided.
+        :param prefix: prefix of the names of the spans.
+
+        """
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer(__name__)
+        self.tracer = tracer
+        self.prefix = prefix
+
+    def __call__(self, span):
+        if span.duration is None:
+            return
+        start = int(span.start * 1e9)
+        attributes = {k: v if isinstance(v, (bool, int, float, str))
+                      else str(v)
+                      for k, v in span.attributes.items() if v is not None}
+        otel_span = self.tracer.start_span(
+            self.prefix + span.name, start_time=start, attributes=attributes)
+        if span.error is not None:
+            otel_span.record_exception(span.error)
+            from opentelemetry.trace import Status
+            from opentelemetry.trace import StatusCode
+            otel_span.set_status(Status(StatusCode.ERROR, repr(span.error)))
+        otel_span.end(end_time=start + int(span.duration * 1e9))
+
+
+class TracedConnectionMixin(object):
+    """
+    A mixin for :class:`http.client.HTTPConnection` subclasses, including
+    those of :mod:`urllib3`, which reports the ``connect``, ``tls`` and
+    ``ttfb`` phases of the requests made using the connection. The
+    ``backend`` attribute of the spans is :attr:`tracing_backend`.
+    """
+    tracing_backend = None
+    _tcp_time = None
+
+    def __init__(self, *args, **kwargs):
+        super(TracedConnectionMixin, self).__init__(*args, **kwargs)
+        # Used by http.client connections. urllib3 uses _new_conn.
+        self._untraced_create_connection = self._create_connection
+        self._create_connection = self._traced_create_connection
+
+    def _time_tcp(self, func, *args, **kwargs):
+        if not _tracers:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._tcp_time = time.perf_counter() - start
+
+    def _traced_create_connection(self, *args, **kwargs):
+        return self._time_tcp(self._untraced_create_connection,
+                              *args, **kwargs)
+
+    def _new_conn(self):
+        return self._time_tcp(super(TracedConnectionMixin, self)._new_conn)
+
+    def connect(self):
+        if not _tracers:
+            return super(TracedConnectionMixin, self).connect()
+        self._tcp_time = None
+        start = time.perf_counter()
+        super(TracedConnectionMixin, self).connect()
+        total = time.perf_counter() - start
+        tcp = total if self._tcp_time is None else self._tcp_time
+        record('connect', tcp, host=self.host, backend=self.tracing_backend)
+        if hasattr(self.sock, 'cipher'):
+            record('tls', total - tcp, host=self.host,
+                   backend=self.tracing_backend)
+
+    def getresponse(self, *args, **kwargs):
+        if not _tracers:
+            return super(TracedConnectionMixin, self).getresponse(
+                *args, **kwargs)
+        with Span('ttfb', {'host': self.host,
+                           'backend': self.tracing_backend}):
+            return super(TracedConnectionMixin, self).getresponse(
+                *args, **kwargs)
+
+
+class _HttpcoreTrace(object):
+    # Receives the events of the httpcore ``trace`` extension of a
+    # request, and reports the phases they delimit.
+    _phases = {'connect_tcp': 'connect', 'connect_unix_socket': 'connect',
+               'start_tls': 'tls', 'receive_response_body': 'transfer'}
+
+    def __init__(self, host, chained=None):
+        self.host = host
+        self.chained = chained
+        self._started = {}
+
+    def _event(self, name, info):
+        phase, _, state = name.partition('.')[2].rpartition('.')
+        now = time.perf_counter()
+        if state == 'started':
+            self._started[phase] = now
+            return
+        if phase == 'receive_response_headers':
+            name, start = 'ttfb', self._started.get('send_request_headers')
+        else:
+            name, start = self._phases.get(phase), self._started.get(phase)
+        if name is None or start is None:
+            return
+        s = Span(name, {'host': self.host, 'backend': 'hx'},
+                 time.time() - (now - start), now - start)
+        if state == 'failed':
+            s.error = info.get('exception')
+        _emit(s)
+
+    def trace(self, name, info):
+        self._event(name, info)
+        if self.chained is not None:
+            self.chained(name, info)
+
+    async def atrace(self, name, info):
+        self._event(name, info)
+        if self.chained is not None:
+            await self.chained(name, info)
+
+
+class TracingTransport(BaseTransport, AsyncBaseTransport):
+    def __init__(self, transport):
+        """
+        An :mod:`httpx` transport wrapping another (sync or async one),
+        which reports a ``request`` span for each request it sends, and
+        the ``connect``, ``tls``, ``ttfb`` and ``transfer`` phases of
+        the requests using the ``trace`` extension of :mod:`httpcore`.
+        Any ``trace`` extension already set on a request still receives
+        the events.
+
+        Requests are passed on untouched while tracing is disabled. The
+        clients from :mod:`tendril.utils.www.hx` wrap their network
+        transport in one, so that each attempt at a request is traced.
+
+        :param transport: the transport to wrap.
+
+        """
+        self._transport = transport
+
+    @staticmethod
+    def _start(request, asynchronous):
+        host = request.url.host
+        chained = request.extensions.get('trace')
+        if isinstance(getattr(chained, '__self__', None), _HttpcoreTrace):
+            # The request is being sent again, as when retried.
+            chained = chained.__self__.chained
+        trace = _HttpcoreTrace(host, chained)
+        request.extensions['trace'] = \
+            trace.atrace if asynchronous else trace.trace
+        return Span('request', _get_attributes(
+            request.url, {'host': host, 'backend': 'hx',
+                          'method': request.method}))
+
+    def handle_request(self, request):
+        if not _tracers:
+            return self._transport.handle_request(request)
+        with self._start(request, False) as s:
+            response = self._transport.handle_request(request)
+            s.set_attribute('status', response.status_code)
+        return response
+
+    async def handle_async_request(self, request):
+        if not _tracers:
+            return await self._transport.handle_async_request(request)
+        with self._start(request, True) as s:
+            response = await self._transport.handle_async_request(request)
+            s.set_attribute('status', response.status_code)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+    async def aclose(self):
+        await self._transport.aclose()
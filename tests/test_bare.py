@@ -23,12 +23,62 @@ Docstring for test_utils_www
 """
 
 import six
-from tendril.utils.www import redirectcache
+import gzip
+import socket
+import threading
 from tendril.utils.www import bare
+from tendril.utils.www import status
 from hashlib import md5
 import pytest
 from six.moves.urllib.error import HTTPError, URLError
-redirectcache.DUMP_REDIR_CACHE_ON_EXIT = False
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class _ValidatingHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        body = b'<html><body><p>content</p></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.path == '/gzip' and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    server = HTTPServer(('127.0.0.1', 0), _ValidatingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _ValidatingHandler.requests = []
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher(tmp_path, monkeypatch):
+    monkeypatch.setattr(bare.time, 'sleep', lambda x: None)
+    status.set_connected()
+    yield bare.WWWCachedFetcher(cache_dir=str(tmp_path))
+    status.set_disconnected()
 
 
 def test_cached_fetcher():
@@ -52,3 +102,52 @@ def test_www_errors():
         bare.get_soup('httpd://httpstat.us/404')
     with pytest.raises(HTTPError):
         bare.get_soup('http://httpstat.us/500')
+
+
+def test_cached_fetcher_revalidation(local_server, fetcher):
+    url = local_server + '/page'
+    content = fetcher.fetch(url)
+    assert b'content' in content
+    assert 'If-None-Match' not in _ValidatingHandler.requests[-1]
+    assert fetcher.fetch(url) == content
+    assert len(_ValidatingHandler.requests) == 1
+    assert fetcher.fetch(url, max_age=0) == content
+    assert len(_ValidatingHandler.requests) == 2
+    assert _ValidatingHandler.requests[-1]['If-None-Match'] == '"v1"'
+
+
+def test_cached_fetcher_response(local_server, fetcher):
+    url = local_server + '/page'
+    response = fetcher.fetch_response(url)
+    assert response.status == 200
+    assert response.url == url
+    assert response.encoding == 'utf-8'
+    assert response.headers['ETag'] == '"v1"'
+    assert b'content' in response.content
+    cached = fetcher.fetch_response(url)
+    assert len(_ValidatingHandler.requests) == 1
+    assert cached.headers == response.headers
+    assert cached.fetched_at == response.fetched_at
+
+
+def test_cached_fetcher_compression(local_server, fetcher):
+    url = local_server + '/gzip'
+    response = fetcher.fetch_response(url)
+    assert 'gzip' in _ValidatingHandler.requests[-1]['Accept-Encoding']
+    assert response.content == b'<html><body><p>content</p></body></html>'
+    filepath = fetcher._get_filepath(url)
+    assert fetcher.cache_fs.readbytes(filepath) == response.content
+
+
+def test_classify_error():
+    assert bare._classify_error(URLError(socket.timeout('timed out'))) == \
+        (True, None)
+    assert bare._classify_error(URLError(ConnectionRefusedError())) == \
+        (True, None)
+    assert bare._classify_error(
+        URLError(socket.gaierror(socket.EAI_AGAIN, 'again')))[0]
+    assert not bare._classify_error(
+        URLError(socket.gaierror(socket.EAI_NONAME, 'unknown')))[0]
+    assert not bare._classify_error(URLError('unknown url type: ftpx'))[0]
+    assert not bare._classify_error(ValueError())[0]
+    assert bare._classify_error(ConnectionResetError())[0]
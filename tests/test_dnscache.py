@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import time
+import socket
+import asyncio
+import threading
+import httpx
+import pytest
+import requests
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.request import build_opener
+from tendril.utils.www import hx
+from tendril.utils.www import req
+from tendril.utils.www import bare
+from tendril.utils.www import dnscache
+from tendril.utils.www.reqcache import SQLiteCache
+from tendril.utils.www.resilience import RetryPolicy
+
+
+class _Resolver(object):
+    def __init__(self, hosts, ttl=None, delay=0):
+        self.hosts = hosts
+        self.ttl = ttl
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, host, port, family=0, type=0, proto=0, flags=0):
+        self.calls.append(host)
+        time.sleep(self.delay)
+        if host not in self.hosts:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name does not resolve')
+        infos = []
+        for address in self.hosts[host]:
+            infos.extend(socket.getaddrinfo(address, port, family, type,
+                                            proto, flags))
+        if self.ttl is not None:
+            return infos, self.ttl
+        return infos
+
+
+def test_dns_cache():
+    resolver = _Resolver({'a.test': ['127.0.0.1'], 'b.test': ['127.0.0.2']})
+    cache = dnscache.DNSCache(ttl=60, max_entries=2, resolver=resolver)
+    infos = cache.getaddrinfo('a.test', 80, 0, socket.SOCK_STREAM)
+    assert infos[0][4] == ('127.0.0.1', 80)
+    assert cache.getaddrinfo('A.test', 80, 0, socket.SOCK_STREAM) == infos
+    assert resolver.calls == ['a.test']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.getaddrinfo('b.test', 80, 0, socket.SOCK_STREAM)
+    cache.getaddrinfo('b.test', 443, 0, socket.SOCK_STREAM)
+    assert len(cache) == 2
+    # The least recently used entry was discarded.
+    cache.getaddrinfo('a.test', 80, 0, socket.SOCK_STREAM)
+    assert resolver.calls == ['a.test', 'b.test', 'b.test', 'a.test']
+
+    cache.invalidate('a.test')
+    cache.getaddrinfo('a.test', 80, 0, socket.SOCK_STREAM)
+    assert resolver.calls.count('a.test') == 3
+
+
+def test_dns_cache_ttl():
+    resolver = _Resolver({'a.test': ['127.0.0.1']}, ttl=0.05)
+    cache = dnscache.DNSCache(ttl=60, resolver=resolver)
+    cache.getaddrinfo('a.test', 80)
+    cache.getaddrinfo('a.test', 80)
+    assert len(resolver.calls) == 1
+    time.sleep(0.1)
+    cache.getaddrinfo('a.test', 80)
+    assert len(resolver.calls) == 2
+
+    # Records are not kept for longer than the cache's TTL.
+    resolver.ttl = 3600
+    cache = dnscache.DNSCache(ttl=0.05, resolver=resolver)
+    cache.getaddrinfo('a.test', 80)
+    time.sleep(0.1)
+    cache.getaddrinfo('a.test', 80)
+    assert len(resolver.calls) == 4
+
+
+def test_dns_cache_negative():
+    resolver = _Resolver({})
+    cache = dnscache.DNSCache(negative_ttl=60, resolver=resolver)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror) as e:
+            cache.getaddrinfo('missing.test', 80)
+        assert e.value.errno == socket.EAI_NONAME
+    assert resolver.calls == ['missing.test']
+
+    def _failing(*args):
+        resolver.calls.append(args[0])
+        raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure')
+
+    # Temporary failures are not cached.
+    cache.resolver = _failing
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo('flaky.test', 80)
+    assert resolver.calls.count('flaky.test') == 2
+
+
+def test_dns_cache_concurrent():
+    resolver = _Resolver({'a.test': ['127.0.0.1']}, delay=0.1)
+    cache = dnscache.DNSCache(resolver=resolver)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.getaddrinfo('a.test', 80)))
+        for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 5
+    assert resolver.calls == ['a.test']
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.headers.get('Host').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def resolver(tmp_path, monkeypatch):
+    monkeypatch.setattr(req, 'requests_cache',
+                        SQLiteCache(str(tmp_path / 'cache.db')))
+    retry = req.get_urllib3_retry(RetryPolicy(retries=1, backoff=0))
+    monkeypatch.setattr(req, 'get_urllib3_retry', lambda: retry)
+    server = _Server(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    # The first address of the host refuses connections.
+    resolver = _Resolver({'service.test': ['127.0.0.2', '127.0.0.1']})
+    resolver.port = server.server_port
+    monkeypatch.setattr(dnscache, 'dns_cache',
+                        dnscache.DNSCache(resolver=resolver))
+    yield resolver
+    server.shutdown()
+    server.server_close()
+
+
+def test_req_dns_cache(resolver):
+    host = 'service.test:{0}'.format(resolver.port)
+    with req.get_session() as session:
+        for _ in range(2):
+            r = session.get('http://{0}/'.format(host),
+                            headers={'Connection': 'close'})
+            assert r.text == host
+        with pytest.raises(requests.ConnectionError):
+            session.get('http://missing.test:{0}/'.format(resolver.port))
+    assert resolver.calls == ['service.test', 'missing.test']
+
+
+def test_hx_dns_cache(resolver):
+    host = 'service.test:{0}'.format(resolver.port)
+
+    async def _run():
+        async with hx.async_client(shared=False, cache=False,
+                                   retry=False) as client:
+            r = await client.get('http://{0}/'.format(host))
+            assert r.text == host
+        async with hx.async_client(shared=False, cache=False,
+                                   retry=False) as client:
+            r = await client.get('http://{0}/'.format(host))
+            assert r.text == host
+            with pytest.raises(httpx.ConnectError):
+                await client.get('http://missing.test/')
+
+    asyncio.run(_run())
+    with hx.sync_client(shared=False, retry=False) as client:
+        assert client.get('http://{0}/'.format(host)).text == host
+        with pytest.raises(httpx.ConnectError):
+            client.get('http://missing.test/')
+    assert resolver.calls == ['service.test', 'missing.test']
+
+
+def test_bare_dns_cache(resolver):
+    host = 'service.test:{0}'.format(resolver.port)
+    opener = build_opener(bare.TracingHTTPHandler())
+    for _ in range(2):
+        assert opener.open('http://{0}/'.format(host)).read() == \
+            host.encode('ascii')
+    assert resolver.calls == ['service.test']
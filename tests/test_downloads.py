@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import os
+import gzip
+import time
+import asyncio
+import hashlib
+import threading
+import httpx
+import pytest
+import requests
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from tendril.utils.www import req
+from tendril.utils.www import downloads
+from tendril.utils.www.reqcache import SQLiteCache
+from tendril.utils.www import status
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    content = os.urandom(200000)
+    etag = '"f1"'
+    truncate = False
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.path.endswith('.txt'):
+            return self._send_text()
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        start, end = 0, len(self.content) - 1
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', self.etag) == \
+                self.etag:
+            first, last = byte_range.split('=')[1].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(self.content)))
+        else:
+            self.send_response(200)
+        body = self.content[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        if self.truncate:
+            body = body[:len(body) // 2]
+            _FileHandler.truncate = False
+        self.wfile.write(body)
+
+    text = b'compressible text\n' * 10000
+    force_gzip = False
+
+    def _send_text(self):
+        body = self.text
+        self.send_response(200)
+        if self.force_gzip or \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads, 'download_cache', downloads.DownloadCache(
+        cache_dir=str(tmp_path / 'cache')))
+    status.set_connected()
+    server = HTTPServer(('127.0.0.1', 0), _FileHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _FileHandler.requests = []
+    yield 'http://127.0.0.1:{0}/archive.zip'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+    status.set_disconnected()
+
+
+def test_download_resume(file_server, tmp_path, monkeypatch):
+    dest = str(tmp_path / 'archive.zip')
+    monkeypatch.setattr(req, 'requests_cache',
+                        SQLiteCache(str(tmp_path / 'cache.db')))
+    session = req.get_session()
+
+    _FileHandler.truncate = True
+    with pytest.raises(requests.RequestException):
+        downloads.download(file_server, dest, session=session,
+                          chunk_size=1024)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(dest + '.download')
+
+    downloads.download(file_server, dest, session=session, chunk_size=1024)
+    assert 'Range' in _FileHandler.requests[-1]
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.content
+
+
+def test_download_cached(file_server, tmp_path):
+    dest = str(tmp_path / 'archive.zip')
+    session = requests.Session()
+    downloads.download(file_server, dest, session=session)
+    os.remove(dest)
+
+    downloads.download(file_server, dest, session=session)
+    assert len(_FileHandler.requests) == 1
+
+    downloads.download(file_server, dest, max_age=0, session=session)
+    assert len(_FileHandler.requests) == 2
+    assert _FileHandler.requests[-1]['If-None-Match'] == _FileHandler.etag
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.content
+
+
+def test_download_encoded(file_server, tmp_path, monkeypatch):
+    url = file_server.replace('archive.zip', 'notes.txt')
+    dest = str(tmp_path / 'notes.txt')
+    session = requests.Session()
+    downloads.download(url, dest, session=session)
+    assert _FileHandler.requests[-1]['Accept-Encoding'] == 'identity'
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.text
+
+    # Servers which encode the body regardless.
+    monkeypatch.setattr(_FileHandler, 'force_gzip', True)
+    downloads.download(url, dest, max_age=0, session=session)
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.text
+
+
+def _async_download(url, dest, **kwargs):
+    async def _run():
+        async with httpx.AsyncClient() as client:
+            return await downloads.async_download(url, dest, client=client,
+                                                  **kwargs)
+    return asyncio.run(_run())
+
+
+def test_async_download(file_server, tmp_path):
+    dest = str(tmp_path / 'archive.zip')
+    digest = hashlib.sha256(_FileHandler.content).hexdigest()
+
+    _FileHandler.truncate = True
+    with pytest.raises(httpx.HTTPError):
+        _async_download(file_server, dest, chunk_size=1024)
+    assert not os.path.exists(dest)
+
+    assert _async_download(file_server, dest, chunk_size=1024) == digest
+    resumed = _FileHandler.requests[-1]['Range']
+    assert int(resumed.split('=')[1].rstrip('-')) > 90000
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.content
+
+    os.remove(dest)
+    assert _async_download(file_server, dest) == digest
+    assert len(_FileHandler.requests) == 2
+    assert _async_download(file_server, dest, max_age=0) == digest
+    assert _FileHandler.requests[-1]['If-None-Match'] == _FileHandler.etag
+
+
+def test_async_download_encoded(file_server, tmp_path, monkeypatch):
+    url = file_server.replace('archive.zip', 'notes.txt')
+    dest = str(tmp_path / 'notes.txt')
+    digest = hashlib.sha256(_FileHandler.text).hexdigest()
+    assert _async_download(url, dest) == digest
+    assert _FileHandler.requests[-1]['Accept-Encoding'] == 'identity'
+
+    # Servers which encode the body regardless.
+    monkeypatch.setattr(_FileHandler, 'force_gzip', True)
+    assert _async_download(url, dest, max_age=0, parts=4,
+                           part_size=30000) == digest
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.text
+
+
+def test_async_download_parts(file_server, tmp_path):
+    dest = str(tmp_path / 'archive.zip')
+    digest = _async_download(file_server, dest, parts=4, part_size=30000)
+    assert digest == hashlib.sha256(_FileHandler.content).hexdigest()
+    assert len(_FileHandler.requests) == 7
+    assert sorted(r['Range'] for r in _FileHandler.requests)[-1] == \
+        'bytes=90000-119999'
+    with open(dest, 'rb') as f:
+        assert f.read() == _FileHandler.content
+
+
+def test_pump_backpressure():
+    state = {'read': 0, 'written': 0, 'ahead': 0}
+
+    async def _chunks():
+        for _ in range(50):
+            state['read'] += 1
+            state['ahead'] = max(state['ahead'],
+                                 state['read'] - state['written'])
+            yield b'x' * 10
+
+    def _write(chunk):
+        time.sleep(0.001)
+        state['written'] += 1
+
+    received = asyncio.run(downloads._pump(_chunks(), _write, buffers=4))
+    assert received == 500
+    assert state['written'] == 50
+    assert state['ahead'] <= 6
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import asyncio
+import threading
+import httpx
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from tendril.utils.www import hx
+from tendril.utils.www import hxcache
+
+
+def _shared(host, **kwargs):
+    return hx.async_client(base_url='http://{0}'.format(host),
+                           shared=True, **kwargs)
+
+
+def test_shared_async_clients(monkeypatch):
+    async def _run():
+        async with _shared('a.example') as c1:
+            async with _shared('a.example') as c2:
+                assert c1 is c2
+        async with _shared('a.example') as c3:
+            assert c3 is c1
+        async with _shared('b.example') as c4:
+            assert c4 is not c1
+        async with hx.async_client(base_url='http://a.example') as c5:
+            assert c5 is not c1
+        assert c5.is_closed
+        assert not c1.is_closed
+        # Clients with credentials are never shared.
+        async with _shared('a.example', auth=('user', 'pass')) as c7:
+            assert c7 is not c1
+        assert c7.is_closed
+
+        # Clients in use are never closed for being idle.
+        now = hx.time.monotonic()
+        async with _shared('b.example') as c6:
+            monkeypatch.setattr(
+                hx.time, 'monotonic',
+                lambda: now + hx.HTTPX_CLIENT_IDLE_TIMEOUT + 1)
+            async with _shared('c.example'):
+                pass
+            assert c1.is_closed
+            assert not c6.is_closed
+        monkeypatch.undo()
+
+        await hx.close_async_clients()
+        assert c6.is_closed
+        assert not hx._shared_clients
+        return c4
+
+    client = asyncio.run(_run())
+    assert client.is_closed
+    # Each event loop gets its own clients.
+    asyncio.run(_run())
+
+
+class _Origin(object):
+    def __init__(self, headers, etag=None):
+        self.headers = headers
+        self.etag = etag
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        if self.etag and request.headers.get('If-None-Match') == self.etag:
+            return httpx.Response(304, headers={'ETag': self.etag})
+        headers = dict(self.headers)
+        if self.etag:
+            headers['ETag'] = self.etag
+        return httpx.Response(200, headers=headers,
+                              content='body {0}'.format(len(self.requests)))
+
+
+def _get_client(origin, **kwargs):
+    transport = hxcache.CachingTransport(
+        httpx.MockTransport(origin), hxcache.MemoryStore(), **kwargs)
+    return httpx.AsyncClient(transport=transport)
+
+
+def test_caching_transport_freshness():
+    async def _run():
+        origin = _Origin({'Cache-Control': 'max-age=60'})
+        async with _get_client(origin) as client:
+            r1 = await client.get('http://api.example/a')
+            r2 = await client.get('http://api.example/a')
+            assert r1.text == r2.text == 'body 1'
+            assert r2.extensions['tendril.cache'] == 'hit'
+            await client.get('http://api.example/a',
+                             headers={'Cache-Control': 'no-cache'})
+            assert len(origin.requests) == 2
+            await client.post('http://api.example/a')
+            assert (await client.get('http://api.example/a')).text == \
+                'body 4'
+            await client.get('http://api.example/a',
+                             extensions={'tendril.cache': False})
+            assert len(origin.requests) == 5
+
+        origin = _Origin({'Cache-Control': 'no-store'})
+        async with _get_client(origin) as client:
+            await client.get('http://api.example/a')
+            await client.get('http://api.example/a')
+            assert len(origin.requests) == 2
+
+        origin = _Origin({'Cache-Control': 'max-age=60'})
+        async with _get_client(origin,
+                               bypass=['http://api.example/']) as client:
+            await client.get('http://api.example/a')
+            await client.get('http://api.example/a')
+            assert len(origin.requests) == 2
+
+    asyncio.run(_run())
+
+
+def test_caching_transport_revalidation():
+    async def _run():
+        origin = _Origin({'Cache-Control': 'no-cache'}, etag='"e1"')
+        async with _get_client(origin) as client:
+            r1 = await client.get('http://api.example/a')
+            r2 = await client.get('http://api.example/a')
+            assert r1.text == r2.text == 'body 1'
+            assert r2.status_code == 200
+            assert origin.requests[1].headers['If-None-Match'] == '"e1"'
+            origin.etag = '"e2"'
+            assert (await client.get('http://api.example/a')).text == \
+                'body 3'
+
+    asyncio.run(_run())
+
+
+def test_caching_transport_vary():
+    async def _run():
+        origin = _Origin({'Cache-Control': 'max-age=60',
+                          'Vary': 'Accept'})
+        async with _get_client(origin) as client:
+            json_headers = {'Accept': 'application/json'}
+            await client.get('http://api.example/a', headers=json_headers)
+            await client.get('http://api.example/a', headers=json_headers)
+            assert len(origin.requests) == 1
+            await client.get('http://api.example/a',
+                             headers={'Accept': 'text/html'})
+            assert len(origin.requests) == 2
+
+    asyncio.run(_run())
+
+
+def test_caching_transport_large_body():
+    async def _run():
+        origin = _Origin({'Cache-Control': 'max-age=60'})
+        async with _get_client(origin, max_body_size=3) as client:
+            assert (await client.get('http://api.example/a')).text == \
+                'body 1'
+            assert (await client.get('http://api.example/a')).text == \
+                'body 2'
+
+    asyncio.run(_run())
+
+
+def test_caching_transport_credentials():
+    def origin(request):
+        user = request.headers.get('Authorization', 'anonymous')
+        return httpx.Response(200, headers={'Cache-Control': 'max-age=60'},
+                              content='body for {0}'.format(user))
+
+    async def _run():
+        store = hxcache.MemoryStore()
+        transport = hxcache.CachingTransport(httpx.MockTransport(origin),
+                                             store)
+        alice = httpx.AsyncClient(transport=transport, auth=('alice', 'a'))
+        bob = httpx.AsyncClient(transport=transport, auth=('bob', 'b'))
+        anonymous = httpx.AsyncClient(transport=transport)
+        r1 = await alice.get('http://api.example/a')
+        r2 = await bob.get('http://api.example/a')
+        r3 = await anonymous.get('http://api.example/a')
+        assert len(set([r1.text, r2.text, r3.text])) == 3
+        assert r3.text == 'body for anonymous'
+        assert 'tendril.cache' not in r1.extensions
+        assert (await anonymous.get('http://api.example/a')).extensions[
+            'tendril.cache'] == 'hit'
+
+        r4 = await anonymous.get('http://api.example/a',
+                                 headers={'Cookie': 'session=1'})
+        assert 'tendril.cache' not in r4.extensions
+
+        def private(request):
+            return httpx.Response(
+                200, headers={'Cache-Control': 'private, max-age=60'})
+
+        transport._transport = httpx.MockTransport(private)
+        await anonymous.get('http://api.example/b')
+        assert await store.get('http://api.example/b') is None
+
+    asyncio.run(_run())
+
+
+def test_async_client_cache():
+    async def _run():
+        store = hxcache.MemoryStore()
+        async with hx.async_client(cache=store, shared=False) as client:
+            assert isinstance(client._transport, hxcache.CachingTransport)
+            assert client._transport.store is store
+        async with hx.async_client(cache=False, shared=False) as client:
+            assert not isinstance(client._transport,
+                                  hxcache.CachingTransport)
+
+    asyncio.run(_run())
+
+
+def _get_pool(client):
+    transport = client._transport
+    while not isinstance(transport, httpx.AsyncHTTPTransport):
+        transport = transport._transport
+    return transport._pool
+
+
+def test_http2_fallback(monkeypatch):
+    async def _run():
+        async with hx.async_client(http2=True, http1=False,
+                                   shared=False) as client:
+            pool = _get_pool(client)
+            assert (pool._http1, pool._http2) == (True, False)
+
+    monkeypatch.setattr(hx, '_http2_available', False)
+    asyncio.run(_run())
+
+
+class _SlowOrigin(object):
+    def __init__(self):
+        self.active = {}
+        self.peak = {}
+        self.peak_total = 0
+
+    async def __call__(self, request):
+        host = request.url.host
+        self.active[host] = self.active.get(host, 0) + 1
+        self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+        self.peak_total = max(self.peak_total, sum(self.active.values()))
+        try:
+            await asyncio.sleep(float(request.url.params.get('delay', 0.01)))
+        finally:
+            self.active[host] -= 1
+        if request.url.path == '/missing':
+            return httpx.Response(404)
+        return httpx.Response(200, text=str(request.url))
+
+
+def test_fetch_many():
+    origin = _SlowOrigin()
+    consumed = []
+
+    async def _requests():
+        for i in range(40):
+            consumed.append(i)
+            yield 'http://host{0}.example/item/{1}'.format(i % 2, i)
+        yield {'url': 'http://host0.example/missing'}
+        yield 'http://host0.example/slow?delay=1'
+
+    async def _run():
+        async with httpx.AsyncClient(
+                transport=httpx.MockTransport(origin)) as client:
+            results = []
+            async for result in hx.fetch_many(
+                    _requests(), client, concurrency=6, max_per_host=2,
+                    timeout=0.2, raise_for_status=True):
+                assert len(consumed) <= result.index + 13
+                results.append(result)
+        return results
+
+    results = asyncio.run(_run())
+    assert sorted(r.index for r in results) == list(range(42))
+    assert origin.peak == {'host0.example': 2, 'host1.example': 2}
+    assert origin.peak_total <= 6
+    failed = {r.index: r.error for r in results if not r.ok}
+    assert isinstance(failed.pop(40), httpx.HTTPStatusError)
+    assert isinstance(failed.pop(41), asyncio.TimeoutError)
+    assert not failed
+    assert results[0].response.text.startswith('http://host')
+
+
+def test_fetch_many_hosts():
+    origin = _SlowOrigin()
+
+    def _requests():
+        for i in range(4):
+            yield 'http://hot.example/{0}?delay=0.2'.format(i)
+        for i in range(20):
+            yield 'http://cold{0}.example/'.format(i)
+
+    async def _run():
+        async with httpx.AsyncClient(
+                transport=httpx.MockTransport(origin)) as client:
+            results = []
+            async for result in hx.fetch_many(
+                    _requests(), client, concurrency=4, max_per_host=1):
+                results.append(result.index)
+        return results
+
+    results = asyncio.run(_run())
+    # Requests held back for the hot host don't hold up the others.
+    assert results.index(1) > max(results.index(i) for i in range(4, 24))
+    assert origin.peak['hot.example'] == 1
+    assert origin.peak_total == 4
+
+
+def test_fetch_many_early_exit():
+    origin = _SlowOrigin()
+
+    async def _run():
+        async with httpx.AsyncClient(
+                transport=httpx.MockTransport(origin)) as client:
+            urls = ('http://host.example/{0}'.format(i) for i in range(100))
+            async for result in hx.fetch_many(urls, client, concurrency=4):
+                break
+            await asyncio.sleep(0)
+            assert origin.active['host.example'] == 0
+
+    asyncio.run(_run())
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_sync_clients():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    class _Resource(object):
+        def _async_http_client_args(self):
+            # Arguments only supported by async clients are ignored.
+            return {'base_url': base_url, 'cache': False, 'hedge': True}
+
+        @hx.with_sync_client_cl(shared=True)
+        def get(self, client=None):
+            return client.get('/item').text
+
+    try:
+        with hx.sync_client(base_url=base_url, shared=True) as c1:
+            assert c1.get('/a').text == 'ok'
+        with hx.sync_client(base_url=base_url, shared=True) as c2:
+            assert c2 is c1
+            assert c2.get('/b').text == 'ok'
+        assert _Resource().get() == 'ok'
+        assert len(_KeepAliveHandler.connections) == 1
+        with hx.sync_client(base_url=base_url, shared=False) as c3:
+            assert c3 is not c1
+        assert c3.is_closed
+        hx.close_sync_clients()
+        assert c1.is_closed
+        assert not hx._shared_sync_clients
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.path.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_environment_proxies(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ProxyHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    proxy = 'http://127.0.0.1:{0}'.format(server.server_port)
+    for name in ('ALL_PROXY', 'HTTPS_PROXY', 'all_proxy', 'https_proxy',
+                 'http_proxy', 'no_proxy'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('HTTP_PROXY', proxy)
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+
+    async def _run():
+        async with hx.async_client(shared=False, cache=False,
+                                   retry=False) as client:
+            r = await client.get('http://proxied.example/a')
+            assert r.text == 'http://proxied.example/a'
+            r = await client.get(proxy + '/direct')
+            assert r.text == '/direct'
+
+    try:
+        asyncio.run(_run())
+        with hx.sync_client(shared=False, retry=False) as client:
+            r = client.get('http://proxied.example/b')
+            assert r.text == 'http://proxied.example/b'
+        with hx.sync_client(shared=False, trust_env=False) as client:
+            assert not client._mounts
+    finally:
+        server.shutdown()
+        server.server_close()
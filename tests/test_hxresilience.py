@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import asyncio
+import httpx
+import pytest
+from tendril.utils.www import hxresilience
+from tendril.utils.www import ratelimit
+from tendril.utils.www.resilience import RetryPolicy
+
+
+class _FlakyOrigin(object):
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request.method)
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+        if failure:
+            return httpx.Response(failure, headers={'Retry-After': '0'})
+        return httpx.Response(200)
+
+
+def _send(origin, method='GET', **kwargs):
+    async def _run():
+        transport = hxresilience.RetryingTransport(
+            httpx.MockTransport(origin), RetryPolicy(retries=2, backoff=0))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.request(method, 'http://api.example/',
+                                        **kwargs)
+    return asyncio.run(_run())
+
+
+def test_retries():
+    origin = _FlakyOrigin([503, httpx.ReadError('reset')])
+    assert _send(origin).status_code == 200
+    assert len(origin.requests) == 3
+
+    origin = _FlakyOrigin([503, 503, 503])
+    assert _send(origin).status_code == 503
+    assert len(origin.requests) == 3
+
+    origin = _FlakyOrigin([503, httpx.ReadError('reset')])
+    assert _send(origin, 'POST', content=b'x').status_code == 503
+    origin = _FlakyOrigin([httpx.ReadError('reset')])
+    with pytest.raises(httpx.ReadError):
+        _send(origin, 'POST', content=b'x')
+    origin = _FlakyOrigin([httpx.ConnectError('refused'), 503])
+    assert _send(origin, 'POST', content=b'x').status_code == 503
+    assert len(origin.requests) == 2
+
+    origin = _FlakyOrigin([503])
+    assert _send(origin, 'POST', content=b'x',
+                 headers={'Idempotency-Key': 'k1'}).status_code == 200
+
+
+def test_hedging():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        # The first request to /slow hits a slow replica.
+        if calls.count('/slow') == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, text=str(len(calls)))
+
+    async def _run():
+        transport = hxresilience.HedgingTransport(
+            httpx.MockTransport(handler), quantile=0.9, min_samples=5)
+        async with httpx.AsyncClient(transport=transport) as client:
+            for _ in range(5):
+                await client.get('http://replicas.example/fast')
+            assert hxresilience.get_hedge_stats('replicas.example').hedged \
+                == 0
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            response = await client.get('http://replicas.example/slow')
+            assert loop.time() - start < 0.5
+            assert response.text == '7'
+
+    asyncio.run(_run())
+    stats = hxresilience.get_hedge_stats('replicas.example')
+    assert (stats.requests, stats.hedged, stats.hedge_wins) == (6, 1, 1)
+    assert len(calls) == 7
+
+
+def test_hedging_cancelled():
+    state = {'started': 0, 'cancelled': 0}
+
+    async def handler(request):
+        state['started'] += 1
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            state['cancelled'] += 1
+            raise
+        return httpx.Response(200)
+
+    async def _run():
+        transport = hxresilience.HedgingTransport(
+            httpx.MockTransport(handler), delay=0.5)
+        async with httpx.AsyncClient(transport=transport) as client:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    client.get('http://cancelled.example/'), 0.05)
+            await asyncio.sleep(0)
+            assert state == {'started': 1, 'cancelled': 1}
+
+    asyncio.run(_run())
+
+
+def test_hedging_rate_limited():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(200)
+
+    async def _run():
+        limiter = ratelimit.AsyncRateLimiter(rate=5, burst=1)
+        transport = hxresilience.HedgingTransport(
+            ratelimit.RateLimitingTransport(httpx.MockTransport(handler),
+                                            limiter), delay=0.05)
+        async with httpx.AsyncClient(transport=transport) as client:
+            # Each request but the first waits 0.2s for the limiter.
+            await asyncio.gather(*[
+                client.get('http://limited.example/{0}'.format(i))
+                for i in range(3)])
+
+    asyncio.run(_run())
+    assert len(calls) == 3
+    assert hxresilience.get_hedge_stats('limited.example').hedged == 0
+
+
+def test_sync_retries():
+    responses = [503, 200]
+
+    def handler(request):
+        return httpx.Response(responses.pop(0))
+
+    transport = hxresilience.RetryingTransport(
+        httpx.MockTransport(handler), RetryPolicy(retries=1, backoff=0))
+    with httpx.Client(transport=transport) as client:
+        assert client.get('http://api.example/').status_code == 200
+    assert not responses
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import time
+import asyncio
+import httpx
+import pytest
+from tendril.utils.www import ratelimit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_token_bucket(clock):
+    limiter = ratelimit.AsyncRateLimiter(rate=10, burst=3)
+    delays = [limiter.reserve() for _ in range(5)]
+    assert delays == pytest.approx([0, 0, 0, 0.1, 0.2])
+    clock[0] += 1
+    assert [limiter.reserve() for _ in range(4)] == \
+        pytest.approx([0, 0, 0, 0.1])
+
+
+def test_quotas(clock):
+    limiter = ratelimit.AsyncRateLimiter(quotas=[(3, 60), (5, 3600)])
+    assert [limiter.reserve() for _ in range(4)] == \
+        pytest.approx([0, 0, 0, 60])
+    clock[0] += 120
+    # The per-minute quota has been replenished, but only one request of
+    # the hourly quota remains.
+    assert limiter.reserve() == pytest.approx(0)
+    assert limiter.reserve() == pytest.approx(3480)
+
+
+def test_rate_limiting_transport():
+    requests = []
+
+    def handler(request):
+        requests.append(time.monotonic())
+        return httpx.Response(200)
+
+    async def _run():
+        ratelimit.register_rate_limiter(
+            'limited.example', ratelimit.AsyncRateLimiter(rate=50, burst=1))
+        transport = ratelimit.RateLimitingTransport(
+            httpx.MockTransport(handler))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await asyncio.gather(*[client.get('http://limited.example/')
+                                   for _ in range(6)])
+            start = time.monotonic()
+            await asyncio.gather(*[client.get('http://free.example/')
+                                   for _ in range(6)])
+            assert time.monotonic() - start < 0.05
+
+    try:
+        asyncio.run(_run())
+    finally:
+        ratelimit.rate_limiters.pop('limited.example')
+    assert requests[5] - requests[0] >= 0.09
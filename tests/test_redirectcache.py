@@ -22,14 +22,66 @@
 Docstring for test_utils_www
 """
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import asyncio
+import threading
+import pytest
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
 from tendril.utils.www import redirectcache
+from tendril.utils.www import req
+from tendril.utils.www import hx
 from tendril.utils.www.bare import urlopen
-redirectcache.DUMP_REDIR_CACHE_ON_EXIT = False
+
+
+class _RedirectingHandler(BaseHTTPRequestHandler):
+    requests = []
+    authorization = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.authorization.append(self.headers.get('Authorization'))
+        if self.path in ('/old', '/moved'):
+            self.send_response(301 if self.path == '/old' else 308)
+            self.send_header('Location', '/new')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'new'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def redirecting_server(tmp_path, monkeypatch):
+    store = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'))
+    monkeypatch.setattr(redirectcache, 'redirect_cache', store)
+    monkeypatch.setattr(redirectcache, 'ENABLE_REDIRECT_CACHING', True)
+    monkeypatch.setattr(hx, 'ENABLE_REDIRECT_CACHING', True)
+    server = HTTPServer(('127.0.0.1', 0), _RedirectingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _RedirectingHandler.requests = []
+    _RedirectingHandler.authorization = []
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
 
 
 def test_redirect_cache_301():
     redirectcache.ENABLE_REDIRECT_CACHING = True
-    assert isinstance(redirectcache.redirect_cache, dict)
+    assert isinstance(redirectcache.redirect_cache,
+                      redirectcache.RedirectStore)
     result = urlopen('https://jigsaw.w3.org/HTTP/300/301.html')
     assert result.status == 301
     newtarget = redirectcache.get_actual_url('https://jigsaw.w3.org/HTTP/300/301.html')
@@ -54,3 +106,136 @@ def test_disabled_redirect_caching():
     assert result.status == 301
     newtarget = redirectcache.get_actual_url('https://jigsaw.w3.org/HTTP/300/301.html')
     assert newtarget == 'https://jigsaw.w3.org/HTTP/300/301.html'
+
+
+def test_redirect_store(tmp_path, monkeypatch):
+    legacy = str(tmp_path / 'redirects.p')
+    with open(legacy, 'wb') as f:
+        pickle.dump({'http://a.example/old': 'http://a.example/new'}, f)
+    store = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'),
+                                        ttl=100, legacy_path=legacy)
+    assert store['http://a.example/old'] == 'http://a.example/new'
+    assert not (tmp_path / 'redirects.p').exists()
+
+    store['http://b.example/1'] = 'http://b.example/2'
+    other = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'))
+    assert other['http://b.example/1'] == 'http://b.example/2'
+    assert len(other) == 2
+
+    store.invalidate('http://b.example/2')
+    assert 'http://b.example/1' not in store
+
+    now = redirectcache.time.time()
+    monkeypatch.setattr(redirectcache.time, 'time', lambda: now + 200)
+    assert 'http://a.example/old' not in store
+    assert 'http://a.example/old' in other
+    store.purge_expired()
+    assert len(other) == 0
+
+    # Expired redirects are purged when the database is opened.
+    store['http://c.example/1'] = 'http://c.example/2'
+    monkeypatch.setattr(redirectcache.time, 'time', lambda: now + 400)
+    expiring = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'),
+                                           ttl=100)
+    assert len(expiring) == 0
+    assert len(other) == 0
+
+
+def test_redirect_store_resolve(tmp_path):
+    store = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'))
+    assert store.resolve('http://c.example/0') == 'http://c.example/0'
+    for i in range(4):
+        store['http://c.example/{0}'.format(i)] = \
+            'http://c.example/{0}'.format(i + 1)
+    assert store.resolve('http://c.example/0') == 'http://c.example/4'
+    # The chain is collapsed in the database as well
+    assert store['http://c.example/0'] == 'http://c.example/4'
+    assert store['http://c.example/2'] == 'http://c.example/4'
+
+    # Extending the chain updates urls already resolved
+    store['http://c.example/4'] = 'http://c.example/5'
+    assert store.resolve('http://c.example/1') == 'http://c.example/5'
+    other = redirectcache.RedirectStore(str(tmp_path / 'redirects.db'))
+    assert other.resolve('http://c.example/0') == 'http://c.example/5'
+
+    store['http://c.example/5'] = 'http://c.example/0'
+    assert store.resolve('http://c.example/0') == 'http://c.example/0'
+    assert 'http://c.example/5' not in store
+
+    store.clear()
+    # Write an uncollapsed chain directly to the database
+    with store._conn as conn:
+        conn.executemany(
+            'INSERT INTO redirects VALUES (?, ?, ?)',
+            [('http://d.example/{0}'.format(i),
+              'http://d.example/{0}'.format(i + 1), 0) for i in range(5)]
+        )
+    assert store.resolve('http://d.example/0', max_hops=2) == \
+        'http://d.example/2'
+
+
+def test_redirect_caching_requests(redirecting_server):
+    session = req.requests.session()
+    session.mount('http://', req.ResilientCacheControlAdapter())
+    r = session.get(redirecting_server + '/old')
+    assert r.text == 'new'
+    assert _RedirectingHandler.requests == ['/old', '/new']
+    assert redirectcache.get_actual_url(redirecting_server + '/old') == \
+        redirecting_server + '/new'
+    r = session.get(redirecting_server + '/old')
+    assert r.text == 'new'
+    assert _RedirectingHandler.requests == ['/old', '/new', '/new']
+
+
+def test_redirect_caching_httpx(redirecting_server):
+    async def fetch():
+        async with hx.async_client(follow_redirects=True) as client:
+            r = await client.get(redirecting_server + '/old')
+            return r.text
+
+    assert asyncio.run(fetch()) == 'new'
+    assert asyncio.run(fetch()) == 'new'
+    assert _RedirectingHandler.requests == ['/old', '/new', '/new']
+
+
+def test_redirect_credentials(redirecting_server):
+    assert redirectcache.is_same_origin('http://a.example/x',
+                                        'http://a.example:80/y')
+    assert redirectcache.is_same_origin('http://a.example/x',
+                                        'https://a.example/y')
+    assert not redirectcache.is_same_origin('https://a.example/x',
+                                            'http://a.example/y')
+    assert not redirectcache.is_same_origin('http://a.example/x',
+                                            'http://b.example/x')
+    assert not redirectcache.is_same_origin('http://a.example/x',
+                                            'http://a.example:8080/x')
+
+    # Another origin, as the host differs (on the same port).
+    other = redirecting_server.replace('127.0.0.1', 'localhost')
+    redirectcache.record_redirect(other + '/private',
+                                  redirecting_server + '/new')
+    redirectcache.record_redirect(redirecting_server + '/same',
+                                  redirecting_server + '/new')
+    headers = {'Authorization': 'Bearer secret'}
+
+    session = req.requests.session()
+    session.mount('http://', req.ResilientCacheControlAdapter())
+    session.get(other + '/private', headers=headers)
+    session.get(redirecting_server + '/same', headers=headers)
+
+    async def fetch():
+        async with hx.async_client(shared=False, cache=False) as client:
+            await client.get(other + '/private', headers=headers)
+
+    asyncio.run(fetch())
+    urlopen(other + '/private', headers=headers)
+    assert _RedirectingHandler.requests == ['/new'] * 4
+    assert _RedirectingHandler.authorization == \
+        [None, 'Bearer secret', None, None]
+
+
+def test_redirect_cache_308(redirecting_server):
+    result = urlopen(redirecting_server + '/moved')
+    assert result.status == 308
+    assert redirectcache.get_actual_url(redirecting_server + '/moved') == \
+        redirecting_server + '/new'
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import time
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from requests import HTTPError
+from requests.structures import CaseInsensitiveDict
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from cachecontrol.heuristics import ExpiresAfter
+from tendril.utils.www import req
+from tendril.utils.www import cachepolicy
+from tendril.utils.www.reqcache import SQLiteCache
+from tendril.utils.www.resilience import RetryPolicy
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+    active = 0
+    peak = 0
+    served = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            _PageHandler.served += 1
+            _PageHandler.active += 1
+            _PageHandler.peak = max(_PageHandler.peak, _PageHandler.active)
+        # Later pages respond sooner, so completion order differs from
+        # request order.
+        time.sleep(0.05 / int(self.path.strip('/').split('/')[-1] or 1))
+        with self.lock:
+            _PageHandler.active -= 1
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '<html><body><p>{0}</p></body></html>'.format(
+            self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ETagHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    statuses = []
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        body = b'<html><body><p>content</p></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _PolicyHandler(BaseHTTPRequestHandler):
+    failing = False
+    count = 0
+
+    def _respond(self, content):
+        _PolicyHandler.count += 1
+        if self.failing:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '<html><body><p>{0} {1}</p></body></html>'.format(
+            content, self.count).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(self.path)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._respond(self.rfile.read(length).decode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def page_server():
+    server = _Server(('127.0.0.1', 0), _PageHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _PageHandler.peak = 0
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def etag_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(req, 'requests_cache',
+                        SQLiteCache(str(tmp_path / 'cache.db')))
+    server = _Server(('127.0.0.1', 0), _ETagHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _ETagHandler.statuses = []
+    yield 'http://127.0.0.1:{0}/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def policy_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(req, 'requests_cache',
+                        SQLiteCache(str(tmp_path / 'cache.db')))
+    monkeypatch.setattr(cachepolicy, 'cache_policies', {})
+    server = _Server(('127.0.0.1', 0), _PolicyHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    retry = req.get_urllib3_retry(RetryPolicy(retries=1, backoff=0))
+    monkeypatch.setattr(req, 'get_urllib3_retry', lambda: retry)
+    _PolicyHandler.failing = False
+    _PolicyHandler.count = 0
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_policy_heuristic():
+    class _Response(object):
+        def __init__(self, **headers):
+            self.headers = CaseInsensitiveDict(headers)
+
+    heuristic = cachepolicy.CachePolicy(ttl=60).heuristic
+    assert heuristic.update_headers(_Response())['cache-control'] == \
+        'public'
+    assert heuristic.update_headers(
+        _Response(**{'Cache-Control': 'max-age=5'})) == {}
+    heuristic = cachepolicy.CachePolicy(ignore_cache_control=True).heuristic
+    assert heuristic.ttl == req.MAX_AGE_DEFAULT
+    assert heuristic.update_headers(
+        _Response(**{'Cache-Control': 'no-store'}))['expires']
+    assert cachepolicy.CachePolicy().heuristic is None
+
+
+def test_cache_policy_stale_grace(policy_server, monkeypatch):
+    url = policy_server + '/price'
+    cachepolicy.register_cache_policy(url, cachepolicy.CachePolicy(
+        ttl=10, stale_grace=60, ignore_cache_control=True))
+    session = req.get_session(policy_server)
+    assert session.get_adapter(url).stale_grace == 60
+    assert session.get_adapter(policy_server + '/').stale_grace == 0
+
+    assert req.get_soup_requests(url, session).p.text == '/price 1'
+    assert req.get_soup_requests(url, session).p.text == '/price 1'
+    assert _PolicyHandler.count == 1
+
+    _PolicyHandler.failing = True
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 30)
+    assert req.get_soup_requests(url, session).p.text == '/price 1'
+    monkeypatch.setattr(time, 'time', lambda: now + 100)
+    with pytest.raises(HTTPError):
+        req.get_soup_requests(url, session)
+
+
+def test_cache_policy_https(policy_server):
+    cachepolicy.register_cache_policy(
+        'https://secure.example/', cachepolicy.CachePolicy(stale_grace=60))
+    session = req.get_session()
+    assert session.get_adapter('https://secure.example/a').stale_grace == 60
+    assert session.get_adapter('http://plain.example/a').stale_grace == 0
+
+
+def test_cache_policy_post(policy_server):
+    url = policy_server + '/quote'
+    cachepolicy.register_cache_policy(url, cachepolicy.CachePolicy(
+        ttl=60, ignore_cache_control=True, cache_post=True))
+    session = req.get_session(policy_server)
+    assert session.post(url, data='a').text == \
+        session.post(url, data='a').text
+    assert 'b 2' in session.post(url, data='b').text
+    assert 'a 1' in session.post(url, data='a').text
+    assert '/quote 3' in session.get(url).text
+    assert _PolicyHandler.count == 3
+
+
+def test_revalidation(etag_server):
+    # Responses expire immediately, and must be revalidated each time.
+    heuristic = ExpiresAfter(seconds=0)
+    session = req.get_session(heuristic=heuristic, revalidate=True)
+    for _ in range(3):
+        soup = req.get_soup_requests(etag_server, session)
+        assert soup.p.text == 'content'
+    assert _ETagHandler.statuses == [200, 304, 304]
+
+    _ETagHandler.statuses = []
+    session = req.get_session(heuristic=heuristic, revalidate=False)
+    for _ in range(2):
+        req.get_soup_requests(etag_server, session)
+    assert _ETagHandler.statuses == [200, 200]
+
+
+def test_shared_session(monkeypatch):
+    req.close_shared_sessions()
+    session = req.get_shared_session()
+    assert req.get_shared_session() is session
+    assert req.get_shared_session('https://') is not session
+    # Heuristics are compared by value.
+    other = req.get_shared_session(heuristic=ExpiresAfter(seconds=60))
+    assert req.get_shared_session(
+        heuristic=ExpiresAfter(seconds=60)) is other
+    assert req.get_shared_session(
+        heuristic=ExpiresAfter(seconds=30)) is not other
+
+    now = req.time.time()
+    monkeypatch.setattr(req.time, 'time',
+                        lambda: now + req.REQUESTS_SESSION_IDLE_TIMEOUT + 1)
+    assert req.get_shared_session('https://') is not session
+    assert len(req._shared_sessions) == 1
+    req.close_shared_sessions()
+
+
+def test_get_soups_requests(page_server):
+    urls = ['{0}/page/{1}'.format(page_server, i) for i in range(1, 9)]
+    session = req.requests.Session()
+
+    results = list(req.get_soups_requests(urls, session, max_workers=8,
+                                          max_per_host=3))
+    assert [url for url, _ in results] == urls
+    for url, soup in results:
+        assert soup.p.text == url[len(page_server):]
+    assert _PageHandler.peak <= 3
+
+    results = list(req.get_soups_requests(urls, session, ordered=False))
+    assert sorted(url for url, _ in results) == sorted(urls)
+    assert [url for url, _ in results] != urls
+
+    with ThreadPoolExecutor(2) as parse_executor:
+        results = list(req.get_soups_requests(
+            urls, session, parse_executor=parse_executor))
+    assert [soup.p.text for _, soup in results] == \
+        [url[len(page_server):] for url in urls]
+
+
+def test_get_soups_requests_early_exit(page_server):
+    urls = ['{0}/page/{1}'.format(page_server, i) for i in range(1, 21)]
+    session = req.requests.Session()
+    _PageHandler.served = 0
+    with ThreadPoolExecutor(2) as parse_executor:
+        soups = req.get_soups_requests(urls, session, max_workers=2,
+                                       parse_executor=parse_executor)
+        next(soups)
+        soups.close()
+    # The remaining requests are abandoned.
+    assert _PageHandler.served < len(urls) // 2
+
+
+def test_get_soups_requests_errors(page_server):
+    urls = [page_server + '/page/1', page_server + '/missing/2']
+    session = req.requests.Session()
+    results = dict(req.get_soups_requests(urls, session,
+                                          return_exceptions=True))
+    assert results[urls[0]].p.text == '/page/1'
+    assert isinstance(results[urls[1]], HTTPError)
+    with pytest.raises(HTTPError):
+        list(req.get_soups_requests(urls, session))
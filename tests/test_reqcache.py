@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+from tendril.utils.www import reqcache
+
+
+def test_sqlite_cache(tmp_path, monkeypatch):
+    cache = reqcache.SQLiteCache(str(tmp_path / 'cache.db'))
+    assert cache.get('a') is None
+    cache.set('a', b'value')
+    cache.set('b', b'other', expires=10)
+    assert cache.get('a') == b'value'
+    assert cache.get('b') == b'other'
+    cache.close()
+    assert cache.get('a') == b'value'
+    cache.delete('a')
+    assert cache.get('a') is None
+
+    now = reqcache.time.time()
+    monkeypatch.setattr(reqcache.time, 'time', lambda: now + 20)
+    assert cache.get('b') is None
+
+
+def test_memory_fronted_cache(tmp_path):
+    backend = reqcache.SQLiteCache(str(tmp_path / 'cache.db'))
+    cache = reqcache.MemoryFrontedCache(backend, max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key.encode())
+    assert list(cache._entries.keys()) == ['b', 'c']
+    assert cache.get('a') == b'a'
+    assert list(cache._entries.keys()) == ['c', 'a']
+    cache.delete('a')
+    assert cache.get('a') is None
+    assert backend.get('a') is None
+
+
+def test_memory_fronted_cache_expiry(tmp_path, monkeypatch):
+    backend = reqcache.SQLiteCache(str(tmp_path / 'cache.db'))
+    backend.set('a', b'a', expires=10)
+    cache = reqcache.MemoryFrontedCache(backend)
+    assert cache.get('a') == b'a'
+    assert 'a' in cache._entries
+    now = reqcache.time.time()
+    monkeypatch.setattr(reqcache.time, 'time', lambda: now + 20)
+    assert cache.get('a') is None
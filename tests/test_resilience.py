@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import pytest
+from tendril.utils.www import resilience
+
+
+def _classify(e):
+    return isinstance(e, IOError), None
+
+
+def test_parse_retry_after():
+    assert resilience.parse_retry_after('120') == 120
+    assert resilience.parse_retry_after(None) is None
+    assert resilience.parse_retry_after('garbage') is None
+    assert resilience.parse_retry_after(
+        'Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+def test_retry_policy_backoff():
+    policy = resilience.RetryPolicy(retries=3, backoff=1, backoff_max=5)
+    for attempt in range(10):
+        assert 0 <= policy.get_backoff(attempt) <= 5
+    assert policy.get_backoff(0, retry_after=3) == 3
+    assert policy.get_backoff(0, retry_after=300) == 5
+
+
+def test_call_retries(monkeypatch):
+    monkeypatch.setattr(resilience.time, 'sleep', lambda x: None)
+    policy = resilience.RetryPolicy(retries=2)
+    attempts = []
+
+    def flaky():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise IOError
+        return 'ok'
+
+    assert resilience.call('http://retry.example', flaky,
+                           _classify, policy) == 'ok'
+    assert len(attempts) == 3
+
+    def broken():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        resilience.call('http://retry.example', broken, _classify, policy)
+
+
+def test_circuit_breaker(monkeypatch):
+    breaker = resilience.CircuitBreaker('host', threshold=2,
+                                        reset_timeout=10)
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, 'time', lambda: now[0])
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    now[0] += 10
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    now[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+
+
+def test_call_fails_fast(monkeypatch):
+    monkeypatch.setattr(resilience.time, 'sleep', lambda x: None)
+    policy = resilience.RetryPolicy(retries=0)
+    url = 'http://failing.example'
+    breaker = resilience.get_breaker(resilience.get_host(url))
+    calls = []
+
+    def down():
+        calls.append(None)
+        raise IOError
+
+    for _ in range(breaker.threshold):
+        with pytest.raises(IOError):
+            resilience.call(url, down, _classify, policy)
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call(url, down, _classify, policy)
+    assert len(calls) == breaker.threshold
+
+
+def test_call_half_open(monkeypatch):
+    monkeypatch.setattr(resilience.time, 'sleep', lambda x: None)
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, 'time', lambda: now[0])
+    policy = resilience.RetryPolicy(retries=2)
+    url = 'http://recovering.example'
+    breaker = resilience.get_breaker(resilience.get_host(url))
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+    now[0] += breaker.reset_timeout
+    calls = []
+
+    def down():
+        calls.append(None)
+        raise IOError
+
+    # The trial is retried, and its failure reopens the breaker.
+    with pytest.raises(IOError):
+        resilience.call(url, down, _classify, policy)
+    assert len(calls) == 3
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call(url, down, _classify, policy)
+    now[0] += breaker.reset_timeout
+    assert resilience.call(url, lambda: 'ok', _classify, policy) == 'ok'
+    assert breaker.state == breaker.CLOSED
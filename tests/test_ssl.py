@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import ssl
+import shutil
+import asyncio
+import threading
+import subprocess
+import pytest
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from tendril.utils.www import hx
+from tendril.utils.www import ssl as wwwssl
+
+
+class _TLSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    resumed = []
+
+    def do_GET(self):
+        self.resumed.append(self.connection.session_reused)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def tls_server(tmp_path):
+    if not shutil.which('openssl'):
+        pytest.skip("openssl is needed to create a test certificate")
+    certfile, keyfile = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _TLSHandler)
+    server.daemon_threads = True
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _TLSHandler.resumed = []
+    yield 'https://localhost:{0}'.format(server.server_port), certfile
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_ssl_context(monkeypatch):
+    monkeypatch.setattr(wwwssl, 'SSL_NOVERIFY_HOSTS',
+                        ['https://dev.example'])
+    context = wwwssl.get_ssl_context('https://a.example/api')
+    assert wwwssl.get_ssl_context('https://a.example/other') is context
+    assert wwwssl.get_ssl_context('https://b.example') is not context
+    assert context.verify_mode == ssl.CERT_REQUIRED
+    noverify = wwwssl.get_ssl_context('https://dev.example')
+    assert noverify.verify_mode == ssl.CERT_NONE
+    assert wwwssl.get_ssl_context('https://a.example', verify=False) \
+        .verify_mode == ssl.CERT_NONE
+    assert wwwssl.ssl_context is wwwssl.get_ssl_context()
+
+
+def test_session_resumption(tls_server):
+    url, certfile = tls_server
+
+    async def _get():
+        async with hx.async_client(base_url=url, verify=certfile,
+                                   shared=False) as client:
+            response = await client.get('/')
+            assert response.text == 'ok'
+
+    for _ in range(3):
+        asyncio.run(_get())
+    assert _TLSHandler.resumed == [False, True, True]
+
+    with hx.sync_client(base_url=url, verify=certfile,
+                        shared=False) as client:
+        assert client.get('/').text == 'ok'
+    assert _TLSHandler.resumed[-1] is True
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015 Chintalagiri Shashank
+#
+# This file is part of tendril.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Docstring for test_utils_www
+"""
+
+import io
+import asyncio
+import threading
+import pytest
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.request import build_opener
+from tendril.utils.www import hx
+from tendril.utils.www import req
+from tendril.utils.www import bare
+from tendril.utils.www import tracing
+from tendril.utils.www import caching
+from tendril.utils.www.reqcache import SQLiteCache
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'<html><body><p>content</p></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=60')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(req, 'requests_cache',
+                        SQLiteCache(str(tmp_path / 'cache.db')))
+    server = _Server(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}/page'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+class _Collector(list):
+    def __call__(self, span):
+        self.append(span)
+
+    def names(self, backend=None):
+        return [s.name for s in self
+                if backend is None or s.attributes.get('backend') == backend]
+
+
+@pytest.fixture
+def spans():
+    collector = _Collector()
+    tracing.add_tracer(collector)
+    yield collector
+    tracing.remove_tracer(collector)
+
+
+def test_tracing_disabled():
+    assert not tracing.is_enabled()
+    with tracing.span('request', url='http://a.example/') as s:
+        s.set_attribute('status', 200)
+    assert not isinstance(s, tracing.Span)
+    tracing.record('connect', 0.1, host='a.example')
+
+
+def test_span(spans):
+    with pytest.raises(ValueError):
+        with tracing.span('parse', url='http://a.example/x', backend='req'):
+            raise ValueError()
+    tracing.record('connect', 0.25, host='b.example')
+    first, second = spans
+    assert first.name == 'parse'
+    assert first.attributes == {'url': 'http://a.example/x',
+                                'host': 'a.example', 'backend': 'req'}
+    assert isinstance(first.error, ValueError)
+    assert first.duration >= 0
+    assert second.duration == 0.25
+    assert second.end == pytest.approx(second.start + 0.25)
+
+
+def test_latency_aggregator():
+    with tracing.aggregate() as aggregator:
+        for duration in (0.01, 0.02, 0.03, 0.04):
+            tracing.record('ttfb', duration, host='a.example')
+        tracing.record('connect', 0.005, host='a.example')
+        tracing.record('parse', 0.1)
+    tracing.record('ttfb', 1, host='a.example')
+    assert not tracing.is_enabled()
+    assert aggregator.hosts() == ['-', 'a.example']
+    stats = aggregator.get_stats('a.example', 'ttfb')
+    assert stats.count == 4
+    assert stats.mean == pytest.approx(0.025)
+    assert stats.quantile(0.95) == 0.04
+    summary = aggregator.summary()
+    assert summary['-']['parse']['count'] == 1
+    out = io.StringIO()
+    aggregator.report(out)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == '-'
+    assert lines[3] == 'a.example'
+    # Phases are listed in the order of the request.
+    assert lines[5].split()[0] == 'connect'
+    assert lines[6].split()[:2] == ['ttfb', '4']
+
+
+def test_opentelemetry_tracer():
+    class _OTelSpan(object):
+        def __init__(self, name, start_time, attributes):
+            self.name, self.start_time = name, start_time
+            self.attributes = attributes
+
+        def end(self, end_time):
+            self.end_time = end_time
+
+    class _OTelTracer(list):
+        def start_span(self, name, start_time=None, attributes=None):
+            self.append(_OTelSpan(name, start_time, attributes))
+            return self[-1]
+
+    otel = _OTelTracer()
+    tracer = tracing.OpenTelemetryTracer(otel)
+    tracer(tracing.Span('ttfb', {'host': 'a.example', 'port': 443,
+                                 'scheme': None}, 100.0, 0.5))
+    span, = otel
+    assert span.name == 'http.ttfb'
+    assert span.attributes == {'host': 'a.example', 'port': 443}
+    assert span.end_time - span.start_time == 500000000
+
+
+class _Cache(caching.CacheBase):
+    def _get_filepath(self, key):
+        return key
+
+    def _get_fresh_content(self, key):
+        return b'content'
+
+    def _get_trace_attributes(self, key):
+        return {'host': key}
+
+
+def test_cache_tracing(tmp_path, monkeypatch, spans):
+    monkeypatch.setattr(caching, 'is_connected', lambda: True)
+    cache = _Cache(str(tmp_path))
+    assert cache._accessor(60, False, 'a.example') == b'content'
+    assert cache._accessor(60, False, 'a.example') == b'content'
+    assert [(s.name, s.attributes.get('hit')) for s in spans] == \
+        [('cache.get', False), ('cache.set', None), ('cache.get', True)]
+    assert spans[0].attributes == {'host': 'a.example', 'cache': '_Cache',
+                                   'hit': False}
+
+
+def test_req_tracing(server, spans):
+    session = req.get_session()
+    soup = req.get_soup_requests(server, session)
+    assert soup.find('p').text == 'content'
+    assert spans.names('req') == ['cache.get', 'connect', 'ttfb',
+                                  'cache.set', 'transfer', 'request',
+                                  'parse']
+    assert all(s.attributes['host'] == '127.0.0.1' for s in spans)
+    spans.clear()
+    req.get_soup_requests(server, session)
+    assert spans.names('req') == ['cache.get', 'transfer', 'request',
+                                  'parse']
+    assert spans[0].attributes['hit'] is True
+    assert spans[2].attributes['from_cache'] is True
+    session.close()
+
+
+def test_hx_tracing(server, spans):
+    async def _run():
+        async with hx.async_client(shared=False, cache=False) as client:
+            response = await client.get(server)
+            assert response.status_code == 200
+
+    asyncio.run(_run())
+    assert spans.names('hx') == ['connect', 'ttfb', 'request', 'transfer']
+    request, = [s for s in spans if s.name == 'request']
+    assert request.attributes['status'] == 200
+    assert request.attributes['url'] == server
+
+    spans.clear()
+    traced = []
+    with hx.sync_client(shared=False) as client:
+        client.get(server, extensions={
+            'trace': lambda name, info: traced.append(name)})
+    assert spans.names('hx') == ['connect', 'ttfb', 'request', 'transfer']
+    assert 'http11.receive_response_body.complete' in traced
+
+
+def test_bare_tracing(server, spans):
+    opener = build_opener(bare.TracingHTTPHandler())
+    assert opener.open(server).read()
+    assert spans.names('bare') == ['connect', 'ttfb']
+    assert spans[0].attributes['host'] == '127.0.0.1'